@@ -0,0 +1,381 @@
+import configparser
+import math
+import re
+import psycopg2
+from prettytable import PrettyTable
+import instrumentation
+from backends import get_backend, get_columns
+from sql_queries import QuerySpec, compile_queries, create_table_queries
+
+
+CREATE_TABLE_PATTERN = re.compile(r'CREATE TABLE IF NOT EXISTS (\w+)',
+                                  re.IGNORECASE)
+FOREIGN_KEY_PATTERN = re.compile(r'FOREIGN KEY\s*\((\w+)\)\s*'
+                                 r'REFERENCES\s+(\w+)\s*\((\w+)\)',
+                                 re.IGNORECASE)
+ALIAS_PATTERN = re.compile(r'\b(?:FROM|JOIN|USING)\s+(\w+)(?:\s+(?!ON\b|WHERE\b)'
+                           r'(\w+))?', re.IGNORECASE)
+EQUALITY_PATTERN = re.compile(r'\b(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)')
+COLUMN_PATTERN = re.compile(r'^(\s*)(\w+)\s+(\w+(?:\(\d+(?:,\s*\d+)?\))?)'
+                            r'(.*?)(,?)\s*$')
+CLOSING_PATTERN = re.compile(r'\n([ \t]*)\)\s*;\s*$')
+DISTSTYLE_PATTERN = re.compile(r'\s*\bdiststyle\s+\w+', re.IGNORECASE)
+KEY_PATTERN = re.compile(r'\s*\b(distkey|sortkey)\b', re.IGNORECASE)
+
+CHARACTER_TYPES = ('character varying', 'text')
+AZ64_TYPES = ('smallint', 'integer', 'bigint', 'numeric', 'date',
+              'timestamp')
+
+# BYTEDICT keeps a dictionary of at most 256 values per block
+BYTEDICT_MAX_DISTINCT = 256
+
+ANALYZE_COMPRESSION = "ANALYZE COMPRESSION {};"
+
+
+def get_settings(config):
+    """
+    Returns dictionary with section [ADVISOR] of the config:
+
+    - TABLES: tables to profile
+    - DISTSTYLE_ALL_ROWS: joined tables up to this many rows are copied to
+    every node (diststyle all)
+    - MIN_DISTKEY_DISTINCT: distinct values a distkey needs to spread the
+    rows evenly over the slices
+    - ANALYZE_COMPRESSION: use ANALYZE COMPRESSION on Redshift
+    - OUTPUT: file the revised DDL is written to
+    """
+    section = 'ADVISOR'
+    return {'tables': [table.strip() for table in
+                       config.get(section, 'TABLES', fallback='').split(',')
+                       if table.strip()],
+            'diststyle_all_rows': config.getint(section, 'DISTSTYLE_ALL_ROWS',
+                                                fallback=3000000),
+            'min_distkey_distinct': config.getint(section,
+                                                  'MIN_DISTKEY_DISTINCT',
+                                                  fallback=1000),
+            'analyze_compression': config.getboolean(
+                section, 'ANALYZE_COMPRESSION', fallback=True),
+            'output': config.get(section, 'OUTPUT',
+                                 fallback='advised_tables.sql')}
+
+
+def get_create_queries():
+    """
+    Returns dictionary of the create statements by table name.
+    """
+    return {CREATE_TABLE_PATTERN.search(query).group(1).lower(): query
+            for query in create_table_queries}
+
+
+def get_join_edges():
+    """
+    Returns set of equi-join edges (table, column, table, column) used by
+    the project: foreign keys of the DDL (the joins of the star schema
+    queries) and the equality conditions of the load queries.
+    """
+    edges = set()
+    for table, query in get_create_queries().items():
+        for column, ref_table, ref_column in FOREIGN_KEY_PATTERN.findall(query):
+            edges.add((table, column.lower(), ref_table.lower(),
+                       ref_column.lower()))
+
+    queries = compile_queries(QuerySpec())
+    for query in (queries['insert_table_queries']
+                  + queries['incremental_insert_table_queries']
+                  + queries['merge_insert_table_queries']):
+        aliases = {}
+        for table, alias in ALIAS_PATTERN.findall(query):
+            aliases[table.lower()] = table.lower()
+            if alias:
+                aliases[alias.lower()] = table.lower()
+        for left, left_column, right, right_column in \
+                EQUALITY_PATTERN.findall(query):
+            left, right = aliases.get(left.lower()), aliases.get(right.lower())
+            if left and right and left != right:
+                edges.add((left, left_column.lower(), right,
+                           right_column.lower()))
+
+    # joins are symmetric
+    return edges | {(t2, c2, t1, c1) for t1, c1, t2, c2 in edges}
+
+
+def profile_table(cur, table):
+    """
+    Returns dictionary with the row count and per column the data type,
+    non-null and distinct values and, for character columns, the longest
+    value in bytes.
+    """
+    columns = get_columns(cur, table)
+    expressions = ['COUNT(1)']
+    for name, data_type in columns:
+        expressions += ['COUNT({})'.format(name),
+                        'COUNT(DISTINCT {})'.format(name)]
+        if data_type.startswith(CHARACTER_TYPES):
+            expressions.append('MAX(OCTET_LENGTH({}))'.format(name))
+        else:
+            expressions.append('NULL')
+
+    instrumentation.execute(cur, "SELECT {} FROM {};".format(
+        ",\n       ".join(expressions), table))
+    row = cur.fetchone()
+
+    profile = {'table': table, 'rows': row[0], 'columns': []}
+    for i, (name, data_type) in enumerate(columns):
+        profile['columns'].append({'column': name, 'data_type': data_type,
+                                   'non_null': row[1 + 3 * i],
+                                   'distinct': row[2 + 3 * i],
+                                   'max_length': row[3 + 3 * i]})
+    return profile
+
+
+def analyze_compression(conn, table):
+    """
+    Returns dictionary of the encodings proposed by ANALYZE COMPRESSION
+    (Redshift) by column. It cannot run inside a transaction.
+    """
+    cur = conn.cursor()
+    conn.autocommit = True
+    try:
+        instrumentation.execute(cur, ANALYZE_COMPRESSION.format(table))
+        return {row[1].lower(): row[2].lower() for row in cur.fetchall()}
+    finally:
+        conn.autocommit = False
+
+
+def recommend_encoding(column, sortkey):
+    """
+    Returns the encoding of a column: RAW for the leading sort key (keeps
+    zone maps precise), AZ64 for numbers and timestamps, BYTEDICT for
+    character columns with few distinct values, ZSTD otherwise.
+    """
+    data_type = column['data_type']
+    if sortkey or data_type == 'boolean':
+        return 'raw'
+    if data_type.startswith(AZ64_TYPES):
+        return 'az64'
+    if data_type.startswith(CHARACTER_TYPES + ('character',)) \
+            and column['distinct'] <= BYTEDICT_MAX_DISTINCT:
+        return 'bytedict'
+    return 'zstd'
+
+
+def recommend_width(max_length):
+    """
+    Returns varchar width for values of up to max_length bytes: the next
+    power of two with 25% headroom (16 to 65535).
+    """
+    if not max_length:
+        return 16
+    return min(65535, max(16, 2 ** math.ceil(math.log2(max_length * 1.25))))
+
+
+def recommend_distribution(profiles, edges, settings):
+    """
+    Returns dictionary of (diststyle, distkey) by table.
+
+    Joined tables up to DISTSTYLE_ALL_ROWS rows are copied to every node.
+    Other tables are distributed on the join column whose largest partner
+    table is not copied to every node, so both sides of the largest join
+    are distributed on the same key; tables without such a join are
+    distributed evenly.
+    """
+    rows = {table: profile['rows'] for table, profile in profiles.items()}
+    distinct = {(table, column['column']): column['distinct']
+                for table, profile in profiles.items()
+                for column in profile['columns']}
+    joined = {edge[0] for edge in edges}
+
+    distribution = {}
+    for table in profiles:
+        if table in joined and rows[table] <= settings['diststyle_all_rows']:
+            distribution[table] = ('all', None)
+
+    for table in profiles:
+        if table in distribution:
+            continue
+        candidates = [(rows[t2], c1) for t1, c1, t2, _ in edges
+                      if t1 == table and t2 in profiles
+                      and distribution.get(t2, ('key',))[0] != 'all'
+                      and distinct.get((table, c1), 0)
+                      >= settings['min_distkey_distinct']]
+        if candidates:
+            distribution[table] = ('key', max(candidates)[1])
+        else:
+            distribution[table] = ('even', None)
+    return distribution
+
+
+def recommend_sortkey(profile, edges, referencing):
+    """
+    Returns the sort key of a table: the first timestamp column of a fact
+    table (tables with foreign keys are filtered by time), otherwise the
+    column joined most often.
+    """
+    if profile['table'] in referencing:
+        for column in profile['columns']:
+            if column['data_type'].startswith('timestamp'):
+                return column['column']
+
+    counts = {}
+    for t1, c1, _, _ in edges:
+        if t1 == profile['table']:
+            counts[c1] = counts.get(c1, 0) + 1
+    if counts:
+        return max(sorted(counts), key=counts.get)
+    return None
+
+
+def recommend(profiles, compression, settings):
+    """
+    Returns dictionary of recommendations by table with the diststyle,
+    distkey, sortkey and per column the encoding and type.
+    """
+    edges = get_join_edges()
+    referencing = {table for table, query in get_create_queries().items()
+                   if FOREIGN_KEY_PATTERN.search(query)}
+    distribution = recommend_distribution(profiles, edges, settings)
+
+    recommendations = {}
+    for table, profile in profiles.items():
+        diststyle, distkey = distribution[table]
+        sortkey = recommend_sortkey(profile, edges, referencing)
+        columns = {}
+        for column in profile['columns']:
+            name = column['column']
+            encoding = recommend_encoding(column, name == sortkey)
+            if name != sortkey and name in compression.get(table, {}):
+                encoding = compression[table][name]
+            data_type = None
+            if column['data_type'].startswith(CHARACTER_TYPES):
+                data_type = 'varchar({})'.format(
+                    recommend_width(column['max_length']))
+            columns[name] = {'encoding': encoding, 'data_type': data_type}
+        recommendations[table] = {'diststyle': diststyle, 'distkey': distkey,
+                                  'sortkey': sortkey, 'columns': columns}
+    return recommendations
+
+
+def revise_ddl(query, recommendation):
+    """
+    Returns the create statement with the recommended types, encodings,
+    distribution and sort key.
+    """
+    lines = []
+    for line in DISTSTYLE_PATTERN.sub('', query).split('\n'):
+        match = COLUMN_PATTERN.match(line)
+        column = match and recommendation['columns'].get(
+            match.group(2).lower())
+        if column is None:
+            lines.append(line)
+            continue
+
+        indent, name, data_type, rest, comma = match.groups()
+        rest = KEY_PATTERN.sub('', rest).rstrip()
+        line = "{}{} {}{} ENCODE {}".format(
+            indent, name, column['data_type'] or data_type, rest,
+            column['encoding'])
+        if name.lower() == recommendation['distkey']:
+            line += ' distkey'
+        if name.lower() == recommendation['sortkey']:
+            line += ' sortkey'
+        lines.append(line + comma)
+
+    query = '\n'.join(lines)
+    diststyle = recommendation['diststyle']
+    if diststyle == 'key':
+        return query
+    return CLOSING_PATTERN.sub(
+        lambda m: "\n{0})\n{0}diststyle {1};\n".format(m.group(1), diststyle),
+        query)
+
+
+def print_recommendations(profiles, recommendations):
+    """
+    Prints the column profiles and recommendations in table format.
+    """
+    t = PrettyTable(['table', 'column', 'type', 'distinct', 'max bytes',
+                     'advised type', 'encoding', 'key'])
+    for table, profile in profiles.items():
+        recommendation = recommendations[table]
+        for column in profile['columns']:
+            name = column['column']
+            advised = recommendation['columns'][name]
+            keys = [key for key in ('distkey', 'sortkey')
+                    if recommendation[key] == name]
+            t.add_row([table, name, column['data_type'], column['distinct'],
+                       column['max_length'] or '',
+                       advised['data_type'] or '', advised['encoding'],
+                       ", ".join(keys)])
+
+    print("Schema Advisor")
+    print(t)
+    for table, recommendation in recommendations.items():
+        print("{}: {} rows, diststyle {}".format(
+            table, profiles[table]['rows'], recommendation['diststyle']))
+    print(" ")
+
+
+def main():
+    """
+    - Reads configuration file.
+
+    - Profiles the loaded tables of section [ADVISOR] (rows, distinct
+    values, longest value per column) on the configured backend, which
+    can be the local PostgreSQL database.
+
+    - On Redshift adds the encodings proposed by ANALYZE COMPRESSION.
+
+    - Recommends encodings, varchar widths, distribution and sort keys,
+    prints them and writes the revised DDL to OUTPUT.
+    """
+
+    # read config
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    instrumentation.configure(config, backend.name)
+    settings = get_settings(config)
+    create_queries = get_create_queries()
+
+    # set process status
+    success = False
+    conn = None
+    try:
+        # connect database
+        conn = backend.connect()
+        cur = conn.cursor()
+
+        profiles = {}
+        compression = {}
+        for table in settings['tables']:
+            profiles[table] = profile_table(cur, table)
+            conn.commit()
+            if backend.name == 'redshift' and settings['analyze_compression']:
+                compression[table] = analyze_compression(conn, table)
+
+        recommendations = recommend(profiles, compression, settings)
+        print_recommendations(profiles, recommendations)
+
+        with open(settings['output'], 'w') as f:
+            for table, recommendation in recommendations.items():
+                f.write(revise_ddl(create_queries[table], recommendation))
+                f.write('\n')
+        print("Revised DDL written to {}".format(settings['output']))
+
+        # change process status
+        success = True
+    except (psycopg2.Error, ValueError, KeyError) as e:
+        print(e)
+    finally:
+        if conn is not None:
+            backend.release(conn)
+        if success:
+            print('Process suceeded')
+        else:
+            print('Process failed')
+
+    return success
+
+
+if __name__ == "__main__":
+    main()
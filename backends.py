@@ -0,0 +1,300 @@
+import os
+import time
+from datetime import datetime
+import psycopg2
+import db
+import ingest
+import instrumentation
+import quarantine
+from scheduler import run_queries
+from sql_queries import copy_table_dependencies, compile_queries, \
+    get_spec, translate
+
+
+# resolves the table through the search path, so session temp tables
+# shadowing a staging table are found first
+STAGING_COLUMNS_SELECT = """
+                SELECT attname, format_type(atttypid, NULL)
+                FROM pg_attribute
+                WHERE attrelid = %s::regclass
+                AND attnum > 0
+                AND NOT attisdropped
+                ORDER BY attnum;
+"""
+
+
+class RedshiftBackend:
+    """
+    Amazon Redshift cluster configured in section [CLUSTER]. Staging tables
+    are loaded server-side by COPY from S3.
+    """
+
+    name = 'redshift'
+
+    def __init__(self, config):
+        self.config = config
+
+    section = 'CLUSTER'
+
+    def connect_kwargs(self):
+        """
+        Returns the connection parameters of the sparkify database.
+        """
+        section = self.config[self.section]
+        return {'host': section['HOST'],
+                'dbname': section['DB_NAME'],
+                'user': section['DB_USER'],
+                'password': section['DB_PASSWORD'],
+                'port': section['DB_PORT']}
+
+    def connect(self, pooled=True):
+        """
+        Returns pooled connection to the sparkify database, release it
+        with `release`. Sessions which leave state behind (e.g. temp
+        tables) should not be pooled. With SCHEMA in section [BACKEND]
+        the schema is put in front of the search path, otherwise the
+        default search path is set (a pooled connection may come from a
+        backend with another schema).
+        """
+        if not pooled:
+            conn = db.connect(self.connect_kwargs())
+        else:
+            conn = db.acquire(self.connect_kwargs())
+
+        cur = conn.cursor()
+        cur.execute(self.queries()['search_path_set'])
+        conn.commit()
+        return conn
+
+    def release(self, conn):
+        """
+        Returns a connection obtained by `connect` to the pool.
+        """
+        db.release(conn)
+
+    def queries(self, **overrides):
+        """
+        Returns dictionary with the compiled statements of the configuration
+        in the dialect of the backend (see `sql_queries.compile_queries`),
+        keyword arguments override single QuerySpec parameters.
+        """
+        return compile_queries(get_spec(self.config, dialect=self.name,
+                                        **overrides))
+
+    def translate(self, query):
+        """
+        Returns the query in the dialect of the backend.
+        """
+        return translate(query, self.name)
+
+    def translate_all(self, queries):
+        """
+        Returns list of queries in the dialect of the backend.
+        """
+        return [self.translate(query) for query in queries]
+
+    def sample_predicate(self, column, percent):
+        """
+        Returns SQL predicate keeping about `percent` percent of the rows,
+        chosen by hash of the column so equal values are kept together.
+        """
+        return "ABS(MOD(FNV_HASH({}), 10000)) < {}".format(
+            column, int(percent * 100))
+
+    def load_staging_tables(self, cur, conn, workers=1):
+        """
+        Copies data from S3 to staging tables using `copy_table_queries`.
+        Rows rejected within MAXERROR are moved to `etl_load_errors`.
+        """
+        started_at = datetime.utcnow()
+        try:
+            run_queries(cur, conn, self.queries()['copy_table_queries'],
+                        copy_table_dependencies, self.connect, workers,
+                        self.release)
+        except psycopg2.Error:
+            conn.rollback()
+            self.quarantine(cur, conn, ['stg_events_raw', 'stg_songs_raw'],
+                            started_at)
+            raise
+        self.quarantine(cur, conn, ['stg_events_raw', 'stg_songs_raw'],
+                        started_at)
+
+    def copy_events(self, cur, conn, prefix=''):
+        """
+        Copies the log_data files whose key starts with LOG_DATA/prefix
+        (e.g. "2018/11/2018-11-01") to stg_events_raw.
+        """
+        self.copy_table(cur, conn, 'stg_events_raw',
+                        self.queries(partition=prefix)['staging_events_copy'])
+
+    def copy_songs(self, cur, conn):
+        """
+        Copies all song_data files to stg_songs_raw.
+        """
+        self.copy_table(cur, conn, 'stg_songs_raw',
+                        self.queries()['staging_songs_copy'])
+
+    def copy_table(self, cur, conn, table, query):
+        """
+        Runs a COPY into a table and moves the rows it rejected (within
+        MAXERROR or failing the COPY) to `etl_load_errors`.
+        """
+        try:
+            instrumentation.execute(cur, query)
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            self.quarantine(cur, conn, [table],
+                            query_ids=[quarantine.get_last_copy_id(cur)])
+            raise
+        self.quarantine(cur, conn, [table],
+                        query_ids=[quarantine.get_last_copy_id(cur)])
+
+    def quarantine(self, cur, conn, tables, started_at=None, query_ids=None):
+        """
+        Moves the rows rejected by the COPYs into the tables since
+        `started_at` from STL_LOAD_ERRORS to `etl_load_errors`; with
+        `query_ids` only those of these COPYs (the backfill partitions copy
+        into session temp tables of the same name).
+        """
+        for table in tables:
+            count = quarantine.quarantine_copy(cur, conn, table, started_at,
+                                               query_ids=query_ids)
+            if count:
+                print("Rows quarantined in etl_load_errors ({}): {}".format(
+                    table, count))
+
+
+class PostgresBackend(RedshiftBackend):
+    """
+    Local PostgreSQL database configured in section [LOCAL]. Staging tables
+    are loaded by COPY FROM STDIN from local log_data/song_data directories
+    laid out like the S3 bucket, so the same DDL and transforms can run
+    without a cluster.
+    """
+
+    name = 'postgres'
+    section = 'LOCAL'
+
+    def sample_predicate(self, column, percent):
+        """
+        Returns SQL predicate keeping about `percent` percent of the rows,
+        hashing the column with hashtext (PostgreSQL has no FNV_HASH).
+        """
+        return "ABS(MOD(HASHTEXT(CAST({} AS text)), 10000)) < {}".format(
+            column, int(percent * 100))
+
+    def load_staging_tables(self, cur, conn, workers=1):
+        """
+        Streams local JSON files into the staging tables in batches of
+        BATCH_SIZE rows, mapping log_data with the JSONPaths file and
+        song_data by column name (JSON 'auto').
+        """
+        self.copy_events(cur, conn)
+        self.copy_songs(cur, conn)
+
+    def copy_events(self, cur, conn, prefix=''):
+        """
+        Streams the log_data files whose path below LOG_DATA starts with
+        prefix into stg_events_raw, column i is read from jsonpath i.
+        """
+        local = self.config['LOCAL']
+        started_at, start = datetime.utcnow(), time.perf_counter()
+
+        paths = [path for path in ingest.iter_json_files(local['LOG_DATA'])
+                 if os.path.relpath(path, local['LOG_DATA'])
+                 .replace(os.sep, '/').startswith(prefix)]
+        columns = get_columns(cur, 'stg_events_raw')
+        keys = ingest.read_jsonpaths(local['LOG_JSONPATH'])
+        rejects = self.reject_log()
+        records = ingest.iter_records(paths, rejects)
+        rows = self.stream_table(
+            cur, conn, 'stg_events_raw', columns,
+            ingest.flatten_events(records, keys, columns, rejects), rejects)
+        instrumentation.record_load('copy stg_events_raw', started_at,
+                                    time.perf_counter() - start, rows, conn)
+
+    def copy_songs(self, cur, conn):
+        """
+        Streams the song_data files into stg_songs_raw, columns are matched
+        to keys by name.
+        """
+        local = self.config['LOCAL']
+        started_at, start = datetime.utcnow(), time.perf_counter()
+
+        columns = get_columns(cur, 'stg_songs_raw')
+        rejects = self.reject_log()
+        records = ingest.iter_records(
+            ingest.iter_json_files(local['SONG_DATA']), rejects)
+        rows = self.stream_table(
+            cur, conn, 'stg_songs_raw', columns,
+            ingest.flatten_songs(records, columns, rejects), rejects)
+        instrumentation.record_load('copy stg_songs_raw', started_at,
+                                    time.perf_counter() - start, rows, conn)
+
+    def reject_log(self):
+        """
+        Returns reject log failing the load after [ETL] MAX_ERRORS
+        rejected lines.
+        """
+        return ingest.RejectLog(self.config.getint('ETL', 'MAX_ERRORS',
+                                                   fallback=0))
+
+    def stream_table(self, cur, conn, table, columns, rows, rejects):
+        """
+        Streams rows into a table, committing each batch together with the
+        lines rejected while reading it (moved to `etl_load_errors`). Like
+        COPY with MAXERROR, more than MAX_ERRORS rejected lines fail the
+        load as soon as they are read: the current batch is rolled back,
+        the rejected lines are kept.
+
+        Returns number of rows copied.
+        """
+        def quarantine_batch():
+            quarantine.store_load_errors(cur, conn, table, rejects.drain())
+            conn.commit()
+
+        try:
+            rows = ingest.load_table(cur, table, columns, rows,
+                                     self.batch_size(), quarantine_batch)
+            quarantine_batch()
+        except ValueError as e:
+            conn.rollback()
+            quarantine.store_load_errors(cur, conn, table, rejects.drain())
+            raise ValueError("Load of {} failed: {} (MAX_ERRORS), see "
+                             "etl_load_errors".format(table, e))
+        if rejects.count:
+            print("Rows quarantined in etl_load_errors ({}): {}".format(
+                table, rejects.count))
+        return rows
+
+    def batch_size(self):
+        """
+        Returns number of rows per COPY FROM STDIN batch.
+        """
+        return self.config.getint('LOCAL', 'BATCH_SIZE', fallback=10000)
+
+
+BACKENDS = {backend.name: backend
+            for backend in (RedshiftBackend, PostgresBackend)}
+
+
+def get_backend(config):
+    """
+    Returns the backend selected by ENGINE in section [BACKEND]
+    (default: redshift) and configures its connections (section
+    [CONNECTION]).
+    """
+    engine = config.get('BACKEND', 'ENGINE', fallback='redshift')
+    if engine not in BACKENDS:
+        raise ValueError("Unknown backend engine: {}".format(engine))
+    db.configure(config)
+    return BACKENDS[engine](config)
+
+
+def get_columns(cur, table):
+    """
+    Returns list of (column name, data type) of a table in table order.
+    """
+    cur.execute(STAGING_COLUMNS_SELECT, (table,))
+    return cur.fetchall()
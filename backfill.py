@@ -0,0 +1,221 @@
+import argparse
+import configparser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import psycopg2
+import etl
+import instrumentation
+from backends import get_backend
+from sql_queries import staging_temp_tables_create, staging_events_key_insert, \
+    staging_events_window_delete, staging_songs_truncate, \
+    staging_songs_key_insert, staging_songs_raw_truncate, backfill_lock, \
+    completed_partitions_select, completed_partition_insert, \
+    songplay_window_delete, user_history_merge, \
+    time_table_merge, song_table_merge, artist_table_merge, \
+    song_play_rollup_refresh, level_play_rollup_refresh, \
+    active_user_rollup_refresh, songplay_pending_window_delete, \
+    songplay_pending_insert
+
+
+GRAINS = {'day': timedelta(days=1), 'hour': timedelta(hours=1)}
+
+
+def get_partitions(start, end, grain):
+    """
+    Returns list of (partition start, partition end) tuples covering
+    [start, end) in steps of the grain (day or hour).
+    """
+    step = GRAINS[grain]
+    if grain == 'day':
+        start = datetime(start.year, start.month, start.day)
+    else:
+        start = datetime(start.year, start.month, start.day, start.hour)
+
+    partitions = []
+    while start < end:
+        partitions.append((start, start + step))
+        start += step
+    return partitions
+
+
+def get_completed_partitions(cur, grain, start, end):
+    """
+    Returns set of partition starts already recorded as completed.
+    """
+    try:
+        cur.execute(completed_partitions_select, (grain, start, end))
+        return {row[0] for row in cur.fetchall()}
+    except psycopg2.Error:
+        print("Error: Reading completed partitions")
+        raise
+
+
+def load_song_catalog(cur, conn, backend):
+    """
+    Reloads the song catalog (stg_songs) from song_data, merges it into
+    the songs and artists tables and resolves pending songplays whose song
+    has arrived.
+    """
+    try:
+        instrumentation.execute(cur, staging_songs_truncate)
+        conn.commit()
+        backend.copy_songs(cur, conn)
+        for query in backend.translate_all([staging_songs_key_insert,
+                                            staging_songs_raw_truncate,
+                                            song_table_merge,
+                                            artist_table_merge]):
+            instrumentation.execute(cur, query)
+            conn.commit()
+        etl.reconcile_songplays(cur, conn, backend)
+    except psycopg2.Error:
+        print("Error: Loading song catalog")
+        raise
+
+
+def backfill_partition(backend, grain, partition_start, partition_end):
+    """
+    Loads one partition on its own connection:
+
+    - copies the log_data files of the partition's day into session temp
+    tables shadowing stg_events_raw/stg_events and keeps only the events
+    inside the partition,
+
+    - merges the partition's events into the users history and time,
+    replaces the partition's songplays, refreshes the rollups of its day
+    and records the partition as completed, all in one transaction.
+
+    The transform takes table locks, so transforms of parallel partitions
+    run one at a time while their copies overlap. Partitions may finish in
+    any order, the users history is rebuilt for the users of each
+    partition.
+
+    Returns number of songplays loaded.
+    """
+    conn = backend.connect(pooled=False)
+    try:
+        cur = conn.cursor()
+
+        # copy partition into session temp staging tables
+        instrumentation.execute(cur, staging_temp_tables_create)
+        conn.commit()
+        backend.copy_events(cur, conn, partition_start.strftime('%Y/%m/%Y-%m-%d'))
+        instrumentation.execute(cur, backend.translate(staging_events_key_insert))
+        instrumentation.execute(cur, staging_events_window_delete,
+                                (partition_start, partition_end))
+        conn.commit()
+
+        # transform and record completion in one transaction
+        queries = backend.queries()
+        instrumentation.execute(cur, backfill_lock)
+        time_insert = queries['time_table_calendar_insert'] or time_table_merge
+        for query in backend.translate_all([user_history_merge, time_insert]):
+            instrumentation.execute(cur, query)
+        instrumentation.execute(cur, songplay_window_delete,
+                                (partition_start, partition_end))
+        instrumentation.execute(cur, songplay_pending_window_delete,
+                                (partition_start, partition_end))
+        record = instrumentation.execute(cur,
+                                         queries['songplay_table_insert'])
+        instrumentation.execute(cur, songplay_pending_insert)
+        for query in [song_play_rollup_refresh, level_play_rollup_refresh,
+                      active_user_rollup_refresh]:
+            instrumentation.execute(cur, query)
+        instrumentation.execute(cur, completed_partition_insert,
+                                (grain, partition_start, record['rows'],
+                                 datetime.utcnow()))
+        conn.commit()
+
+        return record['rows']
+    finally:
+        backend.release(conn)
+
+
+def main():
+    """
+    - Parses command line arguments and reads configuration file.
+
+    - Optionally reloads the song catalog (--songs).
+
+    - Splits the date range into day or hour partitions and skips the
+    partitions completed by a previous (interrupted) backfill.
+
+    - Loads the remaining partitions on a pool of workers, each partition
+    as an independent unit.
+    """
+    parser = argparse.ArgumentParser(
+        description='Backfill songplays partition by partition.')
+    parser.add_argument('--start', required=True, type=datetime.fromisoformat,
+                        help='first day/hour, e.g. 2018-11-01')
+    parser.add_argument('--end', required=True, type=datetime.fromisoformat,
+                        help='end of the range (exclusive), e.g. 2018-12-01')
+    parser.add_argument('--grain', choices=sorted(GRAINS), default='day')
+    parser.add_argument('--workers', type=int,
+                        help='parallel partitions (default: [ETL] WORKERS)')
+    parser.add_argument('--songs', action='store_true',
+                        help='reload the song catalog before the backfill')
+    args = parser.parse_args()
+
+    # read config
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    instrumentation.configure(config, backend.name)
+    workers = args.workers or config.getint('ETL', 'WORKERS', fallback=1)
+
+    # set process status
+    success = False
+    conn = None
+    failed = []
+    try:
+        # connect database
+        conn = backend.connect()
+        cur = conn.cursor()
+
+        if args.songs:
+            load_song_catalog(cur, conn, backend)
+
+        # skip completed partitions
+        completed = get_completed_partitions(cur, args.grain, args.start,
+                                             args.end)
+        partitions = [partition for partition in
+                      get_partitions(args.start, args.end, args.grain)
+                      if partition[0] not in completed]
+        print("Partitions to load: {} ({} completed before)".format(
+            len(partitions), len(completed)))
+
+        # load partitions in parallel
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(backfill_partition, backend,
+                                       args.grain, *partition): partition
+                       for partition in partitions}
+            for future in as_completed(futures):
+                partition_start = futures[future][0]
+                try:
+                    rows = future.result()
+                    print("Partition {}: {} songplays".format(
+                        partition_start, rows))
+                except (psycopg2.Error, ValueError) as e:
+                    print("Error: Partition {}: {}".format(partition_start, e))
+                    failed.append(partition_start)
+
+        # change process status
+        success = not failed
+    except psycopg2.Error as e:
+        print(e)
+    finally:
+        if conn is not None:
+            etl.record_table_load(conn, success)
+            backend.release(conn)
+        if failed:
+            print("Failed partitions (re-run to resume): {}".format(
+                ", ".join(str(start) for start in sorted(failed))))
+        if success:
+            print('Process suceeded')
+        else:
+            print('Process failed')
+
+    return success
+
+
+if __name__ == "__main__":
+    main()
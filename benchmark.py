@@ -0,0 +1,212 @@
+import argparse
+import configparser
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from prettytable import PrettyTable
+import create_tables
+import etl
+import generate_data
+import instrumentation
+import test
+
+
+def get_directory_size(root):
+    """
+    Returns total size in bytes of all files below a directory.
+    """
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, files in os.walk(root) for name in files)
+
+
+def run_stage(name, func):
+    """
+    Runs one pipeline stage and returns dictionary with its wall time,
+    peak memory and the statement records it produced.
+    """
+    tracemalloc.reset_peak()
+    first_record = len(instrumentation.get_records())
+
+    start = time.perf_counter()
+    success = func()
+    seconds = time.perf_counter() - start
+
+    _, peak = tracemalloc.get_traced_memory()
+    return {'stage': name,
+            'success': bool(success),
+            'seconds': round(seconds, 6),
+            'python_peak_mb': round(peak / 2 ** 20, 3),
+            'max_rss_mb': round(resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024, 3),
+            'statements': instrumentation.get_records()[first_record:]}
+
+
+def add_throughput(results, source_bytes):
+    """
+    Adds rows/s to every statement and MB/s to the staging copies and the
+    etl stage, based on the size of the source files.
+    """
+    for stage in results:
+        rows = 0
+        for record in stage['statements']:
+            seconds = record['seconds'] or 1e-9
+            record['rows_per_second'] = round(max(record['rows'], 0)
+                                              / seconds, 1)
+            table = record['statement'].split()[-1]
+            if record['statement'].startswith('copy ') \
+                    and table in source_bytes:
+                record['mb_per_second'] = round(
+                    source_bytes[table] / 2 ** 20 / seconds, 3)
+            rows += max(record['rows'], 0)
+
+        stage['rows'] = rows
+        stage['rows_per_second'] = round(rows / (stage['seconds'] or 1e-9), 1)
+        if stage['stage'] == 'etl':
+            stage['mb_per_second'] = round(
+                sum(source_bytes.values()) / 2 ** 20
+                / (stage['seconds'] or 1e-9), 3)
+
+
+def print_results(results):
+    """
+    Prints stage and statement results in table format.
+    """
+    t = PrettyTable(['stage', 'success', 'seconds', 'rows', 'rows/s', 'MB/s',
+                     'python peak MB', 'max rss MB'])
+    for stage in results:
+        t.add_row([stage['stage'], stage['success'], stage['seconds'],
+                   stage['rows'], stage['rows_per_second'],
+                   stage.get('mb_per_second', ''), stage['python_peak_mb'],
+                   stage['max_rss_mb']])
+    print("Benchmark Results - Stages")
+    print(t)
+
+    t = PrettyTable(['stage', 'statement', 'seconds', 'rows', 'rows/s',
+                     'MB/s'])
+    for stage in results:
+        for record in stage['statements']:
+            t.add_row([stage['stage'], record['statement'], record['seconds'],
+                       record['rows'], record['rows_per_second'],
+                       record.get('mb_per_second', '')])
+    print("Benchmark Results - Statements")
+    print(t)
+    print(" ")
+
+
+def compare_baseline(results, baseline, tolerance):
+    """
+    Returns list of statements which are more than `tolerance` (relative)
+    slower than in the baseline results. Statements are matched by stage,
+    label and position among the statements of the stage with that label
+    (e.g. "delete songs #2"), so statements on the same table stay apart.
+    """
+    def timings(stages):
+        timings = {}
+        for stage in stages:
+            seen = Counter()
+            for record in stage['statements']:
+                seen[record['statement']] += 1
+                statement = record['statement']
+                if seen[statement] > 1:
+                    statement = "{} #{}".format(statement, seen[statement])
+                timings[(stage['stage'], statement)] = record['seconds']
+        return timings
+
+    baseline_timings = timings(baseline)
+    regressions = []
+    for key, seconds in sorted(timings(results).items()):
+        before = baseline_timings.get(key)
+        if before and seconds > before * (1 + tolerance):
+            regressions.append({'stage': key[0], 'statement': key[1],
+                                'baseline': before, 'seconds': seconds})
+    return regressions
+
+
+def main():
+    """
+    - Reads configuration file, the benchmark requires the local backend.
+
+    - Generates synthetic source data at the given scale into the
+    directories of section [LOCAL].
+
+    - Runs create_tables -> etl -> test and prints per-stage and
+    per-statement throughput and peak memory.
+
+    - Optionally writes the results and compares them to a baseline,
+    exits with code 1 on regressions.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pipeline against the local backend.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='size relative to the sample data, e.g. 10')
+    parser.add_argument('--song-skew', type=float, default=1.0)
+    parser.add_argument('--user-skew', type=float, default=1.0)
+    parser.add_argument('--match-rate', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-generate', action='store_true',
+                        help='use the existing source data')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare to this results file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown (default: 0.2)')
+    args = parser.parse_args()
+
+    # read config
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    if config.get('BACKEND', 'ENGINE', fallback='redshift') == 'redshift':
+        print("Error: Benchmark requires a local backend ([BACKEND] ENGINE)")
+        sys.exit(1)
+    local = config['LOCAL']
+
+    # generate source data
+    if not args.no_generate:
+        try:
+            counts = generate_data.generate(
+                local['LOG_DATA'], local['SONG_DATA'], local['LOG_JSONPATH'],
+                args.scale, args.song_skew, args.user_skew, args.match_rate,
+                args.seed)
+        except ValueError as e:
+            print(e)
+            print("Use --no-generate to benchmark the existing data")
+            sys.exit(1)
+        print("Generated {events} events over {days} days, {songs} songs, "
+              "{users} users".format(**counts))
+
+    source_bytes = {'stg_events_raw': get_directory_size(local['LOG_DATA']),
+                    'stg_songs_raw': get_directory_size(local['SONG_DATA'])}
+
+    # run pipeline
+    tracemalloc.start()
+    results = [run_stage('create_tables', create_tables.main),
+               run_stage('etl', etl.main),
+               run_stage('test', lambda: test.main() == 0)]
+    tracemalloc.stop()
+
+    add_throughput(results, source_bytes)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+
+    failed = not all(stage['success'] for stage in results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_baseline(results, json.load(f),
+                                           args.tolerance)
+        for regression in regressions:
+            print("Regression: {stage} / {statement}: {seconds}s "
+                  "(baseline {baseline}s)".format(**regression))
+        failed = failed or bool(regressions)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,82 @@
 import configparser
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import db
+import etl
+import instrumentation
+from backends import get_backend
+from sql_queries import create_table_queries, drop_table_queries, \
+    seed_table_queries
 
 
-def drop_tables(cur, conn):
+def drop_tables(cur, conn, queries=drop_table_queries):
     """
-    Drops each table using the queries in `drop_table_queries` list.
+    Drops each table using the queries in `drop_table_queries` list
+    or the given list of queries.
     """
-    for query in drop_table_queries:
-        try:
-            cur.execute(query)
-            conn.commit()
-        except psycopg2.Error:
-            print("Error: Tables not deleted")
-            raise
+    try:
+        for query in queries:
+            instrumentation.execute(cur, query)
+            db.commit_statement(conn)
+        conn.commit()
+    except psycopg2.Error:
+        print("Error: Tables not deleted")
+        raise
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, queries=create_table_queries):
     """
-    Creates each table using the queries in `create_table_queries` list. 
+    Creates each table using the queries in `create_table_queries` list
+    or the given list of queries.
     """
-    for query in create_table_queries:
-        try:
-            cur.execute(query)
-            conn.commit()
-        except psycopg2.Error:
-            print("Error: Tables not created")
-            raise
+    try:
+        for query in queries:
+            instrumentation.execute(cur, query)
+            db.commit_statement(conn)
+        conn.commit()
+    except psycopg2.Error:
+        print("Error: Tables not created")
+        raise
 
 
 def main():
     """  
     - Reads configuration file.
     
-    - Establishes connection with the sparkify database and gets
+    - Establishes connection with the sparkify database of the configured
+    backend (Redshift or local PostgreSQL) and gets
     cursor to it.  
     
     - Drops all the tables.  
     
-    - Creates all tables needed. 
+    - Creates all tables needed and inserts the UNKNOWN song and artist
+    which unmatched songplays refer to.
     
-    - Finally, closes the connection. 
+    - Records the load in etl_loads, so cached report results of the old
+    tables are not served.
+    
+    - Finally, releases the connection. 
     """
     
     # read config
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    backend = get_backend(config)
+    instrumentation.configure(config, backend.name)
     
     # set process status
     success = False
     conn = None
     try:
         # connect database
-        conn = psycopg2.connect("host={} dbname={} user={} password={} \
-                                port={}".format(*config['CLUSTER'].values()))
+        conn = backend.connect()
         # create cursor
         cur = conn.cursor()
         
         # drop and create tables
-        drop_tables(cur, conn)
-        create_tables(cur, conn)
+        drop_tables(cur, conn, backend.translate_all(drop_table_queries))
+        create_tables(cur, conn, backend.translate_all(create_table_queries)
+                      + seed_table_queries)
+        etl.record_table_load(conn, True)
         
         # change process status
         success = True
@@ -67,11 +84,13 @@ def main():
         print(e)
     finally:
         if conn is not None:
-            conn.close()
+            backend.release(conn)
         if success:
             print('Process suceeded')
         else:
             print('Process failed')
+    
+    return success
 
 
 if __name__ == "__main__":
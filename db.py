@@ -0,0 +1,154 @@
+import atexit
+import threading
+import time
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+
+# errors after which a new connection may succeed
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+_settings = {'pool_size': 4, 'retries': 3, 'backoff': 1.0,
+             'commit': 'statement', 'keepalives': {}}
+_pools = {}
+_owners = {}
+_lock = threading.Lock()
+
+
+def configure(config):
+    """
+    Reads section [CONNECTION] of the config:
+
+    - POOL_SIZE: connections kept open per database and reused across
+    scripts run in one process, at least the larger of [ETL] WORKERS and
+    [TEST] WORKERS + 1 (0: no pooling)
+    - RETRIES, BACKOFF: retries of transient connection errors, waiting
+    BACKOFF * 2^attempt seconds
+    - KEEPALIVES_IDLE, KEEPALIVES_INTERVAL, KEEPALIVES_COUNT: TCP
+    keepalive of the connections
+    - COMMIT: statement (commit after each statement) or stage (commit
+    once per stage)
+    """
+    section = 'CONNECTION'
+    _settings['pool_size'] = config.getint(section, 'POOL_SIZE', fallback=4)
+    if _settings['pool_size'] > 0:
+        # the workers connect while the script holds its own connection
+        workers = max(config.getint('ETL', 'WORKERS', fallback=1),
+                      config.getint('TEST', 'WORKERS', fallback=1))
+        _settings['pool_size'] = max(_settings['pool_size'], workers + 1)
+    _settings['retries'] = config.getint(section, 'RETRIES', fallback=3)
+    _settings['backoff'] = config.getfloat(section, 'BACKOFF', fallback=1.0)
+    _settings['commit'] = config.get(section, 'COMMIT', fallback='statement')
+    _settings['keepalives'] = {
+        'keepalives': 1,
+        'keepalives_idle': config.getint(section, 'KEEPALIVES_IDLE',
+                                         fallback=60),
+        'keepalives_interval': config.getint(section, 'KEEPALIVES_INTERVAL',
+                                             fallback=10),
+        'keepalives_count': config.getint(section, 'KEEPALIVES_COUNT',
+                                          fallback=5)}
+    if _settings['commit'] not in ('statement', 'stage'):
+        raise ValueError("Unknown commit mode: {}".format(_settings['commit']))
+
+
+def retry(func, *args, **kwargs):
+    """
+    Calls func, retrying transient connection errors with exponential
+    backoff.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except TRANSIENT_ERRORS:
+            if attempt >= _settings['retries']:
+                raise
+            time.sleep(get_backoff(attempt))
+            attempt += 1
+
+
+def get_retries():
+    """
+    Returns number of retries of transient errors.
+    """
+    return _settings['retries']
+
+
+def get_backoff(attempt):
+    """
+    Returns seconds to wait before retry number `attempt` (0-based).
+    """
+    return _settings['backoff'] * 2 ** attempt
+
+
+def get_pool(connect_kwargs):
+    """
+    Returns the connection pool of a database, creating it on first use.
+    """
+    key = tuple(sorted(connect_kwargs.items()))
+    with _lock:
+        if key not in _pools:
+            _pools[key] = ThreadedConnectionPool(
+                0, _settings['pool_size'],
+                **dict(connect_kwargs, **_settings['keepalives']))
+        return _pools[key]
+
+
+def connect(connect_kwargs):
+    """
+    Returns new connection which is not pooled.
+    """
+    return retry(psycopg2.connect,
+                 **dict(connect_kwargs, **_settings['keepalives']))
+
+
+def acquire(connect_kwargs):
+    """
+    Returns a connection from the pool of the database (or a new one if
+    pooling is disabled). Connections closed by the server are replaced.
+    """
+    if _settings['pool_size'] <= 0:
+        return connect(connect_kwargs)
+
+    pool = get_pool(connect_kwargs)
+    conn = retry(pool.getconn)
+    while conn.closed:
+        pool.putconn(conn, close=True)
+        conn = retry(pool.getconn)
+
+    with _lock:
+        _owners[id(conn)] = pool
+    return conn
+
+
+def release(conn):
+    """
+    Returns a connection to its pool; an open transaction is rolled back.
+    Connections which are not pooled or broken are closed.
+    """
+    with _lock:
+        pool = _owners.pop(id(conn), None)
+    if pool is None:
+        conn.close()
+    else:
+        pool.putconn(conn, close=bool(conn.closed))
+
+
+def commit_statement(conn):
+    """
+    Commits after a statement unless statements are grouped per stage.
+    """
+    if _settings['commit'] == 'statement':
+        conn.commit()
+
+
+@atexit.register
+def close_all():
+    """
+    Closes all pooled connections.
+    """
+    with _lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+        _owners.clear()
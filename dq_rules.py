@@ -0,0 +1,239 @@
+import configparser
+from datetime import datetime
+from prettytable import PrettyTable
+import instrumentation
+
+
+RULE_TYPES = ['not_null', 'unique', 'foreign_key', 'range',
+              'row_count_delta']
+
+# every rule query returns (rows checked, failing rows)
+NOT_NULL_SELECT = """
+                SELECT COUNT(1),
+                       COALESCE(SUM(CASE WHEN {condition} THEN 1 ELSE 0 END), 0)
+                FROM {table}
+                WHERE {sample};
+"""
+
+UNIQUE_SELECT = """
+                SELECT COALESCE(SUM(n), 0), COALESCE(SUM(n - 1), 0)
+                FROM (
+                    SELECT COUNT(1) AS n
+                    FROM {table}
+                    WHERE {sample}
+                    GROUP BY {columns}
+                ) g;
+"""
+
+FOREIGN_KEY_SELECT = """
+                SELECT COUNT(1),
+                       COALESCE(SUM(CASE WHEN r.ref_key IS NULL
+                                    THEN 1 ELSE 0 END), 0)
+                FROM {table} t
+                LEFT JOIN (SELECT DISTINCT {ref_column} AS ref_key
+                           FROM {ref_table}) r
+                    ON t.{column} = r.ref_key
+                WHERE t.{column} IS NOT NULL
+                AND {sample};
+"""
+
+RANGE_SELECT = """
+                SELECT COUNT({column}),
+                       COALESCE(SUM(CASE WHEN {condition} THEN 1 ELSE 0 END), 0)
+                FROM {table}
+                WHERE {sample};
+"""
+
+ROW_COUNT_SELECT = "SELECT COUNT(1) FROM {table};"
+
+# the previous value of a rule, only from a run after a recorded load (not
+# of a fresh schema)
+PREVIOUS_VALUE_SELECT = """
+                SELECT value
+                FROM etl_dq_results r
+                WHERE rule = %s
+                AND EXISTS (SELECT 1 FROM etl_loads l
+                            WHERE l.loaded_at <= r.run_at)
+                ORDER BY run_at DESC
+                LIMIT 1;
+"""
+
+RESULT_INSERT = """
+                INSERT INTO etl_dq_results(
+                    run_at,
+                    rule,
+                    table_name,
+                    checked,
+                    failures,
+                    value,
+                    passed
+                )
+                VALUES (%s, %s, %s, %s, %s, %s, %s);
+"""
+
+
+def read_rules(path):
+    """
+    Returns list of rule dictionaries read from a rules file, one section
+    per rule:
+
+    - TYPE: not_null, unique, foreign_key, range or row_count_delta
+    - TABLE, COLUMNS (not_null, unique) or COLUMN (foreign_key, range)
+    - REFERENCES: table(column) of a foreign_key rule
+    - MIN / MAX: allowed values (range) or allowed change in percent
+    versus the previous run (row_count_delta)
+    - MAX_FAILURES (default 0) or MAX_FAILURE_PERCENT: pass threshold
+    - SAMPLE_PERCENT: check a hash-based sample of the rows only
+    - EXIT_CODE: exit code if the rule fails (default 1, 0: warning only)
+    """
+    parser = configparser.ConfigParser()
+    if not parser.read(path):
+        raise ValueError("Rules file not found: {}".format(path))
+
+    rules = []
+    for name in parser.sections():
+        section = parser[name]
+        rule = {'rule': name,
+                'type': section['TYPE'],
+                'table': section['TABLE'],
+                'columns': [column.strip() for column in
+                            section.get('COLUMNS', section.get('COLUMN', ''))
+                            .split(',') if column.strip()],
+                'references': section.get('REFERENCES'),
+                'min': section.getfloat('MIN', fallback=None),
+                'max': section.getfloat('MAX', fallback=None),
+                'max_failures': section.getint('MAX_FAILURES', fallback=0),
+                'max_failure_percent': section.getfloat('MAX_FAILURE_PERCENT',
+                                                        fallback=None),
+                'sample_percent': section.getfloat('SAMPLE_PERCENT',
+                                                   fallback=None),
+                'exit_code': section.getint('EXIT_CODE', fallback=1)}
+        if rule['type'] not in RULE_TYPES:
+            raise ValueError("Unknown rule type {} of rule {}".format(
+                rule['type'], name))
+        rules.append(rule)
+    return rules
+
+
+def compile_rule(rule, backend):
+    """
+    Returns the SQL query of a rule. Sampled rules keep the rows whose
+    first column hashes into the sample, so all duplicates of a key and
+    all rows referencing a key are either in or out of the sample.
+    """
+    table, columns = rule['table'], rule['columns']
+    sample = '1 = 1'
+    if rule['sample_percent'] is not None:
+        column = columns[0]
+        if rule['type'] == 'foreign_key':
+            column = 't.' + column
+        sample = backend.sample_predicate(column, rule['sample_percent'])
+
+    if rule['type'] == 'not_null':
+        condition = ' OR '.join('{} IS NULL'.format(column)
+                                for column in columns)
+        return NOT_NULL_SELECT.format(condition=condition, table=table,
+                                      sample=sample)
+    if rule['type'] == 'unique':
+        return UNIQUE_SELECT.format(table=table, sample=sample,
+                                    columns=', '.join(columns))
+    if rule['type'] == 'foreign_key':
+        ref_table, _, ref_column = rule['references'].partition('(')
+        return FOREIGN_KEY_SELECT.format(table=table, column=columns[0],
+                                         ref_table=ref_table.strip(),
+                                         ref_column=ref_column.strip(' )'),
+                                         sample=sample)
+    if rule['type'] == 'range':
+        conditions = []
+        if rule['min'] is not None:
+            conditions.append('{} < {}'.format(columns[0], rule['min']))
+        if rule['max'] is not None:
+            conditions.append('{} > {}'.format(columns[0], rule['max']))
+        return RANGE_SELECT.format(column=columns[0], table=table,
+                                   condition=' OR '.join(conditions) or '1 = 0',
+                                   sample=sample)
+    return ROW_COUNT_SELECT.format(table=table)
+
+
+def evaluate(rule, checked, failures):
+    """
+    Returns True if the failures are within the thresholds of the rule.
+    """
+    if rule['max_failure_percent'] is not None:
+        if not checked:
+            return True
+        return failures * 100.0 / checked <= rule['max_failure_percent']
+    return failures <= rule['max_failures']
+
+
+def run_rule(cur, rule, backend):
+    """
+    Runs a rule and returns dictionary with its result.
+    """
+    instrumentation.execute(cur, compile_rule(rule, backend))
+    row = cur.fetchone()
+
+    skipped = False
+    if rule['type'] == 'row_count_delta':
+        # no delta without a previous count, e.g. after create_tables.py
+        value = row[0]
+        cur.execute(PREVIOUS_VALUE_SELECT, (rule['rule'],))
+        previous = cur.fetchone()
+        checked, failures, passed = value, 0, True
+        skipped = previous is None or not previous[0]
+        if not skipped:
+            delta = (value - previous[0]) * 100.0 / previous[0]
+            passed = ((rule['min'] is None or delta >= rule['min'])
+                      and (rule['max'] is None or delta <= rule['max']))
+            failures = 0 if passed else abs(value - previous[0])
+    else:
+        checked, failures = row
+        value = None
+        passed = evaluate(rule, checked, failures)
+
+    return {'rule': rule['rule'], 'type': rule['type'],
+            'table': rule['table'], 'checked': checked,
+            'failures': failures, 'value': value, 'passed': passed,
+            'skipped': skipped, 'sampled': rule['sample_percent'] is not None,
+            'exit_code': 0 if passed else rule['exit_code']}
+
+
+def run_rules(cur, conn, rules, backend):
+    """
+    Runs all rules, stores the results in `etl_dq_results` and returns
+    list of dictionaries with the results.
+    """
+    results = [run_rule(cur, rule, backend) for rule in rules]
+
+    run_at = datetime.utcnow()
+    for result in results:
+        cur.execute(RESULT_INSERT, (run_at, result['rule'], result['table'],
+                                    result['checked'], result['failures'],
+                                    result['value'], result['passed']))
+    conn.commit()
+
+    return results
+
+
+def get_exit_code(results):
+    """
+    Returns the highest exit code of the failed rules (0 if none failed).
+    """
+    return max([result['exit_code'] for result in results] + [0])
+
+
+def print_rule_results(results):
+    """
+    Prints rule results to console in user friendly format.
+    """
+    t = PrettyTable(['rule', 'type', 'table', 'checked', 'failures',
+                     'sampled', 'result'])
+    for row in results:
+        t.add_row([row['rule'], row['type'], row['table'], row['checked'],
+                   row['failures'], row['sampled'],
+                   'skip' if row['skipped']
+                   else 'pass' if row['passed'] else 'FAIL'])
+
+    print("Data Quality Rules")
+    print(t)
+    print(" ")
@@ -1,32 +1,380 @@
 import configparser
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from psycopg2.extras import execute_values
+import explain
+import export
+import instrumentation
+import maintenance
+import manifest
+import quarantine
+from backends import get_backend
+from scheduler import run_queries
+from sql_queries import staging_events_truncate, slice_count_select, \
+    loaded_files_select, high_water_mark_select, loaded_files_insert, \
+    copy_table_dependencies, insert_table_dependencies, staging_key_queries, \
+    staging_raw_truncate_queries, staging_truncate_queries, \
+    songplay_reconcile_queries, load_insert
 
 
-def load_staging_tables(cur, conn):
+PRELOAD_MODES = ['none', 'manifest', 'compact']
+
+
+def get_incremental_sources(queries, retry_queries):
     """
-    Copies data to staging tables using the queries in `copy_table_queries`.
+    returns list of dictionaries with the S3 sources loaded by manifest,
+    with the COPY statements of the compiled `queries`.
+
+    `ordered` marks sources whose keys sort by date (log_data/YYYY/MM/...),
+    for those listing starts after the highest key already loaded.
+    `copy_gzip` is the COPY of compacted files, `retry` and `retry_gzip`
+    the COPYs (of `retry_queries`) retrying files with rejected rows.
     """
-    for query in copy_table_queries:
-        try:
-            cur.execute(query)
-            conn.commit()
-        except psycopg2.Error:
-            print("Error: Copying into staging tables")
-            raise        
+    
+    log_data = {'source': 'log_data',
+                'location': 'LOG_DATA',
+                'table': 'stg_events_raw',
+                'copy': queries['staging_events_copy_manifest'],
+                'copy_gzip': queries['staging_events_copy_manifest_gzip'],
+                'retry': retry_queries['staging_events_copy_manifest'],
+                'retry_gzip':
+                    retry_queries['staging_events_copy_manifest_gzip'],
+                'ordered': True}
+    
+    song_data = {'source': 'song_data',
+                 'location': 'SONG_DATA',
+                 'table': 'stg_songs_raw',
+                 'copy': queries['staging_songs_copy_manifest'],
+                 'copy_gzip': queries['staging_songs_copy_manifest_gzip'],
+                 'retry': retry_queries['staging_songs_copy_manifest'],
+                 'retry_gzip':
+                     retry_queries['staging_songs_copy_manifest_gzip'],
+                 'ordered': False}
+    
+    return [log_data, song_data]
 
 
-def insert_tables(cur, conn):
+def key_staging_tables(cur, conn, backend, workers=1):
+    """
+    Moves the copied rows from the raw staging tables into the staging
+    tables, computing the song match key, and empties the raw tables.
     """
-    Inserts data to target tables using the queries in `insert_table_queries`.
+    run_queries(cur, conn, backend.translate_all(staging_key_queries),
+                copy_table_dependencies, backend.connect, workers,
+                backend.release)
+    run_queries(cur, conn, staging_raw_truncate_queries)
+
+
+def load_staging_tables(cur, conn, backend, workers=1):
     """
-    for query in insert_table_queries:
+    Copies data to staging tables using the queries in `copy_table_queries`
+    (Redshift) or from local JSON files (local backend).
+    
+    With more than one worker the Redshift copies run in parallel, each on
+    its own connection. The staging tables are emptied first, so they only
+    hold the rows of the current run.
+    """
+    try:
+        run_queries(cur, conn, staging_truncate_queries)
+        backend.load_staging_tables(cur, conn, workers)
+        key_staging_tables(cur, conn, backend, workers)
+    except psycopg2.Error:
+        print("Error: Copying into staging tables")
+        raise        
+
+
+def get_new_objects(cur, s3, config, source):
+    """
+    Returns (key, size) of the S3 objects of a source which are not
+    recorded in `etl_load_files` yet.
+    """
+    url = config.get('S3', source['location'])
+    
+    start_after = None
+    if source['ordered']:
+        cur.execute(high_water_mark_select, (source['source'],))
+        start_after = cur.fetchone()[0]
+    
+    cur.execute(loaded_files_select, (source['source'],))
+    loaded = {row[0] for row in cur.fetchall()}
+    
+    return [(key, size) for key, size in
+            manifest.list_objects(s3, url, start_after) if key not in loaded]
+
+
+def get_slice_count(cur):
+    """
+    Returns number of slices of the Redshift cluster.
+    """
+    cur.execute(slice_count_select)
+    return cur.fetchone()[0]
+
+
+def compact_source(s3, config, source, objects, batch_id, batches,
+                   workers=1):
+    """
+    Compacts the objects of a source into at most `batches` gzip files of
+    about equal size below COMPACT_PREFIX, `workers` files at a time.
+    
+    Returns bucket and keys of the compacted files.
+    """
+    bucket, _ = manifest.parse_s3_url(config.get('S3', source['location']))
+    prefix = manifest.unquote(config.get('S3', 'COMPACT_PREFIX')).rstrip('/')
+    
+    plan = manifest.plan_batches(objects, batches)
+    urls = ["{}/{}_{}/part-{:04d}.json.gz".format(
+                prefix, source['source'], batch_id, i)
+            for i in range(len(plan))]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(
+            lambda batch: manifest.compact_batch(s3, bucket, *batch),
+            zip(plan, urls)))
+    
+    compact_bucket, _ = manifest.parse_s3_url(prefix)
+    return compact_bucket, [manifest.parse_s3_url(url)[1] for url in urls]
+
+
+def copy_manifest(cur, conn, s3, job, batch_id):
+    """
+    Writes the manifest of a copy job and runs its COPY; rows rejected
+    within MAXERROR are skipped.
+    
+    If the COPY fails on rejected rows, only the files with errors are
+    retried with RETRY_MAX_ERRORS, so their valid rows are loaded, while
+    the other files are copied with the job's MAXERROR, both in one
+    transaction. Rejected rows are moved to `etl_load_errors`.
+    
+    Returns number of rows quarantined.
+    """
+    manifest.write_manifest(s3, job['manifest_url'], job['bucket'],
+                            job['keys'])
+    try:
+        instrumentation.execute(
+            cur, job['copy'].format("'{}'".format(job['manifest_url'])))
+        conn.commit()
+        query_ids = [quarantine.get_last_copy_id(cur)]
+    except psycopg2.Error:
+        conn.rollback()
+        # the errors of this COPY by its query id, not by time
+        query_ids = [quarantine.get_last_copy_id(cur)]
+        errors = quarantine.read_load_errors(cur, job['table'],
+                                             query_ids=query_ids)
+        clean, affected = quarantine.split_affected_keys(
+            errors, job['bucket'], job['keys'])
+        if not affected:
+            raise
+        print("Retrying {} of {} files with rejected rows ({})".format(
+            len(affected), len(job['keys']), job['table']))
+        
+        for keys, copy, name in ((clean, job['copy'], 'clean'),
+                                 (affected, job['retry'], 'retry')):
+            if not keys:
+                continue
+            manifest_url = job['manifest_url'].replace(
+                '.manifest', '_{}.manifest'.format(name))
+            manifest.write_manifest(s3, manifest_url, job['bucket'], keys)
+            instrumentation.execute(cur,
+                                    copy.format("'{}'".format(manifest_url)))
+            query_ids.append(quarantine.get_last_copy_id(cur))
+        conn.commit()
+    
+    return quarantine.quarantine_copy(cur, conn, job['table'],
+                                      batch_id=batch_id, query_ids=query_ids)
+
+
+def run_copy_jobs(cur, conn, backend, s3, jobs, batch_id, workers=1):
+    """
+    Runs the copy jobs, with more than one worker in parallel on
+    connections of their own.
+    
+    Returns number of rows quarantined.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        return sum(copy_manifest(cur, conn, s3, job, batch_id)
+                   for job in jobs)
+    
+    def run(job):
+        job_conn = backend.connect()
         try:
-            cur.execute(query)
+            return copy_manifest(job_conn.cursor(), job_conn, s3, job,
+                                 batch_id)
+        finally:
+            backend.release(job_conn)
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(run, jobs))
+
+
+def load_staging_tables_manifest(cur, conn, config, batch_id, backend,
+                                 workers=1, incremental=True):
+    """
+    Copies S3 files to staging tables using a generated COPY manifest
+    per source: only files not loaded yet (incremental) or all files.
+    
+    With PRELOAD=compact in section [S3] the files are first compacted
+    into gzip files, FILES_PER_SLICE per cluster slice and balanced by
+    size, so every slice loads about the same number of bytes.
+    
+    Files with rejected rows are retried on their own (see
+    `copy_manifest`).
+    
+    Returns dictionary with the copied keys per source.
+    """
+    preload = config.get('S3', 'PRELOAD', fallback='none')
+    s3 = manifest.get_s3_client(config)
+    manifest_prefix = manifest.unquote(config.get('S3', 'MANIFEST_PREFIX'))
+    retry_queries = backend.queries(max_errors=config.getint(
+        'ETL', 'RETRY_MAX_ERRORS', fallback=100000))
+    
+    new_keys = {}
+    jobs = []
+    try:
+        # staging events only hold the current batch, a full load also
+        # reloads the song catalog
+        if incremental:
+            instrumentation.execute(cur, staging_events_truncate)
             conn.commit()
-        except psycopg2.Error:
-            print("Error: Inserting into target tables")
-            raise
+        else:
+            run_queries(cur, conn, staging_truncate_queries)
+        
+        batches = None
+        if preload == 'compact':
+            batches = get_slice_count(cur) * config.getint(
+                'S3', 'FILES_PER_SLICE', fallback=1)
+        
+        for source in get_incremental_sources(backend.queries(),
+                                              retry_queries):
+            url = config.get('S3', source['location'])
+            if incremental:
+                objects = get_new_objects(cur, s3, config, source)
+            else:
+                objects = manifest.list_objects(s3, url)
+            new_keys[source['source']] = [key for key, _ in objects]
+            if not objects:
+                continue
+            
+            bucket, _ = manifest.parse_s3_url(url)
+            job = {'table': source['table'], 'bucket': bucket,
+                   'keys': new_keys[source['source']],
+                   'copy': source['copy'], 'retry': source['retry']}
+            if batches:
+                job['bucket'], job['keys'] = compact_source(
+                    s3, config, source, objects, batch_id, batches, workers)
+                job['copy'] = source['copy_gzip']
+                job['retry'] = source['retry_gzip']
+            
+            # manifest listing the files to copy
+            job['manifest_url'] = "{}/{}_{}.manifest".format(
+                manifest_prefix.rstrip('/'), source['source'], batch_id)
+            jobs.append(job)
+        
+        quarantined = run_copy_jobs(cur, conn, backend, s3, jobs, batch_id,
+                                    workers)
+        if quarantined:
+            print("Rows quarantined in etl_load_errors: {}".format(
+                quarantined))
+        key_staging_tables(cur, conn, backend, workers)
+    except psycopg2.Error:
+        print("Error: Copying into staging tables")
+        raise
+    
+    return new_keys
+
+
+def record_loaded_files(cur, conn, new_keys, batch_id):
+    """
+    Records the copied S3 keys in `etl_load_files`, which serves as
+    high-water mark for the next incremental run.
+    """
+    loaded_at = datetime.utcnow()
+    rows = [(source, key, batch_id, loaded_at)
+            for source, keys in new_keys.items() for key in keys]
+    if not rows:
+        return
+    
+    try:
+        execute_values(cur, loaded_files_insert, rows)
+        conn.commit()
+    except psycopg2.Error:
+        print("Error: Recording loaded files")
+        raise
+
+
+def insert_tables(cur, conn, queries, connect=None, workers=1, release=None):
+    """
+    Inserts data to target tables using the given list of queries, e.g.
+    `insert_table_queries` of the compiled queries.
+    
+    With more than one worker independent tables are loaded in parallel,
+    following `insert_table_dependencies` (dimensions before songplays).
+    """
+    try:
+        run_queries(cur, conn, queries, insert_table_dependencies,
+                    connect, workers, release)
+    except psycopg2.Error:
+        print("Error: Inserting into target tables")
+        raise
+
+
+def record_table_load(conn, succeeded):
+    """
+    Records in `etl_loads` that the running script wrote to the tables,
+    also after a failure (statements may have committed). The latest row
+    is the table version of cached report results (reporting.py).
+    
+    Errors are printed, not raised: the connection may be lost already.
+    """
+    try:
+        conn.rollback()
+        cur = conn.cursor()
+        cur.execute(load_insert, (os.path.basename(sys.argv[0]),
+                                  datetime.utcnow(), succeeded))
+        conn.commit()
+    except psycopg2.Error as e:
+        print("Error: Recording load: {}".format(e))
+
+
+def reconcile_songplays(cur, conn, backend):
+    """
+    Resolves the pending songplays whose song is now in stg_songs, in one
+    transaction. Only the pending rows are re-matched.
+    
+    Returns number of songplays resolved.
+    """
+    try:
+        rows = 0
+        for query in backend.translate_all(songplay_reconcile_queries):
+            record = instrumentation.execute(cur, query)
+            if query.lstrip().startswith('UPDATE'):
+                rows = record['rows']
+        conn.commit()
+        return rows
+    except psycopg2.Error:
+        print("Error: Reconciling pending songplays")
+        raise
+
+
+def get_load_queries(backend, mode='full', dimension_load='insert'):
+    """
+    Returns list of (list name, queries) a run of the mode executes
+    against the staging and target tables, in execution order (dry run).
+    """
+    queries = backend.queries()
+    if dimension_load == 'merge':
+        inserts = 'merge_insert_table_queries'
+    elif mode == 'incremental':
+        inserts = 'incremental_insert_table_queries'
+    else:
+        inserts = 'insert_table_queries'
+    return [('copy_table_queries', queries['copy_table_queries']),
+            ('staging_key_queries',
+             backend.translate_all(staging_key_queries)),
+            (inserts, queries[inserts]),
+            ('songplay_reconcile_queries',
+             backend.translate_all(songplay_reconcile_queries))]
 
 
 def main():
@@ -34,48 +382,137 @@ def main():
     """  
     - Reads configuration file.
     
-    - Establishes connection with the sparkify database and gets
+    - Establishes connection with the sparkify database of the configured
+    backend (Redshift or local PostgreSQL) and gets
     cursor to it.  
     
-    - Copies logfiles and songfiles from S3 bucket into sparkify 
-    staging tables: stg_events, stg_songs
+    - Copies logfiles and songfiles from S3 bucket (or local directories)
+    into sparkify staging tables: stg_events, stg_songs
+      (MODE=incremental: only files not loaded by a previous run,
+       PRELOAD=manifest/compact: through a manifest of the listed files,
+       optionally compacted into gzip files per slice)
     
     - Inserts data from staging files into sparkify database target tables.
+      (MODE=incremental: only keys not present in the target tables,
+       DIMENSION_LOAD=merge: upserts users, artists, time and songs)
+    
+    - Resolves pending songplays (loaded with the UNKNOWN song) whose song
+    has arrived.
+    
+    - Optionally exports the songplays inserted since the last export to
+    date partitioned Parquet files (section [EXPORT]).
+    
+    - Optionally analyzes, vacuums or deep copies the tables whose
+    statistics are stale or which are unsorted (section [MAINTENANCE]).
     
-    - Finally, closes the connection. 
+    - Records wall time, rows and query id of each statement
+    (section [INSTRUMENTATION]).
+    
+    - DRY_RUN=true: only explains the statements of the load, stores
+    the plans and compares them with a baseline (section [EXPLAIN]).
+    
+    - Finally, releases the connection. 
     """
     
     # read config
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    mode = config.get('ETL', 'MODE', fallback='full')
+    preload = config.get('S3', 'PRELOAD', fallback='none')
+    workers = config.getint('ETL', 'WORKERS', fallback=1)
+    dimension_load = config.get('ETL', 'DIMENSION_LOAD', fallback='insert')
+    backend = get_backend(config)
+    instrumentation.configure(config, backend.name)
+    connect, release = backend.connect, backend.release
     
     # set process status
     success = False
+    loading = False
     conn = None
     try:
         # connect database
-        conn = psycopg2.connect("host={} dbname={} user={} password={} \
-                                port={}".format(*config['CLUSTER'].values()))
+        conn = connect()
         # create cursor
         cur = conn.cursor()
         
-        # copy data to staging tables 
-        load_staging_tables(cur, conn)
+        if preload not in PRELOAD_MODES:
+            raise ValueError("Unknown preload mode: {}".format(preload))
+        batch_id = int(datetime.utcnow().strftime('%Y%m%d%H%M%S'))
         
-        # insert data from staging to final tables
-        insert_tables(cur, conn)
+        if config.getboolean('ETL', 'DRY_RUN', fallback=False):
+            # explain the load without running it
+            success = explain.dry_run(
+                conn, get_load_queries(backend, mode, dimension_load),
+                explain.get_settings(config))
+            return success
+        
+        loading = True
+        if mode == 'incremental':
+            if backend.name != 'redshift':
+                raise ValueError("MODE=incremental requires the redshift "
+                                 "backend")
+            
+            # copy new files to staging tables
+            new_keys = load_staging_tables_manifest(cur, conn, config,
+                                                    batch_id, backend,
+                                                    workers)
+            
+            # insert new keys from staging to final tables
+            if dimension_load == 'merge':
+                queries = backend.queries()['merge_insert_table_queries']
+            else:
+                queries = backend.queries()[
+                    'incremental_insert_table_queries']
+            insert_tables(cur, conn, queries, connect, workers, release)
+            
+            # move high-water mark
+            record_loaded_files(cur, conn, new_keys, batch_id)
+        else:
+            # copy data to staging tables 
+            if backend.name == 'redshift' and preload != 'none':
+                load_staging_tables_manifest(cur, conn, config, batch_id,
+                                             backend, workers,
+                                             incremental=False)
+            else:
+                load_staging_tables(cur, conn, backend, workers)
+            
+            # insert data from staging to final tables
+            if dimension_load == 'merge':
+                queries = backend.queries()['merge_insert_table_queries']
+            else:
+                queries = backend.queries()['insert_table_queries']
+            insert_tables(cur, conn, queries, connect, workers, release)
+        
+        # resolve songplays loaded before their song arrived
+        resolved = reconcile_songplays(cur, conn, backend)
+        print("Pending songplays resolved: {}".format(resolved))
+        
+        # export the new songplays to the Parquet feed
+        if config.getboolean('EXPORT', 'AFTER_ETL', fallback=False):
+            export.print_export(export.export_songplays(
+                cur, conn, backend, export.get_settings(config), batch_id))
+        
+        # maintain statistics and sort order of the loaded tables
+        if config.getboolean('MAINTENANCE', 'AFTER_ETL', fallback=False):
+            table_info, actions = maintenance.maintain_tables(
+                cur, conn, backend, maintenance.get_settings(config))
+            maintenance.print_table_info(table_info, actions)
         
         # change process status
         success = True
-    except psycopg2.Error as e:
+    except (psycopg2.Error, ValueError) as e:
         print(e)
     finally:
         if conn is not None:
-            conn.close()
+            if loading:
+                record_table_load(conn, success)
+            backend.release(conn)
         if success:
             print('Process suceeded')
         else:
             print('Process failed')
+    
+    return success
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(0 if main() else 1)
\ No newline at end of file
@@ -0,0 +1,238 @@
+import json
+import os
+import re
+from collections import Counter
+import psycopg2
+from prettytable import PrettyTable
+import instrumentation
+
+
+# statements EXPLAIN accepts; COPY, LOCK, DROP etc. are skipped
+EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'with')
+
+# temp tables created by the merges, created empty so the statements
+# reading them can be explained
+CTAS_PATTERN = re.compile(r'^\s*create\s+temp\s+table\s+(\w+)\s+as\s+(.*)$',
+                          re.IGNORECASE | re.DOTALL)
+
+# costs and row estimates depend on the data, not on the plan shape
+COST_PATTERN = re.compile(r'\s*\(cost=[^)]*\)')
+
+
+def get_settings(config):
+    """
+    Returns dictionary with section [EXPLAIN] of the config:
+
+    - PLAN_FILE: JSON file the plans of a dry run are written to
+    - BASELINE: JSON file of accepted plans (a previous PLAN_FILE) the
+    plans are compared with, no comparison if it does not exist
+    - COSTLY_STEPS: plan steps which are flagged, e.g. DS_BCAST_INNER
+    """
+    section = 'EXPLAIN'
+    steps = config.get(section, 'COSTLY_STEPS',
+                       fallback='DS_BCAST_INNER,DS_DIST_BOTH,'
+                                'DS_DIST_ALL_INNER,Nested Loop')
+    return {'plan_file': config.get(section, 'PLAN_FILE',
+                                    fallback='explain_plans.json'),
+            'baseline': config.get(section, 'BASELINE',
+                                   fallback='explain_baseline.json'),
+            'costly_steps': [step.strip() for step in steps.split(',')
+                             if step.strip()]}
+
+
+def split_statements(query):
+    """
+    Returns list of the statements of a query string (the merges run
+    several statements at once).
+    """
+    return [statement.strip() for statement in query.split(';')
+            if statement.strip()]
+
+
+def get_flags(plan, costly_steps):
+    """
+    Returns sorted list of the costly steps found in the plan lines, once
+    per occurrence.
+    """
+    return sorted(step for line in plan for step in costly_steps
+                  if step in line)
+
+
+def get_cost(plan):
+    """
+    Returns the total cost estimate of the top plan step, or None.
+    """
+    for line in plan:
+        match = re.search(r'cost=[\d.]+\.\.([\d.]+)', line)
+        if match is not None:
+            return float(match.group(1))
+    return None
+
+
+def explain_queries(conn, query_lists, costly_steps):
+    """
+    Runs EXPLAIN on every statement of the (list name, queries) pairs
+    without executing them and returns list of dictionaries with
+    statement, plan lines, flagged steps, cost and the reason a statement
+    was skipped or failed. Statements are keyed by list name and position,
+    e.g. "insert_table_queries[5] insert songplays" or
+    "insert_table_queries[1.2] delete users" for the second statement of
+    a merge, so statements with the same label stay apart.
+
+    Temp tables of the merges are created empty (LIMIT 0) so the following
+    statements can be explained; everything is rolled back at the end.
+    """
+    cur = conn.cursor()
+    plans = []
+    try:
+        for list_name, queries in query_lists:
+            for n, query in enumerate(queries):
+                plans.extend(explain_query(conn, cur, list_name, n + 1,
+                                           query, costly_steps))
+    finally:
+        conn.rollback()
+
+    return plans
+
+
+def explain_query(conn, cur, list_name, position, query, costly_steps):
+    """
+    Explains the statements of the query at `position` (1-based) of a
+    query list, see `explain_queries`.
+    """
+    plans = []
+    statements = split_statements(query)
+    for i, statement in enumerate(statements):
+        key = "{}[{}] {}".format(list_name, position,
+                                 instrumentation.describe(query))
+        if len(statements) > 1:
+            key = "{}[{}.{}] {}".format(list_name, position, i + 1,
+                                        instrumentation.describe(statement))
+        result = {'statement': key, 'plan': [], 'flags': [], 'cost': None,
+                  'skipped': None}
+        plans.append(result)
+
+        ctas = CTAS_PATTERN.match(statement)
+        keyword = statement.split(None, 1)[0].lower()
+        if ctas is None and keyword not in EXPLAINABLE:
+            result['skipped'] = keyword
+            continue
+
+        try:
+            cur.execute('EXPLAIN ' + statement)
+            result['plan'] = [row[0] for row in cur.fetchall()]
+            if ctas is not None:
+                cur.execute("CREATE TEMP TABLE {} AS SELECT * FROM ({}) q "
+                            "LIMIT 0".format(ctas.group(1), ctas.group(2)))
+        except psycopg2.Error as e:
+            # the transaction is aborted, temp tables are gone
+            conn.rollback()
+            result['skipped'] = 'error: {}'.format(
+                str(e).strip().splitlines()[0])
+            continue
+        result['flags'] = get_flags(result['plan'], costly_steps)
+        result['cost'] = get_cost(result['plan'])
+
+    return plans
+
+
+def normalize_plan(plan):
+    """
+    Returns the plan lines without costs and row estimates.
+    """
+    return [COST_PATTERN.sub('', line).rstrip() for line in plan]
+
+
+def compare_plans(plans, baseline):
+    """
+    Returns list of dictionaries with the differences to the baseline
+    plans: regression (costly steps added), changed (other plan change),
+    new and removed statements.
+    """
+    baseline = {plan['statement']: plan for plan in baseline}
+    current = {plan['statement'] for plan in plans}
+
+    changes = []
+    for plan in plans:
+        old = baseline.get(plan['statement'])
+        if old is None:
+            changes.append({'statement': plan['statement'], 'change': 'new',
+                            'detail': ', '.join(plan['flags'])})
+            continue
+        added = Counter(plan['flags']) - Counter(old['flags'])
+        if added:
+            changes.append({'statement': plan['statement'],
+                            'change': 'regression',
+                            'detail': ', '.join(sorted(added.elements()))})
+        elif normalize_plan(plan['plan']) != normalize_plan(old['plan']):
+            changes.append({'statement': plan['statement'],
+                            'change': 'changed', 'detail': ''})
+    for statement in baseline:
+        if statement not in current:
+            changes.append({'statement': statement, 'change': 'removed',
+                            'detail': ''})
+    return changes
+
+
+def read_plans(path):
+    """
+    Returns the plans stored in a JSON file, or None if it does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_plans(path, plans):
+    """
+    Stores the plans in a JSON file.
+    """
+    with open(path, 'w') as f:
+        json.dump(plans, f, indent=2)
+
+
+def print_plans(plans, changes):
+    """
+    Prints flagged steps, cost and baseline change per statement in table
+    format.
+    """
+    change = {row['statement']: row for row in changes}
+    t = PrettyTable(['statement', 'cost', 'flags', 'baseline'])
+    t.align['statement'] = 'l'
+    for plan in plans:
+        row = change.get(plan['statement'])
+        t.add_row([plan['statement'],
+                   plan['cost'] if plan['skipped'] is None
+                   else 'skipped ({})'.format(plan['skipped']),
+                   ', '.join(plan['flags']),
+                   '' if row is None
+                   else ' '.join([row['change'], row['detail']]).strip()])
+    for row in changes:
+        if row['change'] == 'removed':
+            t.add_row([row['statement'], '', '', 'removed'])
+
+    print("Query Plans")
+    print(t)
+    print(" ")
+
+
+def dry_run(conn, query_lists, settings):
+    """
+    Explains the (list name, queries) pairs, writes the plans to PLAN_FILE
+    and compares them with the BASELINE plans.
+
+    Returns True unless a statement gained a costly step versus the
+    baseline.
+    """
+    plans = explain_queries(conn, query_lists, settings['costly_steps'])
+    write_plans(settings['plan_file'], plans)
+
+    baseline = read_plans(settings['baseline'])
+    changes = [] if baseline is None else compare_plans(plans, baseline)
+    print_plans(plans, changes)
+    if baseline is None:
+        print("No baseline {}, copy {} to accept the plans".format(
+            settings['baseline'], settings['plan_file']))
+
+    return not any(row['change'] == 'regression' for row in changes)
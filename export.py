@@ -0,0 +1,261 @@
+import configparser
+import json
+import os
+from datetime import datetime
+import psycopg2
+import instrumentation
+import manifest
+from backends import get_backend
+from sql_queries import export_high_water_mark_select, \
+    songplay_max_id_select, songplay_export_select, songplay_export_count, \
+    songplay_correction_export_select, songplay_correction_count, \
+    songplay_correction_delete, export_insert
+
+
+# columns of the exported files, day is the partition column
+EXPORT_COLUMNS = [('songplay_id', 'int64'), ('start_time', 'timestamp'),
+                  ('time_key', 'timestamp'), ('user_id', 'int32'),
+                  ('level', 'string'), ('song_id', 'string'),
+                  ('artist_id', 'string'), ('session_id', 'int32'),
+                  ('location', 'string'), ('user_agent', 'string')]
+
+
+def get_settings(config):
+    """
+    Returns dictionary with section [EXPORT] of the config:
+
+    - PREFIX: S3 prefix of the exports (redshift backend)
+    - LOCAL_PATH: directory of the exports (local backend)
+    - BATCH_SIZE: rows fetched and written at a time by the local writer
+    """
+    section = 'EXPORT'
+    return {'prefix': manifest.unquote(config.get(section, 'PREFIX',
+                                                  fallback='')),
+            'local_path': config.get(section, 'LOCAL_PATH',
+                                     fallback='export/songplays'),
+            'batch_size': config.getint(section, 'BATCH_SIZE',
+                                        fallback=10000)}
+
+
+def get_export_range(cur):
+    """
+    Returns (last exported songplay_id, highest songplay_id); the rows in
+    between have not been exported yet.
+    """
+    cur.execute(export_high_water_mark_select)
+    first = cur.fetchone()[0]
+    cur.execute(songplay_max_id_select)
+    last = cur.fetchone()[0]
+    return first, (last if last is not None else first)
+
+
+def unload_songplays(cur, conn, backend, url, select):
+    """
+    Unloads the songplays of a select (see `get_export_select`) to Parquet
+    files below url, partitioned by day, and returns the url of the UNLOAD
+    manifest.
+    """
+    instrumentation.execute(cur, backend.queries()['songplay_unload'].format(
+        select=select.replace("'", "''"), prefix=url))
+    conn.commit()
+    return url + 'manifest'
+
+
+def write_songplays(conn, path, select, batch_size):
+    """
+    Writes the songplays of a select (see `get_export_select`) to Parquet
+    files below path, one
+    file per day (day=YYYY-MM-DD/part-0000.parquet like UNLOAD), and a
+    manifest in the format of UNLOAD. Rows are streamed from a server-side
+    cursor batch by batch.
+
+    Returns the path of the manifest.
+    """
+    # pyarrow is only needed for exports of the local backend
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {'int64': pa.int64(), 'int32': pa.int32(),
+             'timestamp': pa.timestamp('us'), 'string': pa.string()}
+    schema = pa.schema([(name, types[data_type])
+                        for name, data_type in EXPORT_COLUMNS])
+
+    writers = {}
+    cur = conn.cursor(name='songplay_export')
+    try:
+        cur.execute(select)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            days = {}
+            for row in rows:
+                days.setdefault(row[-1], []).append(row[:-1])
+            for day, day_rows in days.items():
+                if day not in writers:
+                    directory = os.path.join(path, 'day={}'.format(day))
+                    os.makedirs(directory, exist_ok=True)
+                    writers[day] = pq.ParquetWriter(
+                        os.path.join(directory, 'part-0000.parquet'), schema)
+                columns = list(zip(*day_rows))
+                writers[day].write_table(pa.table(
+                    [pa.array(column, type=field.type)
+                     for column, field in zip(columns, schema)],
+                    schema=schema))
+    finally:
+        cur.close()
+        for writer in writers.values():
+            writer.close()
+    conn.commit()
+
+    entries = []
+    for day in sorted(writers):
+        file_path = os.path.join(path, 'day={}'.format(day),
+                                 'part-0000.parquet')
+        entries.append({'url': os.path.abspath(file_path),
+                        'meta': {'content_length':
+                                 os.path.getsize(file_path)}})
+    manifest_path = os.path.join(path, 'manifest')
+    os.makedirs(path, exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump({'entries': entries}, f, indent=2)
+    return manifest_path
+
+
+def write_export(conn, cur, backend, settings, export_id, select,
+                 partition=''):
+    """
+    Writes the songplays of a select below the export's directory (plus
+    `partition`, e.g. corrections/): UNLOAD on Redshift, the local Parquet
+    writer on PostgreSQL.
+
+    Returns the url or path of the manifest.
+    """
+    if backend.name == 'redshift':
+        if not settings['prefix']:
+            raise ValueError("PREFIX in section [EXPORT] is not set")
+        url = "{}/export_{}/{}".format(settings['prefix'].rstrip('/'),
+                                       export_id, partition)
+        return unload_songplays(cur, conn, backend, url, select)
+    path = os.path.join(settings['local_path'], 'export_{}'.format(export_id),
+                        partition)
+    return write_songplays(conn, path, select, settings['batch_size'])
+
+
+def export_songplays(cur, conn, backend, settings, export_id):
+    """
+    Exports the songplays inserted since the last export to date
+    partitioned Parquet files with a manifest, and the songplays exported
+    before and resolved since by the reconcile pass (queued in
+    `songplay_corrections`) to the corrections/ partition of the export.
+    The exported range is recorded in `etl_exports`, the next export
+    starts behind it.
+
+    Returns dictionary with the export, or None if there are no new or
+    corrected rows.
+    """
+    try:
+        first, last = get_export_range(cur)
+        cur.execute(songplay_correction_count, (first,))
+        corrected = cur.fetchone()[0]
+        if last <= first and not corrected:
+            conn.commit()
+            return None
+
+        rows, manifest_url = 0, None
+        if last > first:
+            cur.execute(songplay_export_count, (first, last))
+            rows = cur.fetchone()[0]
+            manifest_url = write_export(
+                conn, cur, backend, settings, export_id,
+                songplay_export_select.format(first=int(first),
+                                              last=int(last)))
+
+        corrections_manifest = None
+        if corrected:
+            corrections_manifest = write_export(
+                conn, cur, backend, settings, export_id,
+                songplay_correction_export_select.format(first=int(first)),
+                'corrections/')
+
+        export = {'export_id': export_id, 'first_songplay_id': first + 1,
+                  'last_songplay_id': last, 'rows': rows,
+                  'manifest': manifest_url, 'rows_corrected': corrected,
+                  'corrections_manifest': corrections_manifest}
+        cur.execute(songplay_correction_delete, (last,))
+        cur.execute(export_insert, (export_id, first + 1, last, rows,
+                                    manifest_url, corrected,
+                                    corrections_manifest, datetime.utcnow()))
+        conn.commit()
+    except psycopg2.Error:
+        print("Error: Exporting songplays")
+        raise
+
+    return export
+
+
+def print_export(export):
+    """
+    Prints the exported songplay_id range and manifest.
+    """
+    if export is None:
+        print("Songplays exported: none (no new rows)")
+        return
+    if export['manifest'] is not None:
+        print("Songplays exported: {} (songplay_id {} to {}), manifest {}"
+              .format(export['rows'], export['first_songplay_id'],
+                      export['last_songplay_id'], export['manifest']))
+    if export['corrections_manifest'] is not None:
+        print("Songplays corrected: {}, manifest {}".format(
+            export['rows_corrected'], export['corrections_manifest']))
+
+
+def main():
+    """
+    - Reads configuration file.
+
+    - Finds the songplays inserted since the last export by their
+    songplay_id (IDENTITY) range, and the songplays resolved since their
+    export.
+
+    - Exports them to Parquet files partitioned by day plus a manifest
+    (the resolved songplays to a corrections partition) and records the
+    range in etl_exports.
+    """
+
+    # read config
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    instrumentation.configure(config, backend.name)
+    settings = get_settings(config)
+
+    # set process status
+    success = False
+    conn = None
+    try:
+        # connect database
+        conn = backend.connect()
+        cur = conn.cursor()
+
+        export_id = int(datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+        print_export(export_songplays(cur, conn, backend, settings,
+                                      export_id))
+
+        # change process status
+        success = True
+    except (psycopg2.Error, ValueError) as e:
+        print(e)
+    finally:
+        if conn is not None:
+            backend.release(conn)
+        if success:
+            print('Process suceeded')
+        else:
+            print('Process failed')
+
+    return success
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import argparse
+import bisect
+import json
+import os
+import random
+import string
+from datetime import datetime
+
+
+# size of the udacity-dend sample at scale 1
+SAMPLE_DAYS = 30
+SAMPLE_EVENTS = 8056
+SAMPLE_SONGS = 14896
+SAMPLE_USERS = 96
+SAMPLE_START = datetime(2018, 11, 1)
+
+# pages of non-NextSong events, they carry no song
+OTHER_PAGES = ['Home', 'Logout', 'Login', 'Settings', 'About', 'Help',
+               'Upgrade', 'Downgrade', 'Save Settings']
+NEXT_SONG_SHARE = 0.8
+
+FIRST_NAMES = ['Lily', 'Jacob', 'Kate', 'Chloe', 'Aleena', 'Tegan',
+               'Jayden', 'Mohammad', 'Ryan', 'Sara']
+LAST_NAMES = ['Koch', 'Klein', 'Harrell', 'Cuevas', 'Kirby', 'Levine',
+              'Graves', 'Rodriguez', 'Smith', 'Johnson']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Lansing-East Lansing, MI',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'Atlanta-Sandy Springs-'
+             'Roswell, GA', 'Portland-South Portland, ME']
+USER_AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 '
+               '(KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+               '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) '
+               'AppleWebKit/537.77.4 (KHTML, like Gecko) Version/7.0.5 '
+               'Safari/537.77.4"',
+               'Mozilla/5.0 (X11; Linux x86_64; rv:31.0) Gecko/20100101 '
+               'Firefox/31.0']
+
+LOG_JSONPATHS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession',
+                 'lastName', 'length', 'level', 'location', 'method', 'page',
+                 'registration', 'sessionId', 'song', 'status', 'ts',
+                 'userAgent', 'userId']
+
+
+def zipf_sampler(rnd, n, skew):
+    """
+    Returns function drawing an index in [0, n) from a Zipf-like
+    distribution; skew 0 is uniform, higher values favour low indexes.
+    """
+    cumulative = []
+    total = 0.0
+    for rank in range(1, n + 1):
+        total += 1.0 / rank ** skew
+        cumulative.append(total)
+
+    def sample():
+        return min(bisect.bisect_left(cumulative, rnd.random() * total), n - 1)
+
+    return sample
+
+
+def random_id(rnd, prefix, length=16):
+    """
+    Returns random upper-case id like the Million Song Dataset ids.
+    """
+    return prefix + ''.join(rnd.choice(string.ascii_uppercase + string.digits)
+                            for _ in range(length))
+
+
+def random_title(rnd):
+    """
+    Returns random song or artist title of two to four words.
+    """
+    return ' '.join(''.join(rnd.choice(string.ascii_lowercase)
+                            for _ in range(rnd.randint(3, 8))).capitalize()
+                    for _ in range(rnd.randint(2, 4)))
+
+
+def generate_songs(rnd, n_songs):
+    """
+    Returns list of song records; roughly four songs per artist.
+    """
+    artists = [{'artist_id': random_id(rnd, 'AR'),
+                'artist_name': random_title(rnd),
+                'artist_location': rnd.choice(LOCATIONS + ['']),
+                'artist_latitude': rnd.choice([None,
+                                               round(rnd.uniform(-90, 90), 5)]),
+                'artist_longitude': rnd.choice([None,
+                                                round(rnd.uniform(-180, 180),
+                                                      5)])}
+               for _ in range(max(1, n_songs // 4))]
+
+    songs = []
+    for _ in range(n_songs):
+        song = dict(rnd.choice(artists))
+        song.update({'num_songs': 1,
+                     'song_id': random_id(rnd, 'SO'),
+                     'title': random_title(rnd),
+                     'duration': round(rnd.uniform(60, 600), 5),
+                     'year': rnd.choice([0] + list(range(1960, 2019)))})
+        songs.append(song)
+    return songs
+
+
+def write_songs(songs, root, rnd):
+    """
+    Writes one JSON file per song in the song_data/A/B/C/TR...json layout.
+    """
+    for song in songs:
+        track_id = random_id(rnd, 'TR')
+        directory = os.path.join(root, *track_id[2:5])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, track_id + '.json'), 'w') as f:
+            json.dump(song, f)
+
+
+def generate_users(rnd, n_users):
+    """
+    Returns list of user records.
+    """
+    return [{'userId': str(user_id),
+             'firstName': rnd.choice(FIRST_NAMES),
+             'lastName': rnd.choice(LAST_NAMES),
+             'gender': rnd.choice(['F', 'M']),
+             'level': rnd.choice(['free', 'paid']),
+             'location': rnd.choice(LOCATIONS),
+             'userAgent': rnd.choice(USER_AGENTS),
+             'registration': 1540000000000.0 + rnd.randint(0, 10 ** 9)}
+            for user_id in range(1, n_users + 1)]
+
+
+def iter_events(rnd, n_events, days, songs, users, song_skew, user_skew,
+                match_rate):
+    """
+    Yields (day, event) in timestamp order. A NextSong event references an
+    existing song (same title, artist and duration) with probability
+    `match_rate`, otherwise a song which is not in song_data.
+    """
+    pick_song = zipf_sampler(rnd, len(songs), song_skew)
+    pick_user = zipf_sampler(rnd, len(users), user_skew)
+    step_ms = days * 86400000 / max(1, n_events)
+    start_ms = int((SAMPLE_START - datetime(1970, 1, 1)).total_seconds() * 1000)
+    sessions = {}
+
+    for i in range(n_events):
+        ts = start_ms + int(i * step_ms) + rnd.randint(0, int(step_ms))
+        user = users[pick_user()]
+
+        # users occasionally up- or downgrade
+        if rnd.random() < 0.001:
+            user['level'] = 'paid' if user['level'] == 'free' else 'free'
+
+        session_id, item = sessions.get(user['userId'], (len(sessions), -1))
+        if rnd.random() < 0.05:
+            session_id = len(sessions) + i
+            item = -1
+        sessions[user['userId']] = (session_id, item + 1)
+
+        event = {'artist': None, 'auth': 'Logged In',
+                 'firstName': user['firstName'], 'gender': user['gender'],
+                 'itemInSession': item + 1, 'lastName': user['lastName'],
+                 'length': None, 'level': user['level'],
+                 'location': user['location'], 'method': 'GET',
+                 'page': rnd.choice(OTHER_PAGES),
+                 'registration': user['registration'],
+                 'sessionId': session_id, 'song': None, 'status': 200,
+                 'ts': ts, 'userAgent': user['userAgent'],
+                 'userId': user['userId']}
+
+        if rnd.random() < NEXT_SONG_SHARE:
+            event['page'] = 'NextSong'
+            event['method'] = 'PUT'
+            if rnd.random() < match_rate:
+                song = songs[pick_song()]
+                event.update({'artist': song['artist_name'],
+                              'song': song['title'],
+                              'length': song['duration']})
+            else:
+                event.update({'artist': random_title(rnd),
+                              'song': random_title(rnd),
+                              'length': round(rnd.uniform(60, 600), 5)})
+
+        day = datetime.utcfromtimestamp(ts / 1000).date()
+        yield day, event
+
+
+def write_events(events, root):
+    """
+    Writes events to one newline-delimited file per day in the
+    log_data/YYYY/MM/YYYY-MM-DD-events.json layout, streaming one event at
+    a time.
+
+    Returns number of events written.
+    """
+    count = 0
+    f = None
+    current_day = None
+    try:
+        for day, event in events:
+            if day != current_day:
+                if f is not None:
+                    f.close()
+                directory = os.path.join(root, day.strftime('%Y'),
+                                         day.strftime('%m'))
+                os.makedirs(directory, exist_ok=True)
+                f = open(os.path.join(directory, day.strftime(
+                    '%Y-%m-%d-events.json')), 'w')
+                current_day = day
+            f.write(json.dumps(event) + '\n')
+            count += 1
+    finally:
+        if f is not None:
+            f.close()
+    return count
+
+
+def write_jsonpaths(path):
+    """
+    Writes the JSONPaths file for log_data.
+    """
+    with open(path, 'w') as f:
+        json.dump({'jsonpaths': ["$['{}']".format(key)
+                                 for key in LOG_JSONPATHS]}, f, indent=4)
+
+
+def generate(log_data, song_data, log_jsonpath, scale=1.0, song_skew=1.0,
+             user_skew=1.0, match_rate=0.5, seed=42):
+    """
+    Generates log_data, song_data and the JSONPaths file at `scale` times
+    the size of the sample data. The time range grows with the scale, so
+    the per-day file size stays that of the sample.
+
+    Returns dictionary with the generated record counts.
+    """
+    for directory in (log_data, song_data):
+        if os.path.isdir(directory) and os.listdir(directory):
+            raise ValueError("Output directory is not empty: {}".format(
+                directory))
+
+    rnd = random.Random(seed)
+    n_songs = max(1, int(SAMPLE_SONGS * scale))
+    n_users = max(1, int(SAMPLE_USERS * scale))
+    n_events = max(1, int(SAMPLE_EVENTS * scale))
+    days = max(1, int(round(SAMPLE_DAYS * scale)))
+
+    songs = generate_songs(rnd, n_songs)
+    write_songs(songs, song_data, rnd)
+
+    users = generate_users(rnd, n_users)
+    events = iter_events(rnd, n_events, days, songs, users, song_skew,
+                         user_skew, match_rate)
+    n_events = write_events(events, log_data)
+
+    write_jsonpaths(log_jsonpath)
+
+    return {'songs': n_songs, 'users': n_users, 'events': n_events,
+            'days': days}
+
+
+def main():
+    """
+    - Parses command line arguments.
+
+    - Generates synthetic Sparkify log_data and song_data JSON files.
+    """
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic Sparkify log_data and song_data.')
+    parser.add_argument('--output', default='data',
+                        help='output directory (default: data)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='size relative to the sample data, e.g. 10')
+    parser.add_argument('--song-skew', type=float, default=1.0,
+                        help='Zipf skew of song popularity (0: uniform)')
+    parser.add_argument('--user-skew', type=float, default=1.0,
+                        help='Zipf skew of user activity (0: uniform)')
+    parser.add_argument('--match-rate', type=float, default=0.5,
+                        help='share of NextSong events matching a song')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    try:
+        counts = generate(os.path.join(args.output, 'log_data'),
+                          os.path.join(args.output, 'song_data'),
+                          os.path.join(args.output, 'log_json_path.json'),
+                          args.scale, args.song_skew, args.user_skew,
+                          args.match_rate, args.seed)
+    except ValueError as e:
+        print(e)
+        return
+
+    print("Generated {events} events over {days} days, {songs} songs, "
+          "{users} users".format(**counts))
+
+
+if __name__ == "__main__":
+    main()
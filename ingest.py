@@ -0,0 +1,245 @@
+import io
+import json
+import os
+import re
+from datetime import datetime
+from decimal import Decimal
+from itertools import islice
+
+
+# range of integer columns, larger values fail the whole COPY batch
+INTEGER_MIN, INTEGER_MAX = -2 ** 31, 2 ** 31 - 1
+
+JSONPATH_PATTERN = re.compile(r"^\$(?:\['([^']+)'\]|\.(\w+))$")
+
+
+def read_jsonpaths(path):
+    """
+    Returns the JSON keys listed in a Redshift JSONPaths file in order.
+    """
+    with open(path) as f:
+        jsonpaths = json.load(f)['jsonpaths']
+
+    keys = []
+    for jsonpath in jsonpaths:
+        match = JSONPATH_PATTERN.match(jsonpath)
+        if match is None:
+            raise ValueError("Unsupported JSONPath: {}".format(jsonpath))
+        keys.append(match.group(1) or match.group(2))
+    return keys
+
+
+def iter_json_files(root):
+    """
+    Yields paths of all JSON files below a directory in sorted order.
+    """
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        for name in sorted(files):
+            if name.endswith('.json'):
+                yield os.path.join(directory, name)
+
+
+def get_reject(location, column, reason):
+    """
+    Returns a rejected line as dictionary with filename, line_number,
+    column, reason and raw_line (like STL_LOAD_ERRORS).
+    """
+    return {'filename': location['filename'],
+            'line_number': location['line_number'],
+            'column': column,
+            'reason': str(reason)[:512],
+            'raw_line': location['raw_line'][:1024]}
+
+
+class RejectLog:
+    """
+    Lines rejected by a load (see `get_reject`), kept until they are
+    written to the quarantine by `drain`. Like COPY with MAXERROR, more
+    than `max_errors` rejected lines fail the load: `append` raises
+    ValueError right away, so a bad source is not read to the end.
+    """
+
+    def __init__(self, max_errors=None):
+        self.max_errors = max_errors
+        self.count = 0
+        self._rejects = []
+
+    def append(self, reject):
+        self._rejects.append(reject)
+        self.count += 1
+        if self.max_errors is not None and self.count > self.max_errors:
+            raise ValueError("more than {} rejected lines".format(
+                self.max_errors))
+
+    def drain(self):
+        """
+        Returns the rejected lines appended since the last call.
+        """
+        rejects, self._rejects = self._rejects, []
+        return rejects
+
+
+def iter_records(paths, rejects=None):
+    """
+    Yields (location, record) of the JSON records of newline-delimited
+    JSON files one line at a time, so no file is ever read into memory as
+    a whole. The location is a dictionary with filename, line_number and
+    raw_line.
+
+    If a `rejects` list (or `RejectLog`) is given, malformed lines are
+    skipped and appended to it (see `get_reject`), otherwise they raise
+    ValueError.
+    """
+    for path in paths:
+        with open(path) as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                location = {'filename': path, 'line_number': line_number,
+                            'raw_line': line.rstrip('\n')}
+                try:
+                    record = json.loads(line)
+                    if not isinstance(record, dict):
+                        raise ValueError("Not a JSON object")
+                except ValueError as e:
+                    if rejects is None:
+                        raise
+                    rejects.append(get_reject(location, None, e))
+                    continue
+                yield location, record
+
+
+def to_copy_row(location, values, rejects=None):
+    """
+    Returns the converted (value, column name, data type) of a record, or
+    None if a value cannot be converted and the record was appended to
+    `rejects` (without `rejects` the ValueError is raised).
+    """
+    row = []
+    for value, name, data_type in values:
+        try:
+            row.append(to_copy_value(value, data_type))
+        except ValueError as e:
+            if rejects is None:
+                raise
+            rejects.append(get_reject(location, name, e))
+            return None
+    return row
+
+
+def flatten_events(records, keys, columns, rejects=None):
+    """
+    Yields one row per event record, column i taken from JSON key i of the
+    JSONPaths file (like COPY with a JSONPaths file). Records with values
+    which cannot be converted are rejected (see `to_copy_row`).
+    """
+    for location, record in records:
+        row = to_copy_row(location,
+                          [(record.get(key), name, data_type)
+                           for key, (name, data_type) in zip(keys, columns)],
+                          rejects)
+        if row is not None:
+            yield row
+
+
+def flatten_songs(records, columns, rejects=None):
+    """
+    Yields one row per song record, columns matched to JSON keys by name
+    (like COPY with JSON 'auto'). Records with values which cannot be
+    converted are rejected (see `to_copy_row`).
+    """
+    for location, record in records:
+        record = {key.lower(): value for key, value in record.items()}
+        row = to_copy_row(location,
+                          [(record.get(name), name, data_type)
+                           for name, data_type in columns],
+                          rejects)
+        if row is not None:
+            yield row
+
+
+def to_copy_value(value, data_type):
+    """
+    Converts a JSON value to a column value the way Redshift COPY does:
+    empty strings are NULL for non-text columns and timestamps are epoch
+    milliseconds (TIMEFORMAT 'epochmillisecs').
+
+    Raises ValueError for values COPY would reject, e.g. 'abc' or an
+    out of range number for an integer column.
+    """
+    if value is None:
+        return None
+    if value == '' and not data_type.startswith(('character', 'text')):
+        return None
+    try:
+        if data_type.startswith('timestamp'):
+            return datetime.utcfromtimestamp(float(value) / 1000).isoformat()
+        if data_type == 'integer':
+            number = int(value)
+            if not INTEGER_MIN <= number <= INTEGER_MAX:
+                raise ValueError("out of range")
+            return number
+        if data_type == 'numeric':
+            number = Decimal(str(value))
+            if not number.is_finite():
+                raise ValueError("not a number")
+            return value
+    except (ValueError, TypeError, ArithmeticError, OSError) as e:
+        raise ValueError("Invalid {} value {!r}: {}".format(
+            data_type, value, e))
+    return value
+
+
+def iter_batches(rows, batch_size):
+    """
+    Yields lists of at most `batch_size` rows.
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def escape_copy_value(value):
+    """
+    Returns a value as field of the COPY text format.
+    """
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_batch(cur, table, column_names, rows):
+    """
+    Copies a batch of rows into a table using COPY FROM STDIN (text format).
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(escape_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    cur.copy_expert("COPY {} ({}) FROM STDIN".format(
+        table, ', '.join(column_names)), buffer)
+
+
+def load_table(cur, table, columns, rows, batch_size, on_batch=None):
+    """
+    Streams rows into a table in batches of `batch_size` rows, memory use
+    is bounded by one batch regardless of the source size. `on_batch` is
+    called after each batch, e.g. to commit it.
+
+    Returns number of rows copied.
+    """
+    column_names = [name for name, _ in columns]
+    count = 0
+    for batch in iter_batches(rows, batch_size):
+        copy_batch(cur, table, column_names, batch)
+        count += len(batch)
+        if on_batch is not None:
+            on_batch()
+    return count
@@ -0,0 +1,174 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+
+
+STATEMENT_PATTERNS = [
+    re.compile(r'\b(insert)\s+into\s+(\w+)', re.IGNORECASE),
+    re.compile(r'\b(copy)\s+(\w+)', re.IGNORECASE),
+    re.compile(r'^\s*(drop|create)\s+(?:temp\s+)?table\s+(?:if\s+(?:not\s+)?'
+               r'exists\s+)?(\w+)', re.IGNORECASE),
+    re.compile(r'^\s*(\w+)(?:\s+from|\s+into)?\s+(\w+)', re.IGNORECASE),
+]
+
+QUERY_ID_SELECT = "SELECT pg_last_query_id();"
+
+# files and bytes scanned by a Redshift COPY
+LOAD_STATS_SELECT = """
+                SELECT
+                    (SELECT COUNT(DISTINCT filename)
+                     FROM stl_load_commits WHERE query = %s) AS files,
+                    (SELECT SUM(lines_scanned)
+                     FROM stl_load_commits WHERE query = %s) AS lines_scanned,
+                    (SELECT SUM(bytes)
+                     FROM svl_query_summary
+                     WHERE query = %s AND label LIKE 'scan%%') AS bytes_scanned;
+"""
+
+_settings = {'backend': None, 'log_file': None, 'prometheus_file': None,
+             'run_id': None}
+_records = []
+_lock = threading.Lock()
+
+
+def configure(config, backend_name):
+    """
+    Sets up instrumentation from section [INSTRUMENTATION] of the config:
+    LOG_FILE (JSON lines) and PROMETHEUS_FILE (textfile collector format),
+    empty values disable an output.
+    """
+    _settings['backend'] = backend_name
+    _settings['log_file'] = config.get('INSTRUMENTATION', 'LOG_FILE',
+                                       fallback='') or None
+    _settings['prometheus_file'] = config.get('INSTRUMENTATION',
+                                              'PROMETHEUS_FILE',
+                                              fallback='') or None
+    _settings['run_id'] = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+
+
+def describe(query):
+    """
+    Returns short label of a statement, e.g. "insert songplays".
+    """
+    for pattern in STATEMENT_PATTERNS:
+        match = pattern.search(query)
+        if match is not None:
+            return "{} {}".format(match.group(1).lower(),
+                                  match.group(2).lower())
+    return query.strip().split(None, 1)[0].lower()
+
+
+def execute(cur, query, params=None):
+    """
+    Executes a statement and records its wall time, rows affected and the
+    backend pid/query id. On Redshift files, lines and bytes scanned are
+    added for COPY statements. These are read on a cursor of their own, so
+    the result set of `cur` is left to the caller.
+
+    Returns the record.
+    """
+    started_at = datetime.utcnow()
+    start = time.perf_counter()
+    cur.execute(query, params)
+    seconds = time.perf_counter() - start
+
+    record = {'run_id': _settings['run_id'],
+              'script': os.path.basename(sys.argv[0]),
+              'statement': describe(query),
+              'started_at': started_at.isoformat(),
+              'seconds': round(seconds, 6),
+              'rows': cur.rowcount,
+              'backend': _settings['backend'],
+              'pid': cur.connection.get_backend_pid()}
+
+    if _settings['backend'] == 'redshift':
+        stats_cur = cur.connection.cursor()
+        try:
+            stats_cur.execute(QUERY_ID_SELECT)
+            record['query_id'] = stats_cur.fetchone()[0]
+            if record['statement'].startswith('copy '):
+                query_id = record['query_id']
+                stats_cur.execute(LOAD_STATS_SELECT,
+                                  (query_id, query_id, query_id))
+                files, lines, scanned = stats_cur.fetchone()
+                record.update({'files': files, 'lines_scanned': lines,
+                               'bytes_scanned': scanned})
+        finally:
+            stats_cur.close()
+
+    write(record)
+    return record
+
+
+def record_load(statement, started_at, seconds, rows, conn):
+    """
+    Records a load which is not a single statement, e.g. a client-side
+    COPY FROM STDIN streamed in batches.
+    """
+    record = {'run_id': _settings['run_id'],
+              'script': os.path.basename(sys.argv[0]),
+              'statement': statement,
+              'started_at': started_at.isoformat(),
+              'seconds': round(seconds, 6),
+              'rows': rows,
+              'backend': _settings['backend'],
+              'pid': conn.get_backend_pid()}
+    write(record)
+    return record
+
+
+def get_records():
+    """
+    Returns list of all records of the current process.
+    """
+    with _lock:
+        return list(_records)
+
+
+def write(record):
+    """
+    Appends record to the JSON lines log and rewrites the Prometheus file.
+    """
+    with _lock:
+        _records.append(record)
+        if _settings['log_file']:
+            with open(_settings['log_file'], 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+        if _settings['prometheus_file']:
+            write_prometheus(_settings['prometheus_file'], _records)
+
+
+def write_prometheus(path, records):
+    """
+    Writes the latest record per statement in Prometheus textfile format.
+    The file is replaced atomically so a collector never reads it halfway.
+    """
+    latest = {}
+    for record in records:
+        latest[record['statement']] = record
+
+    metrics = [('seconds', 'sparkify_etl_statement_seconds',
+                'Wall time of the statement'),
+               ('rows', 'sparkify_etl_statement_rows',
+                'Rows affected by the statement'),
+               ('bytes_scanned', 'sparkify_etl_statement_bytes_scanned',
+                'Bytes scanned by the COPY statement')]
+
+    lines = []
+    for key, name, description in metrics:
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} gauge'.format(name))
+        for statement, record in sorted(latest.items()):
+            if record.get(key) is None:
+                continue
+            lines.append('{}{{statement="{}",backend="{}"}} {}'.format(
+                name, statement, record['backend'], record[key]))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
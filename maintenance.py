@@ -0,0 +1,255 @@
+import configparser
+import re
+import psycopg2
+from prettytable import PrettyTable
+import instrumentation
+from backends import get_backend
+from sql_queries import create_table_queries
+
+# size in MB, skew_rows (largest / smallest slice), unsorted and stats_off
+# in percent
+TABLE_INFO_SELECT = {
+    'redshift': """
+                SELECT "table", tbl_rows, size, skew_rows, unsorted, stats_off
+                FROM svv_table_info
+                WHERE schema = current_schema()
+                AND "table" IN %s
+                ORDER BY "table";
+""",
+    # no slices or sort order, stats are stale by rows modified since the
+    # last analyze
+    'postgres': """
+                SELECT relname,
+                       n_live_tup,
+                       pg_total_relation_size(relid) / 1048576,
+                       NULL,
+                       NULL,
+                       CASE WHEN COALESCE(last_analyze, last_autoanalyze) IS NULL
+                            THEN 100.0
+                            ELSE 100.0 * n_mod_since_analyze
+                                 / GREATEST(n_live_tup, 1)
+                       END
+                FROM pg_stat_user_tables
+                WHERE schemaname = current_schema()
+                AND relname IN %s
+                ORDER BY relname;
+"""}
+
+ANALYZE = "ANALYZE {};"
+VACUUM_SORT_ONLY = "VACUUM SORT ONLY {} TO 100 PERCENT;"
+
+# deep copy into a new table created LIKE the table (distribution, sort
+# keys, encodings and IDENTITY columns are kept, the IDENTITY values are
+# copied) which replaces it by rename, all in one transaction: a failure
+# leaves the table as it was. LIKE does not copy key constraints, they are
+# added again from the DDL (see `get_constraint_queries`); grants are not
+# copied.
+DEEP_COPY = ["CREATE TABLE {0}_deep_copy (LIKE {0} INCLUDING DEFAULTS);",
+             "INSERT INTO {0}_deep_copy SELECT * FROM {0};",
+             "ALTER TABLE {0} RENAME TO {0}_deep_copy_old;",
+             "ALTER TABLE {0}_deep_copy RENAME TO {0};",
+             "DROP TABLE {0}_deep_copy_old CASCADE;"]
+
+PRIMARY_KEY_ADD = "ALTER TABLE {} ADD PRIMARY KEY ({});"
+FOREIGN_KEY_ADD = ("ALTER TABLE {} ADD CONSTRAINT {} FOREIGN KEY ({}) "
+                   "REFERENCES {}({});")
+
+# key constraints in the DDL of sql_queries.py
+TABLE_PATTERN = re.compile(r'CREATE TABLE IF NOT EXISTS (\w+)\(')
+PRIMARY_KEY_PATTERN = re.compile(r'^\s*(\w+)\s.*\bPRIMARY KEY\b',
+                                 re.MULTILINE)
+FOREIGN_KEY_PATTERN = re.compile(r'CONSTRAINT\s+(\w+)\s+FOREIGN KEY\s*'
+                                 r'\((\w+)\)\s*REFERENCES\s+(\w+)\s*'
+                                 r'\((\w+)\)')
+
+
+def get_settings(config):
+    """
+    Returns dictionary with section [MAINTENANCE] of the config:
+
+    - TABLES: tables to maintain
+    - STATS_OFF: analyze tables whose statistics are more than STATS_OFF
+    percent stale
+    - VACUUM_UNSORTED: vacuum (sort only) tables with more unsorted rows
+    (percent)
+    - DEEP_COPY_UNSORTED: deep copy tables with more unsorted rows
+    (percent), a deep copy is faster than a vacuum of a mostly unsorted
+    table
+    """
+    section = 'MAINTENANCE'
+    return {'tables': [table.strip() for table in
+                       config.get(section, 'TABLES', fallback='').split(',')
+                       if table.strip()],
+            'stats_off': config.getfloat(section, 'STATS_OFF', fallback=10),
+            'vacuum_unsorted': config.getfloat(section, 'VACUUM_UNSORTED',
+                                               fallback=5),
+            'deep_copy_unsorted': config.getfloat(section,
+                                                  'DEEP_COPY_UNSORTED',
+                                                  fallback=30)}
+
+
+def get_table_info(cur, backend, tables):
+    """
+    Returns list of dictionaries with rows, size, skew, unsorted and
+    stats_off of the tables. Empty tables are not listed by Redshift.
+    """
+    try:
+        cur.execute(TABLE_INFO_SELECT[backend.name], (tuple(tables),))
+    except psycopg2.Error:
+        print("Error: Reading table info")
+        raise
+
+    return [{'table': row[0], 'rows': row[1], 'size_mb': row[2],
+             'skew_rows': row[3], 'unsorted': row[4], 'stats_off': row[5]}
+            for row in cur.fetchall()]
+
+
+def get_constraint_queries(table):
+    """
+    Returns the statements adding the key constraints of the DDL a deep
+    copy of the table drops: its primary key, then its foreign keys and
+    those of other tables referencing it (dropped with the old table).
+    """
+    primary_keys, foreign_keys = [], []
+    for query in create_table_queries:
+        name = TABLE_PATTERN.search(query).group(1)
+        if name == table:
+            primary_keys += [PRIMARY_KEY_ADD.format(table, column) for column
+                             in PRIMARY_KEY_PATTERN.findall(query)]
+        foreign_keys += [FOREIGN_KEY_ADD.format(name, *constraint)
+                         for constraint in FOREIGN_KEY_PATTERN.findall(query)
+                         if table in (name, constraint[2])]
+    return primary_keys + foreign_keys
+
+
+def plan_maintenance(table_info, settings):
+    """
+    Returns list of (table, action) with action analyze, vacuum or
+    deep_copy, decided by the thresholds of the settings.
+    """
+    actions = []
+    for info in table_info:
+        unsorted = info['unsorted']
+        if unsorted is not None and unsorted > settings['deep_copy_unsorted']:
+            actions.append((info['table'], 'deep_copy'))
+        elif unsorted is not None and unsorted > settings['vacuum_unsorted']:
+            actions.append((info['table'], 'vacuum'))
+
+        # a deep copy leaves fresh statistics behind
+        if info['stats_off'] is not None \
+                and info['stats_off'] > settings['stats_off'] \
+                and (info['table'], 'deep_copy') not in actions:
+            actions.append((info['table'], 'analyze'))
+    return actions
+
+
+def run_maintenance(conn, actions):
+    """
+    Runs the maintenance actions. VACUUM cannot run inside a transaction,
+    so the connection is switched to autocommit for vacuums.
+    """
+    cur = conn.cursor()
+    for table, action in actions:
+        try:
+            if action == 'vacuum':
+                conn.autocommit = True
+                try:
+                    instrumentation.execute(cur, VACUUM_SORT_ONLY.format(table))
+                finally:
+                    conn.autocommit = False
+            elif action == 'deep_copy':
+                for query in DEEP_COPY:
+                    instrumentation.execute(cur, query.format(table))
+                for query in get_constraint_queries(table):
+                    instrumentation.execute(cur, query)
+                conn.commit()
+                instrumentation.execute(cur, ANALYZE.format(table))
+                conn.commit()
+            else:
+                instrumentation.execute(cur, ANALYZE.format(table))
+                conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            print("Error: {} of table {}".format(action, table))
+            raise
+
+
+def maintain_tables(cur, conn, backend, settings):
+    """
+    Reads the table info, runs the actions required by the thresholds and
+    returns (table info before maintenance, actions).
+    """
+    if not settings['tables']:
+        return [], []
+    table_info = get_table_info(cur, backend, settings['tables'])
+    conn.commit()
+    actions = plan_maintenance(table_info, settings)
+    run_maintenance(conn, actions)
+    return table_info, actions
+
+
+def print_table_info(table_info, actions):
+    """
+    Prints table info and maintenance actions in table format.
+    """
+    t = PrettyTable(['table', 'rows', 'size MB', 'skew rows', 'unsorted %',
+                     'stats off %', 'action'])
+    for info in table_info:
+        t.add_row([info['table'], info['rows'], info['size_mb'],
+                   info['skew_rows'], info['unsorted'], info['stats_off'],
+                   ", ".join(action for table, action in actions
+                             if table == info['table'])])
+
+    print("Table Maintenance")
+    print(t)
+    print(" ")
+
+
+def main():
+    """
+    - Reads configuration file.
+
+    - Reads rows, size, skew and unsorted percentage of the tables of
+    section [MAINTENANCE] (SVV_TABLE_INFO on Redshift).
+
+    - Analyzes tables with stale statistics, vacuums (sort only) or deep
+    copies tables above the unsorted thresholds.
+
+    - Prints the table info and the actions taken.
+    """
+
+    # read config
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    instrumentation.configure(config, backend.name)
+    settings = get_settings(config)
+
+    # set process status
+    success = False
+    conn = None
+    try:
+        # connect database
+        conn = backend.connect()
+        cur = conn.cursor()
+
+        table_info, actions = maintain_tables(cur, conn, backend, settings)
+        print_table_info(table_info, actions)
+
+        # change process status
+        success = True
+    except (psycopg2.Error, ValueError) as e:
+        print(e)
+    finally:
+        if conn is not None:
+            backend.release(conn)
+        if success:
+            print('Process suceeded')
+        else:
+            print('Process failed')
+
+    return success
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import gzip
+import heapq
+import json
+import tempfile
+
+
+def unquote(value):
+    """
+    Strips the SQL quotes used for S3 locations in dwh.cfg.
+    """
+    return value.strip().strip("'")
+
+
+def parse_s3_url(url):
+    """
+    Splits an S3 url (s3://bucket/prefix) into bucket and prefix.
+    """
+    url = unquote(url)
+    if not url.startswith('s3://'):
+        raise ValueError("Not an S3 url: {}".format(url))
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    return bucket, prefix
+
+
+def get_s3_client(config):
+    """
+    Returns a boto3 S3 client for the region of the source bucket, or for
+    ENDPOINT_URL of section [S3] if set (an S3 stand-in like moto or
+    minio for testing).
+    """
+    # boto3 is only needed for manifest loads
+    import boto3
+    
+    return boto3.client('s3',
+                        region_name=config.get('S3', 'REGION',
+                                               fallback='us-west-2'),
+                        endpoint_url=config.get('S3', 'ENDPOINT_URL',
+                                                fallback='') or None)
+
+
+def list_objects(s3, url, start_after=None):
+    """
+    Returns sorted list of (key, size in bytes) of all JSON objects below
+    the S3 url.
+
+    If `start_after` is given, listing starts after this key, so only
+    keys sorting behind the high-water mark are returned.
+    """
+    bucket, prefix = parse_s3_url(url)
+    params = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after:
+        params['StartAfter'] = start_after
+
+    objects = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**params):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.json'):
+                objects.append((obj['Key'], obj['Size']))
+
+    return sorted(objects)
+
+
+def list_keys(s3, url, start_after=None):
+    """
+    Returns sorted list of all JSON object keys below the S3 url.
+    """
+    return [key for key, _ in list_objects(s3, url, start_after)]
+
+
+def write_manifest(s3, url, bucket, keys):
+    """
+    Writes a Redshift COPY manifest listing the given keys to the S3 url.
+    """
+    entries = [{'url': 's3://{}/{}'.format(bucket, key), 'mandatory': True}
+               for key in keys]
+    manifest_bucket, manifest_key = parse_s3_url(url)
+    s3.put_object(Bucket=manifest_bucket, Key=manifest_key,
+                  Body=json.dumps({'entries': entries}).encode('utf-8'))
+
+
+def plan_batches(objects, batches):
+    """
+    Returns up to `batches` lists of keys with about the same total size:
+    the largest remaining object goes to the smallest batch. Empty batches
+    are dropped.
+    """
+    heap = [(0, i, []) for i in range(max(1, batches))]
+    for key, size in sorted(objects, key=lambda obj: (-obj[1], obj[0])):
+        total, i, keys = heapq.heappop(heap)
+        keys.append(key)
+        heapq.heappush(heap, (total + size, i, keys))
+    return [sorted(keys) for _, _, keys in sorted(heap, key=lambda b: b[1])
+            if keys]
+
+
+def compact_batch(s3, bucket, keys, url):
+    """
+    Concatenates the JSON objects of a batch, one object per line, into
+    one gzip file written to the S3 url. Objects are streamed through a
+    temporary file, so memory use does not depend on the batch size.
+    """
+    target_bucket, target_key = parse_s3_url(url)
+    with tempfile.TemporaryFile() as f:
+        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            for key in keys:
+                body = s3.get_object(Bucket=bucket, Key=key)['Body']
+                last = b'\n'
+                for chunk in body.iter_chunks():
+                    if chunk:
+                        gz.write(chunk)
+                        last = chunk[-1:]
+                if last != b'\n':
+                    gz.write(b'\n')
+        f.seek(0)
+        s3.upload_fileobj(f, target_bucket, target_key)
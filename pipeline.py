@@ -0,0 +1,471 @@
+import argparse
+import configparser
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+from functools import partial
+import psycopg2
+from prettytable import PrettyTable
+import create_tables
+import dq_rules
+import etl
+import export
+import ingest
+import instrumentation
+import maintenance
+import manifest
+import test
+from backends import get_backend
+from scheduler import run_queries, target_table
+from sql_queries import get_spec, create_table_queries, drop_table_queries, \
+    seed_table_queries, staging_events_truncate, staging_songs_truncate, \
+    staging_events_raw_truncate, staging_songs_raw_truncate, \
+    staging_events_key_insert, staging_songs_key_insert, \
+    songplay_reconcile_queries, user_history_merge, artist_table_merge, \
+    time_table_merge, song_table_merge, song_play_rollup_refresh, \
+    level_play_rollup_refresh, active_user_rollup_refresh
+
+
+# staging tables loaded by their own step, so a failed song load does not
+# repeat the event load
+STAGES = [{'step': 'stage_events', 'copy': 'copy_events',
+           'query': 'staging_events_copy', 'location': 'LOG_DATA',
+           'truncate': [staging_events_truncate, staging_events_raw_truncate],
+           'key_insert': staging_events_key_insert},
+          {'step': 'stage_songs', 'copy': 'copy_songs',
+           'query': 'staging_songs_copy', 'location': 'SONG_DATA',
+           'truncate': [staging_songs_truncate, staging_songs_raw_truncate],
+           'key_insert': staging_songs_key_insert}]
+
+# insert steps which replace what they load (delete and insert, or insert
+# where not exists) and can run again on the same staging rows; the others
+# append, e.g. songplays (the calendar time insert is added per spec)
+RERUNNABLE_INSERTS = [user_history_merge, artist_table_merge,
+                      time_table_merge, song_table_merge,
+                      song_play_rollup_refresh, level_play_rollup_refresh,
+                      active_user_rollup_refresh]
+
+STATE_TABLE_CREATE = """
+                CREATE TABLE IF NOT EXISTS pipeline_steps(
+                    step TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    fingerprint TEXT,
+                    started_at TEXT,
+                    finished_at TEXT,
+                    seconds REAL,
+                    error TEXT);
+"""
+
+
+def get_settings(config):
+    """
+    Returns dictionary with section [PIPELINE] of the config:
+
+    - STATE_FILE: SQLite file with the state of the steps
+    - SOURCE_FINGERPRINT: include the source files (key/path, size) in the
+    fingerprints of the staging steps, so new or changed files rerun them
+    (lists the S3 prefixes on Redshift)
+    """
+    section = 'PIPELINE'
+    return {'state_file': config.get(section, 'STATE_FILE',
+                                     fallback='pipeline_state.db'),
+            'source_fingerprint': config.getboolean(
+                section, 'SOURCE_FINGERPRINT', fallback=True)}
+
+
+def get_fingerprint(*inputs):
+    """
+    Returns SHA-256 hex digest of the inputs of a step (queries, settings,
+    source files).
+    """
+    data = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def list_source_files(config, backend, location):
+    """
+    Returns sorted list of (key or path, size) of the source files of
+    LOG_DATA or SONG_DATA; local files also by modification time.
+    """
+    if backend.name == 'redshift':
+        s3 = manifest.get_s3_client(config)
+        return manifest.list_objects(s3, config.get('S3', location))
+    return [(path, os.path.getsize(path), os.path.getmtime(path))
+            for path in ingest.iter_json_files(config.get('LOCAL',
+                                                          location))]
+
+
+def stage_table(cur, conn, backend, stage):
+    """
+    Empties a staging table, copies its source files into the raw staging
+    table and moves the rows into the staging table computing the song
+    match key. The step can be repeated.
+    """
+    try:
+        run_queries(cur, conn, stage['truncate'])
+        getattr(backend, stage['copy'])(cur, conn)
+        run_queries(cur, conn, [backend.translate(stage['key_insert']),
+                                stage['truncate'][1]])
+    except psycopg2.Error:
+        print("Error: Copying into staging tables")
+        raise
+
+
+def reset_tables(cur, conn, backend):
+    """
+    Drops and creates all tables, like create_tables.py.
+    """
+    create_tables.drop_tables(cur, conn,
+                              backend.translate_all(drop_table_queries))
+    create_tables.create_tables(cur, conn,
+                                backend.translate_all(create_table_queries)
+                                + seed_table_queries)
+
+
+def run_tests(cur, conn, backend, config):
+    """
+    Runs the tests and data quality rules of test.py; fails if a rule
+    failed.
+    """
+    workers = config.getint('TEST', 'WORKERS', fallback=1)
+    approximate = (config.getboolean('TEST', 'APPROXIMATE', fallback=False)
+                   and backend.name == 'redshift')
+    test_definition = test.get_test_definition(get_spec(config).time_grain)
+    test.print_test_results(test.run_test(cur, conn, test_definition,
+                                          backend, workers, approximate))
+
+    rules_file = config.get('TEST', 'RULES', fallback='')
+    if rules_file:
+        rule_results = dq_rules.run_rules(cur, conn,
+                                          dq_rules.read_rules(rules_file),
+                                          backend)
+        dq_rules.print_rule_results(rule_results)
+        if dq_rules.get_exit_code(rule_results):
+            raise ValueError("Data quality rules failed")
+
+
+def get_steps(config, backend, settings):
+    """
+    Returns list of the steps of create_tables.py, etl.py (MODE=full) and
+    test.py in execution order. Each step is a dictionary with
+
+    - step: name
+    - run: function of (cur, conn)
+    - fingerprint: digest of its inputs, a changed fingerprint reruns it
+    - rerunnable: False if a completed step must not run again on its
+    tables (appending inserts, e.g. songplays), only after the tables
+    were reset
+    - resets: True if the step recreates the tables (create_tables)
+    """
+    if config.get('ETL', 'MODE', fallback='full') != 'full':
+        raise ValueError("pipeline.py runs MODE=full, incremental loads "
+                         "resume by their high-water mark")
+    queries = backend.queries()
+    reset_queries = (backend.translate_all(drop_table_queries)
+                     + backend.translate_all(create_table_queries)
+                     + seed_table_queries)
+
+    steps = [{'step': 'create_tables',
+              'run': partial(reset_tables, backend=backend),
+              'fingerprint': get_fingerprint(reset_queries),
+              'rerunnable': True, 'resets': True}]
+
+    for stage in STAGES:
+        sources = []
+        if settings['source_fingerprint']:
+            sources = list_source_files(config, backend, stage['location'])
+        copy = queries[stage['query']]
+        if backend.name != 'redshift':
+            copy = [config.get('LOCAL', stage['location']),
+                    config.get('LOCAL', 'LOG_JSONPATH')]
+        steps.append({'step': stage['step'],
+                      'run': partial(stage_table, backend=backend,
+                                     stage=stage),
+                      'fingerprint': get_fingerprint(
+                          stage['truncate'], copy,
+                          backend.translate(stage['key_insert']), sources),
+                      'rerunnable': True, 'resets': False})
+
+    if config.get('ETL', 'DIMENSION_LOAD', fallback='insert') == 'merge':
+        inserts = queries['merge_insert_table_queries']
+    else:
+        inserts = queries['insert_table_queries']
+    rerunnable = set(backend.translate_all(RERUNNABLE_INSERTS))
+    if queries['time_table_calendar_insert'] is not None:
+        rerunnable.add(queries['time_table_calendar_insert'])
+    for query in inserts:
+        steps.append({'step': 'insert_' + target_table(query),
+                      'run': partial(etl.insert_tables, queries=[query]),
+                      'fingerprint': get_fingerprint(query),
+                      'rerunnable': query in rerunnable, 'resets': False})
+
+    reconcile_queries = backend.translate_all(songplay_reconcile_queries)
+    steps.append({'step': 'reconcile_songplays',
+                  'run': lambda cur, conn: print(
+                      "Pending songplays resolved: {}".format(
+                          etl.reconcile_songplays(cur, conn, backend))),
+                  'fingerprint': get_fingerprint(reconcile_queries),
+                  'rerunnable': True, 'resets': False})
+
+    if config.getboolean('EXPORT', 'AFTER_ETL', fallback=False):
+        export_settings = export.get_settings(config)
+        steps.append({'step': 'export_songplays',
+                      'run': lambda cur, conn: export.print_export(
+                          export.export_songplays(
+                              cur, conn, backend, export_settings,
+                              int(datetime.utcnow().strftime(
+                                  '%Y%m%d%H%M%S')))),
+                      'fingerprint': get_fingerprint(export_settings),
+                      'rerunnable': True, 'resets': False})
+
+    if config.getboolean('MAINTENANCE', 'AFTER_ETL', fallback=False):
+        maintenance_settings = maintenance.get_settings(config)
+        steps.append({'step': 'maintain_tables',
+                      'run': lambda cur, conn: maintenance.print_table_info(
+                          *maintenance.maintain_tables(
+                              cur, conn, backend, maintenance_settings)),
+                      'fingerprint': get_fingerprint(maintenance_settings),
+                      'rerunnable': True, 'resets': False})
+
+    test_inputs = [dict(config['TEST'])] if config.has_section('TEST') \
+        else []
+    rules_file = config.get('TEST', 'RULES', fallback='')
+    if rules_file and os.path.exists(rules_file):
+        with open(rules_file) as f:
+            test_inputs.append(f.read())
+    steps.append({'step': 'test',
+                  'run': partial(run_tests, backend=backend, config=config),
+                  'fingerprint': get_fingerprint(
+                      test.compile_test_queries(test.get_test_definition(
+                          get_spec(config).time_grain))[0], test_inputs),
+                  'rerunnable': True, 'resets': False})
+
+    return steps
+
+
+def open_state(path):
+    """
+    Returns connection to the SQLite state store, creating its table.
+    """
+    state_conn = sqlite3.connect(path)
+    state_conn.execute(STATE_TABLE_CREATE)
+    state_conn.commit()
+    return state_conn
+
+
+def read_state(state_conn):
+    """
+    Returns dictionary of the stored steps: name -> dictionary with
+    status, fingerprint, started_at, finished_at, seconds and error.
+    """
+    cursor = state_conn.execute(
+        "SELECT step, status, fingerprint, started_at, finished_at, "
+        "seconds, error FROM pipeline_steps")
+    columns = [column[0] for column in cursor.description]
+    return {row[0]: dict(zip(columns, row)) for row in cursor.fetchall()}
+
+
+def write_state(state_conn, step, status, fingerprint=None, started_at=None,
+                finished_at=None, seconds=None, error=None):
+    """
+    Stores the state of a step.
+    """
+    state_conn.execute(
+        "INSERT OR REPLACE INTO pipeline_steps(step, status, fingerprint, "
+        "started_at, finished_at, seconds, error) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (step, status, fingerprint, started_at, finished_at, seconds, error))
+    state_conn.commit()
+
+
+def is_done(step, state):
+    """
+    Returns True if the step completed with the current fingerprint.
+    """
+    stored = state.get(step['step'])
+    return stored is not None and stored['status'] == 'completed' \
+        and stored['fingerprint'] == step['fingerprint']
+
+
+def get_resume_index(steps, state, start=None):
+    """
+    Returns index of the step to resume from: `start` if given, otherwise
+    the first step which did not complete or whose fingerprint changed.
+
+    If a later completed step cannot run twice (appending inserts), the
+    pipeline resumes from the last step before it that resets the tables.
+    """
+    names = [step['step'] for step in steps]
+    if start is not None:
+        if start not in names:
+            raise ValueError("Unknown step: {}".format(start))
+        index = names.index(start)
+    else:
+        index = next((i for i, step in enumerate(steps)
+                      if not is_done(step, state)), len(steps))
+
+    for i in range(index, len(steps)):
+        stored = state.get(names[i])
+        if steps[i]['rerunnable'] or stored is None \
+                or stored['status'] != 'completed':
+            continue
+        resets = [j for j in range(i + 1) if steps[j]['resets']]
+        if resets:
+            index = min(index, resets[-1])
+    return index
+
+
+def run_pipeline(cur, conn, steps, state_conn, start=None):
+    """
+    Runs the steps from the resume index on, recording each step in the
+    state store. Steps before it are skipped; the steps from it on are
+    marked pending first, so a failure does not leave them completed from
+    an earlier run.
+
+    If any step ran, the load is recorded in etl_loads (see
+    `etl.record_table_load`).
+
+    Returns list of dictionaries with step, action (skipped, completed or
+    failed) and seconds.
+    """
+    state = read_state(state_conn)
+    index = get_resume_index(steps, state, start)
+    for step in steps[index:]:
+        write_state(state_conn, step['step'], 'pending')
+
+    results = [{'step': step['step'], 'action': 'skipped',
+                'seconds': state.get(step['step'], {}).get('seconds')}
+               for step in steps[:index]]
+    for step in steps[index:]:
+        print("Running step {}".format(step['step']))
+        started_at, start_time = datetime.utcnow(), time.perf_counter()
+        write_state(state_conn, step['step'], 'running', step['fingerprint'],
+                    started_at.isoformat())
+        try:
+            step['run'](cur, conn)
+        except (psycopg2.Error, ValueError) as e:
+            conn.rollback()
+            seconds = time.perf_counter() - start_time
+            write_state(state_conn, step['step'], 'failed',
+                        step['fingerprint'], started_at.isoformat(),
+                        datetime.utcnow().isoformat(), seconds,
+                        str(e).strip())
+            results.append({'step': step['step'], 'action': 'failed',
+                            'seconds': seconds})
+            print_results(results)
+            etl.record_table_load(conn, False)
+            raise
+        seconds = time.perf_counter() - start_time
+        write_state(state_conn, step['step'], 'completed',
+                    step['fingerprint'], started_at.isoformat(),
+                    datetime.utcnow().isoformat(), seconds)
+        results.append({'step': step['step'], 'action': 'completed',
+                        'seconds': seconds})
+
+    if index < len(steps):
+        etl.record_table_load(conn, True)
+    print_results(results)
+    return results
+
+
+def print_results(results):
+    """
+    Prints action and seconds per step in table format.
+    """
+    t = PrettyTable(['step', 'action', 'seconds'])
+    t.align['step'] = 'l'
+    for row in results:
+        t.add_row([row['step'], row['action'],
+                   '' if row['seconds'] is None
+                   else round(row['seconds'], 1)])
+    print("Pipeline Steps")
+    print(t)
+    print(" ")
+
+
+def print_state(steps, state):
+    """
+    Prints stored status, finish time and error of the steps, and whether
+    their fingerprint changed since.
+    """
+    t = PrettyTable(['step', 'status', 'finished_at', 'inputs', 'error'])
+    t.align['step'] = 'l'
+    for step in steps:
+        stored = state.get(step['step'], {})
+        changed = stored.get('fingerprint') not in (None,
+                                                    step['fingerprint'])
+        t.add_row([step['step'], stored.get('status', 'new'),
+                   stored.get('finished_at') or '',
+                   'changed' if changed else '',
+                   (stored.get('error') or '')[:60]])
+    print("Pipeline State")
+    print(t)
+    print(" ")
+
+
+def main():
+    """
+    - Parses command line arguments and reads configuration file.
+
+    - Builds the steps of create_tables.py, etl.py and test.py with the
+    fingerprints of their inputs.
+
+    - Resumes from the first step which did not complete or whose inputs
+    changed (--from: from the given step, --status: only prints the
+    state), recording each step in the SQLite state store of section
+    [PIPELINE].
+    """
+    parser = argparse.ArgumentParser(
+        description='Run create_tables, etl and test as resumable steps.')
+    parser.add_argument('--from', dest='start',
+                        help='step to resume from, e.g. insert_songplays')
+    parser.add_argument('--status', action='store_true',
+                        help='print the state of the steps and exit')
+    args = parser.parse_args()
+
+    # read config
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    instrumentation.configure(config, backend.name)
+    settings = get_settings(config)
+
+    # set process status
+    success = False
+    conn = None
+    state_conn = None
+    try:
+        steps = get_steps(config, backend, settings)
+        state_conn = open_state(settings['state_file'])
+
+        if args.status:
+            print_state(steps, read_state(state_conn))
+        else:
+            # connect database
+            conn = backend.connect()
+            cur = conn.cursor()
+
+            run_pipeline(cur, conn, steps, state_conn, args.start)
+
+        # change process status
+        success = True
+    except (psycopg2.Error, ValueError) as e:
+        print(e)
+    finally:
+        if state_conn is not None:
+            state_conn.close()
+        if conn is not None:
+            backend.release(conn)
+        if success:
+            print('Process suceeded')
+        else:
+            print('Process failed')
+
+    return success
+
+
+if __name__ == "__main__":
+    main()
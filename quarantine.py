@@ -0,0 +1,90 @@
+from datetime import datetime
+import psycopg2
+from psycopg2.extras import execute_values
+from sql_queries import load_errors_select, copy_load_errors_select, \
+    load_errors_insert, last_copy_id_select
+
+
+def get_last_copy_id(cur):
+    """
+    Returns the query id of the last COPY run in the cursor's session,
+    also of a failed one once its transaction is rolled back.
+    """
+    cur.execute(last_copy_id_select)
+    return cur.fetchone()[0]
+
+
+def read_load_errors(cur, table, started_at=None, query_ids=None):
+    """
+    Returns list of dictionaries with the rows rejected by the COPYs into
+    a table since `started_at` (UTC), read from STL_LOAD_ERRORS: filename,
+    line_number, column, reason and raw_line.
+
+    With `query_ids` only the rows rejected by these COPYs are read,
+    whatever the clock of the client (see `get_last_copy_id`).
+    """
+    try:
+        if query_ids is None:
+            cur.execute(load_errors_select, (started_at, table))
+        else:
+            cur.execute(copy_load_errors_select, (tuple(query_ids),))
+    except psycopg2.Error:
+        print("Error: Reading load errors of {}".format(table))
+        raise
+
+    return [{'filename': row[0], 'line_number': row[1], 'column': row[2],
+             'reason': row[3], 'raw_line': row[4]}
+            for row in cur.fetchall()]
+
+
+def store_load_errors(cur, conn, table, errors, batch_id=None):
+    """
+    Writes rejected rows to the quarantine table `etl_load_errors`.
+
+    Returns number of rows quarantined.
+    """
+    if not errors:
+        return 0
+
+    loaded_at = datetime.utcnow()
+    rows = [(batch_id, loaded_at, table, error['filename'],
+             error['line_number'], error['column'], error['reason'],
+             error['raw_line']) for error in errors]
+    try:
+        execute_values(cur, load_errors_insert, rows)
+        conn.commit()
+    except psycopg2.Error:
+        print("Error: Quarantining load errors of {}".format(table))
+        raise
+    return len(rows)
+
+
+def quarantine_copy(cur, conn, table, started_at=None, batch_id=None,
+                    query_ids=None):
+    """
+    Moves the rows rejected by the COPYs into a table since `started_at`
+    (or by the COPYs of `query_ids`) to the quarantine table. Lines
+    rejected by a failed COPY and again by its retry are quarantined once.
+
+    Returns number of rows quarantined.
+    """
+    return store_load_errors(cur, conn, table,
+                             read_load_errors(cur, table, started_at,
+                                              query_ids),
+                             batch_id)
+
+
+def split_affected_keys(errors, bucket, keys):
+    """
+    Returns (keys without errors, keys with errors) of the S3 objects of a
+    bucket, by the filenames of the load errors (logged up to 256
+    characters).
+    """
+    affected = {error['filename'] for error in errors}
+    clean, failed = [], []
+    for key in keys:
+        if 's3://{}/{}'.format(bucket, key)[:256] in affected:
+            failed.append(key)
+        else:
+            clean.append(key)
+    return clean, failed
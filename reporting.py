@@ -0,0 +1,333 @@
+import argparse
+import configparser
+import csv
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+import psycopg2
+from prettytable import PrettyTable
+import instrumentation
+from backends import get_backend
+from sql_queries import load_version_select
+
+
+def get_settings(config):
+    """
+    Returns dictionary with section [REPORTING] of the config:
+
+    - CACHE_ENTRIES: results kept in the cache, least recently used are
+    evicted first (0: no caching)
+    - CACHE_TTL: seconds a cached result is served at most
+    - CACHE_MAX_ROWS: larger results are not cached (stream them instead)
+    - CACHE_FILE: file the cache is kept in between runs (empty: memory
+    only)
+    - BATCH_SIZE: rows fetched and written at a time when streaming
+    """
+    section = 'REPORTING'
+    return {'cache_entries': config.getint(section, 'CACHE_ENTRIES',
+                                           fallback=128),
+            'cache_ttl': config.getfloat(section, 'CACHE_TTL',
+                                         fallback=300),
+            'cache_max_rows': config.getint(section, 'CACHE_MAX_ROWS',
+                                            fallback=10000),
+            'cache_file': config.get(section, 'CACHE_FILE', fallback=''),
+            'batch_size': config.getint(section, 'BATCH_SIZE',
+                                        fallback=10000)}
+
+
+class ResultCache:
+    """
+    Query results keyed by query text, parameters and a table version
+    token, with TTL and LRU eviction. A result is only served while the
+    token is unchanged, i.e. no load has written to the tables since.
+    Thread-safe; optionally persisted to a file between runs.
+    """
+
+    def __init__(self, max_entries=128, ttl=300, max_rows=10000, path=''):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Returns cache configured by `get_settings`, loaded from its file.
+        """
+        cache = cls(settings['cache_entries'], settings['cache_ttl'],
+                    settings['cache_max_rows'], settings['cache_file'])
+        cache.load()
+        return cache
+
+    @staticmethod
+    def key(query, parameters=None, version=None):
+        return (query, tuple(parameters or ()), version)
+
+    def get(self, key):
+        """
+        Returns the cached (column names, rows), or None if missing or
+        expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, key, columns, rows):
+        """
+        Stores a result unless it is too large or caching is off.
+        """
+        if self.max_entries <= 0 or len(rows) > self.max_rows:
+            return
+        with self._lock:
+            self._entries[key] = (time.time(), columns, rows)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def load(self):
+        """
+        Reads the unexpired entries of the cache file, if any.
+        """
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            entries = pickle.load(f)
+        now = time.time()
+        with self._lock:
+            for key, entry in entries:
+                if now - entry[0] <= self.ttl:
+                    self._entries[key] = entry
+
+    def save(self):
+        """
+        Writes the entries to the cache file, if configured.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            entries = list(self._entries.items())
+        with open(self.path, 'wb') as f:
+            pickle.dump(entries, f)
+
+
+def get_version(cur):
+    """
+    Returns the table version token: number and time of the loads
+    recorded in etl_loads by create_tables.py, etl.py, backfill.py and
+    pipeline.py. It changes with every run which wrote to the tables.
+    """
+    try:
+        cur.execute(load_version_select)
+        return tuple(cur.fetchone())
+    except psycopg2.Error:
+        print("Error: Reading table version")
+        raise
+
+
+def fetch_cached(cur, cache, query, parameters=None, version=None):
+    """
+    Returns (column names, rows) of a query, from the cache if the same
+    query ran against the same table version before.
+    """
+    key = cache.key(query, parameters, version)
+    result = cache.get(key)
+    if result is None:
+        try:
+            instrumentation.execute(cur, query, parameters)
+            result = ([column[0] for column in cur.description],
+                      cur.fetchall())
+        except psycopg2.Error:
+            print("Error: Running query {}".format(query))
+            raise
+        cache.put(key, *result)
+    return result
+
+
+def stream_query(conn, query, parameters=None, batch_size=10000,
+                 name='report'):
+    """
+    Runs a query on a server-side (named) cursor and yields
+    (column names, rows) batch by batch, so results larger than memory
+    can be processed.
+    """
+    cur = conn.cursor(name=name)
+    try:
+        cur.execute(query, parameters)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [column[0] for column in cur.description], rows
+    finally:
+        cur.close()
+
+
+def write_csv(batches, path):
+    """
+    Writes the batches of `stream_query` to a CSV file with header.
+
+    Returns number of rows written.
+    """
+    count = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for columns, rows in batches:
+            if count == 0:
+                writer.writerow(columns)
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+
+def write_parquet(batches, path):
+    """
+    Writes the batches of `stream_query` to a Parquet file, one row group
+    per batch; the column types are taken from the first batch.
+
+    Returns number of rows written.
+    """
+    # pyarrow is only needed for Parquet reports
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    count = 0
+    writer = None
+    try:
+        for columns, rows in batches:
+            arrays = list(zip(*rows))
+            if writer is None:
+                table = pa.table([pa.array(array) for array in arrays],
+                                 names=columns)
+                writer = pq.ParquetWriter(path, table.schema)
+            else:
+                table = pa.table([pa.array(array, type=field.type)
+                                  for array, field in zip(arrays,
+                                                          writer.schema)],
+                                 schema=writer.schema)
+            writer.write_table(table)
+            count += len(rows)
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+# output writers by format
+WRITERS = {'csv': write_csv, 'parquet': write_parquet}
+
+
+def write_report(conn, query, path, output_format='csv', parameters=None,
+                 batch_size=10000):
+    """
+    Streams the result of a query to a CSV or Parquet file.
+
+    Returns number of rows written.
+    """
+    if output_format not in WRITERS:
+        raise ValueError("Unknown output format: {}".format(output_format))
+    try:
+        count = WRITERS[output_format](
+            stream_query(conn, query, parameters, batch_size), path)
+        conn.commit()
+    except psycopg2.Error:
+        print("Error: Writing report {}".format(path))
+        raise
+    return count
+
+
+def print_rows(columns, rows):
+    """
+    Prints rows in table format.
+    """
+    t = PrettyTable(columns)
+    for row in rows:
+        t.add_row(row)
+    print(t)
+
+
+def main():
+    """
+    - Parses command line arguments and reads configuration file.
+
+    - Runs a report query (--query or --file): with --output its result is
+    streamed from a server-side cursor to a CSV or Parquet file, otherwise
+    it is printed and cached per table version (section [REPORTING]).
+    """
+    parser = argparse.ArgumentParser(
+        description='Run a report query against the sparkify database.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--query', help='SQL query')
+    source.add_argument('--file', help='file with the SQL query')
+    parser.add_argument('--output', help='CSV or Parquet file to write')
+    parser.add_argument('--format', choices=sorted(WRITERS),
+                        help='output format (default: by file extension)')
+    args = parser.parse_args()
+
+    # read config
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    instrumentation.configure(config, backend.name)
+    settings = get_settings(config)
+
+    query = args.query
+    if args.file:
+        with open(args.file) as f:
+            query = f.read()
+    query = backend.translate(query.strip().rstrip(';'))
+
+    # set process status
+    success = False
+    conn = None
+    try:
+        # connect database
+        conn = backend.connect()
+        cur = conn.cursor()
+
+        if args.output:
+            output_format = args.format or (
+                'parquet' if args.output.endswith('.parquet') else 'csv')
+            count = write_report(conn, query, args.output, output_format,
+                                 batch_size=settings['batch_size'])
+            print("Rows written to {}: {}".format(args.output, count))
+        else:
+            cache = ResultCache.from_settings(settings)
+            columns, rows = fetch_cached(cur, cache, query,
+                                         version=get_version(cur))
+            conn.rollback()
+            cache.save()
+            print_rows(columns, rows)
+            if cache.hits:
+                print("Served from cache (tables unchanged)")
+
+        # change process status
+        success = True
+    except (psycopg2.Error, ValueError) as e:
+        print(e)
+    finally:
+        if conn is not None:
+            backend.release(conn)
+        if success:
+            print('Process suceeded')
+        else:
+            print('Process failed')
+
+    return success
+
+
+if __name__ == "__main__":
+    main()
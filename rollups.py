@@ -0,0 +1,136 @@
+import psycopg2
+import instrumentation
+
+
+# time grains from finest to coarsest
+GRAINS = ['hour', 'day', 'week', 'month', 'year']
+
+# rollup tables refreshed by etl.py, smallest first; additive measures can
+# be summed up to coarser grains and fewer dimensions, the others only be
+# read as stored
+ROLLUPS = [
+    {'table': 'active_users_daily',
+     'time_column': 'day',
+     'grain': 'day',
+     'dimensions': [],
+     'measures': {'active_users': 'SUM(active_users)'},
+     'additive': False},
+    {'table': 'level_plays_hourly',
+     'time_column': 'hour',
+     'grain': 'hour',
+     'dimensions': ['level'],
+     'measures': {'plays': 'SUM(plays)'},
+     'additive': True},
+    {'table': 'song_plays_daily',
+     'time_column': 'day',
+     'grain': 'day',
+     'dimensions': ['song_id', 'artist_id'],
+     'measures': {'plays': 'SUM(plays)'},
+     'additive': True},
+]
+
+# the same measures computed from the fact table
+SONGPLAY_MEASURES = {'plays': 'COUNT(1)',
+                     'active_users': 'COUNT(DISTINCT user_id)'}
+
+
+def is_aligned(value, grain):
+    """
+    Returns True if a datetime bound lies on a boundary of the grain, so a
+    rollup of that grain covers exactly the requested range.
+    """
+    if value is None:
+        return True
+    if grain == 'hour':
+        return value.minute == 0 and value.second == 0 \
+            and value.microsecond == 0
+    return (value.hour, value.minute, value.second, value.microsecond) \
+        == (0, 0, 0, 0)
+
+
+def find_rollup(measure, dimensions=(), grain=None, start=None, end=None):
+    """
+    Returns the smallest rollup which can answer the query, or None.
+
+    A rollup is eligible if it stores the measure and all requested
+    dimensions, its grain is at least as fine as the requested grain and
+    the time bounds are aligned to its grain. Non-additive measures are
+    only read at the stored grain and dimensions.
+    """
+    for rollup in ROLLUPS:
+        if measure not in rollup['measures'] \
+                or not set(dimensions) <= set(rollup['dimensions']):
+            continue
+        if not (is_aligned(start, rollup['grain'])
+                and is_aligned(end, rollup['grain'])):
+            continue
+        if rollup['additive']:
+            if grain is None \
+                    or GRAINS.index(grain) >= GRAINS.index(rollup['grain']):
+                return rollup
+        elif grain == rollup['grain'] \
+                and set(dimensions) == set(rollup['dimensions']):
+            return rollup
+    return None
+
+
+def build_query(measure, dimensions=(), grain=None, start=None, end=None):
+    """
+    Returns (query, parameters, source table) of an aggregate of songplays:
+    `measure` (plays or active_users) grouped by `dimensions` and optionally
+    by the time `grain`, for start_time in [start, end).
+
+    The query reads the smallest eligible rollup and falls back to
+    songplays.
+    """
+    if measure not in SONGPLAY_MEASURES:
+        raise ValueError("Unknown measure: {}".format(measure))
+    if grain is not None and grain not in GRAINS:
+        raise ValueError("Unknown grain: {}".format(grain))
+
+    rollup = find_rollup(measure, dimensions, grain, start, end)
+    if rollup is None:
+        table, time_column = 'songplays', 'start_time'
+        expression = SONGPLAY_MEASURES[measure]
+    else:
+        table, time_column = rollup['table'], rollup['time_column']
+        expression = rollup['measures'][measure]
+
+    columns = list(dimensions)
+    if grain is not None:
+        columns.insert(0, "DATE_TRUNC('{}', {}) AS {}".format(
+            grain, time_column, grain))
+
+    conditions = []
+    parameters = []
+    if start is not None:
+        conditions.append("{} >= %s".format(time_column))
+        parameters.append(start)
+    if end is not None:
+        conditions.append("{} < %s".format(time_column))
+        parameters.append(end)
+
+    query = "SELECT {} FROM {}".format(
+        ", ".join(columns + ["{} AS {}".format(expression, measure)]), table)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if columns:
+        positions = ", ".join(str(i + 1) for i in range(len(columns)))
+        query += " GROUP BY {} ORDER BY {}".format(positions, positions)
+
+    return query + ";", parameters, table
+
+
+def run_query(cur, measure, dimensions=(), grain=None, start=None,
+              end=None):
+    """
+    Runs an aggregate built by `build_query` and returns its rows.
+    """
+    query, parameters, _ = build_query(measure, dimensions, grain, start,
+                                       end)
+    try:
+        instrumentation.execute(cur, query, parameters)
+        return cur.fetchall()
+    except psycopg2.Error:
+        print("Error: Running query {}".format(query))
+        raise
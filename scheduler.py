@@ -0,0 +1,126 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import db
+import instrumentation
+
+
+TARGET_PATTERN = re.compile(r'\b(?:insert\s+into|copy)\s+(\w+)', re.IGNORECASE)
+
+
+def target_table(query):
+    """
+    Returns the name of the table a COPY or INSERT statement loads into.
+    """
+    match = TARGET_PATTERN.search(query)
+    if match is None:
+        raise ValueError("No target table found in query: {}".format(query))
+    return match.group(1).lower()
+
+
+def build_graph(queries, dependencies):
+    """
+    Returns dictionary of steps keyed by target table with the query and
+    the target tables it depends on.
+
+    Dependencies on tables which are not loaded by `queries` are ignored.
+    """
+    graph = {}
+    for query in queries:
+        name = target_table(query)
+        if name in graph:
+            raise ValueError("Table {} is loaded twice".format(name))
+        graph[name] = {'query': query, 'depends_on': set()}
+
+    for name, step in graph.items():
+        step['depends_on'] = {dep for dep in dependencies.get(name, [])
+                              if dep in graph}
+
+    # reject cycles before anything is executed
+    done = set()
+    while len(done) < len(graph):
+        ready = [name for name, step in graph.items()
+                 if name not in done and step['depends_on'] <= done]
+        if not ready:
+            raise ValueError("Cyclic dependencies between: {}".format(
+                ", ".join(sorted(set(graph) - done))))
+        done.update(ready)
+
+    return graph
+
+
+def run_statement(query, connect, release):
+    """
+    Executes and commits a query on a connection from `connect`. If the
+    connection is lost, the query is retried on a new connection with
+    backoff; it was rolled back, so it can run again.
+    """
+    attempt = 0
+    while True:
+        conn = connect()
+        try:
+            cur = conn.cursor()
+            instrumentation.execute(cur, query)
+            conn.commit()
+            return
+        except db.TRANSIENT_ERRORS:
+            if not conn.closed or attempt >= db.get_retries():
+                raise
+        finally:
+            release(conn)
+        time.sleep(db.get_backoff(attempt))
+        attempt += 1
+
+
+def run_dag(queries, dependencies, connect, workers, release=None):
+    """
+    Runs queries on up to `workers` connections at a time, each query as
+    soon as all tables it depends on are loaded. Each query commits on its
+    own connection from `connect`, which is handed back to `release`
+    (default: closed).
+
+    The first failing query stops scheduling, queries already running are
+    awaited and the error is re-raised.
+    """
+    graph = build_graph(queries, dependencies)
+    if release is None:
+        def release(conn):
+            conn.close()
+
+    done = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while len(done) < len(graph):
+            scheduled = set(running.values())
+            for name, step in graph.items():
+                if (name not in done and name not in scheduled
+                        and step['depends_on'] <= done):
+                    future = executor.submit(run_statement, step['query'],
+                                             connect, release)
+                    running[future] = name
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                future.result()
+                done.add(name)
+
+
+def run_queries(cur, conn, queries, dependencies=None, connect=None,
+                workers=1, release=None):
+    """
+    Runs queries either one after another on the given cursor (workers=1)
+    or dependency-aware in parallel using `run_dag`.
+
+    One after another, the queries commit per statement or once at the end
+    ([CONNECTION] COMMIT=stage). In parallel each query commits on its own,
+    since dependent queries run on other connections.
+    """
+    if workers > 1 and connect is not None:
+        run_dag(queries, dependencies or {}, connect, workers, release)
+        return
+
+    for query in queries:
+        instrumentation.execute(cur, query)
+        db.commit_statement(conn)
+    conn.commit()
@@ -1,23 +1,135 @@
+from collections import namedtuple
 import configparser
+from functools import lru_cache
+import re
 
 
-# CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
+# QUERY SPEC
+# Statements which depend on the configuration (S3 sources, IAM role,
+# region, time grain, schema and dialect) are templates compiled lazily
+# by `compile_queries`, once per spec; all other statements are constants.
+
+QuerySpec = namedtuple('QuerySpec', ['log_data', 'song_data', 'log_jsonpath',
+                                     'iam_role', 'region', 'time_grain',
+                                     'schema', 'partition', 'max_errors',
+                                     'dialect'],
+                       defaults=["''", "''", "'auto'", "''", 'us-west-2',
+                                 'timestamp', '', '', 0, 'redshift'])
+QuerySpec.__doc__ = """
+Parameters of the compiled statements:
+
+- log_data, song_data, log_jsonpath: quoted S3 locations of the sources
+- iam_role: quoted ARN of the role used by COPY
+- region: region of the source bucket
+- time_grain: grain of the time dimension, timestamp (one row per
+distinct event timestamp) or second/hour (calendar generated for the
+days loaded)
+- schema: schema put in front of the search path (empty: default path)
+- partition: key prefix below log_data copied by `staging_events_copy`,
+e.g. "2018/11/2018-11-01" (empty: all files)
+- max_errors: MAXERROR of the COPY statements, rejected rows up to this
+number are skipped instead of failing the COPY
+- dialect: redshift or postgres
+"""
+
+TIME_GRAIN_UNITS = {'hour': 24, 'second': 86400}
+
+# Redshift-only DDL and functions which a local PostgreSQL database does not
+# understand.
+# Redshift does not enforce key constraints either, so they are dropped
+# to keep the local tables behaving the same way.
+DIALECT_REWRITES = {
+    'redshift': [],
+    'postgres': [
+        (re.compile(r'IDENTITY\(0,\s*1\)', re.IGNORECASE),
+         'GENERATED BY DEFAULT AS IDENTITY (MINVALUE 0 START WITH 0)'),
+        (re.compile(r',\s*CONSTRAINT\s+\w+\s+FOREIGN KEY\s*\(\w+\)\s*'
+                    r'REFERENCES\s+\w+\s*\(\w+\)', re.IGNORECASE), ''),
+        (re.compile(r'\bPRIMARY KEY\b', re.IGNORECASE), ''),
+        (re.compile(r'\bdiststyle\s+(all|even|key|auto)\b', re.IGNORECASE), ''),
+        (re.compile(r'\b(distkey|sortkey)\b', re.IGNORECASE), ''),
+        (re.compile(r'DATEADD\((\w+),\s*([\w.]+),\s*([\w.]+)\)',
+                    re.IGNORECASE),
+         r"(\3 + \2 * INTERVAL '1 \1')"),
+    ]}
+
+
+def get_spec(config, **overrides):
+    """
+    Returns the QuerySpec of a configuration, sections [S3], [IAM_ROLE],
+    [ETL] TIME_GRAIN, MAX_ERRORS and [BACKEND] SCHEMA; keyword arguments override
+    single parameters (e.g. partition or dialect).
+    """
+    spec = QuerySpec(
+        log_data=config.get('S3', 'LOG_DATA', fallback="''"),
+        song_data=config.get('S3', 'SONG_DATA', fallback="''"),
+        log_jsonpath=config.get('S3', 'LOG_JSONPATH', fallback="'auto'"),
+        iam_role=config.get('IAM_ROLE', 'ARN', fallback="''"),
+        region=config.get('S3', 'REGION', fallback='us-west-2'),
+        time_grain=config.get('ETL', 'TIME_GRAIN', fallback='timestamp'),
+        schema=config.get('BACKEND', 'SCHEMA', fallback=''),
+        max_errors=config.getint('ETL', 'MAX_ERRORS', fallback=0),
+        dialect=config.get('BACKEND', 'ENGINE', fallback='redshift'))
+    spec = spec._replace(**overrides)
+
+    if spec.time_grain != 'timestamp' \
+            and spec.time_grain not in TIME_GRAIN_UNITS:
+        raise ValueError("Unknown time grain: {}".format(spec.time_grain))
+    if spec.dialect not in DIALECT_REWRITES:
+        raise ValueError("Unknown dialect: {}".format(spec.dialect))
+    return spec
+
+
+@lru_cache(maxsize=None)
+def default_spec(path='dwh.cfg'):
+    """
+    Returns the QuerySpec of the configuration file, read on first use.
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+    return get_spec(config)
+
+
+@lru_cache(maxsize=1024)
+def translate(query, dialect):
+    """
+    Returns the query rewritten for the dialect.
+    """
+    for pattern, replacement in DIALECT_REWRITES[dialect]:
+        query = pattern.sub(replacement, query)
+    return query
+
 
 # DROP TABLES
 
+staging_events_raw_table_drop = "DROP TABLE IF EXISTS stg_events_raw;"
+staging_songs_raw_table_drop = "DROP TABLE IF EXISTS stg_songs_raw;"
 staging_events_table_drop = "DROP TABLE IF EXISTS stg_events;"
 staging_songs_table_drop = "DROP TABLE IF EXISTS stg_songs;"
 songplay_table_drop = "DROP TABLE IF EXISTS songplays;"
+songplay_pending_table_drop = "DROP TABLE IF EXISTS songplays_pending;"
 user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+load_file_table_drop = "DROP TABLE IF EXISTS etl_load_files;"
+backfill_partition_table_drop = "DROP TABLE IF EXISTS etl_backfill_partitions;"
+dq_result_table_drop = "DROP TABLE IF EXISTS etl_dq_results;"
+load_error_table_drop = "DROP TABLE IF EXISTS etl_load_errors;"
+export_table_drop = "DROP TABLE IF EXISTS etl_exports;"
+songplay_correction_table_drop = "DROP TABLE IF EXISTS songplay_corrections;"
+load_table_drop = "DROP TABLE IF EXISTS etl_loads;"
+song_play_rollup_drop = "DROP TABLE IF EXISTS song_plays_daily;"
+level_play_rollup_drop = "DROP TABLE IF EXISTS level_plays_hourly;"
+active_user_rollup_drop = "DROP TABLE IF EXISTS active_users_daily;"
 
 # CREATE TABLES
 
-staging_events_table_create= ("""CREATE TABLE IF NOT EXISTS stg_events(
+# stg_events_raw and stg_songs_raw are the COPY targets; the keyed staging
+# tables are distributed and sorted on the song match key, so the songplays
+# join is co-located
+
+staging_events_raw_table_create = ("""CREATE TABLE IF NOT EXISTS stg_events_raw(
                                     artist varchar,
                                     auth varchar,
                                     firstName varchar,
@@ -39,7 +151,7 @@ staging_events_table_create= ("""CREATE TABLE IF NOT EXISTS stg_events(
                                     );
 """)
 
-staging_songs_table_create = ("""CREATE TABLE IF NOT EXISTS stg_songs(
+staging_songs_raw_table_create = ("""CREATE TABLE IF NOT EXISTS stg_songs_raw(
                                     artist_id varchar,
                                     artist_latitude decimal(18,5),
                                     artist_location varchar,
@@ -53,9 +165,48 @@ staging_songs_table_create = ("""CREATE TABLE IF NOT EXISTS stg_songs(
                                     );
 """)
 
+staging_events_table_create= ("""CREATE TABLE IF NOT EXISTS stg_events(
+                                    artist varchar,
+                                    auth varchar,
+                                    firstName varchar,
+                                    gender varchar,
+                                    itemInSession int,
+                                    lastName varchar,
+                                    length decimal(18,5),
+                                    level varchar,
+                                    location varchar,
+                                    method varchar,
+                                    page varchar,
+                                    registration timestamp,
+                                    sessionId int,
+                                    song varchar,
+                                    status int,
+                                    ts timestamp,
+                                    userAgent text,
+                                    userId int,
+                                    match_key char(32) distkey sortkey
+                                    );
+""")
+
+staging_songs_table_create = ("""CREATE TABLE IF NOT EXISTS stg_songs(
+                                    artist_id varchar,
+                                    artist_latitude decimal(18,5),
+                                    artist_location varchar,
+                                    artist_longitude decimal(18,5),
+                                    artist_name varchar,
+                                    duration decimal(18,5),
+                                    num_songs int,
+                                    song_id varchar,
+                                    title varchar,
+                                    year int,
+                                    match_key char(32) distkey sortkey
+                                    );
+""")
+
 songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays(
                                 songplay_id bigint IDENTITY(0,1) PRIMARY KEY, 
                                 start_time timestamp not null sortkey, 
+                                time_key timestamp not null, 
                                 user_id int not null, 
                                 level varchar not null, 
                                 song_id varchar not null distkey, 
@@ -63,27 +214,47 @@ songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays(
                                 session_id int, 
                                 location varchar, 
                                 user_agent text,
-                                CONSTRAINT user_id
-                                    FOREIGN KEY (user_id)
-                                        REFERENCES users(user_id),
+                                user_key bigint,
+                                CONSTRAINT user_key
+                                    FOREIGN KEY (user_key)
+                                        REFERENCES users(user_key),
                                 CONSTRAINT song_id
                                     FOREIGN KEY (song_id)
                                         REFERENCES songs(song_id),
                                 CONSTRAINT artist_id
                                     FOREIGN KEY (artist_id)
                                         REFERENCES artists(artist_id),
-                                CONSTRAINT start_time
-                                    FOREIGN KEY (start_time)
+                                CONSTRAINT time_key
+                                    FOREIGN KEY (time_key)
                                         REFERENCES time(start_time)
                                 );
 """)
 
+# songplays whose song is not in the catalog yet: they are loaded with the
+# UNKNOWN song/artist and resolved by `songplay_reconcile` once the song
+# arrives; distributed on the match key like stg_songs, so resolving is
+# co-located
+
+songplay_pending_table_create = ("""CREATE TABLE IF NOT EXISTS songplays_pending(
+                                start_time timestamp not null,
+                                user_id int not null,
+                                session_id int,
+                                match_key char(32) not null distkey sortkey
+                                );
+""")
+
+# Type 2 history: one row per user and level period [valid_from,
+# valid_to), the current row has valid_to 9999-12-31 and is_current set
 user_table_create = ("""CREATE TABLE IF NOT EXISTS users(
-                            user_id int PRIMARY KEY sortkey, 
+                            user_key bigint IDENTITY(0,1) PRIMARY KEY, 
+                            user_id int not null sortkey, 
                             first_name varchar, 
                             last_name varchar, 
                             gender char(1), 
-                            level varchar
+                            level varchar, 
+                            valid_from timestamp not null, 
+                            valid_to timestamp not null, 
+                            is_current boolean not null
                             )
                             diststyle all;
 """)
@@ -119,87 +290,434 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS time(
                             diststyle all;
 """)
 
+load_file_table_create = ("""CREATE TABLE IF NOT EXISTS etl_load_files(
+                                source varchar not null,
+                                s3_key varchar(1024) not null sortkey,
+                                batch_id bigint not null,
+                                loaded_at timestamp not null
+                                )
+                                diststyle all;
+""")
+
+backfill_partition_table_create = ("""CREATE TABLE IF NOT EXISTS etl_backfill_partitions(
+                                grain varchar(8) not null,
+                                partition_start timestamp not null sortkey,
+                                rows_loaded bigint,
+                                finished_at timestamp not null
+                                )
+                                diststyle all;
+""")
+
+dq_result_table_create = ("""CREATE TABLE IF NOT EXISTS etl_dq_results(
+                                run_at timestamp not null sortkey,
+                                rule varchar(256) not null,
+                                table_name varchar(256) not null,
+                                checked bigint,
+                                failures bigint,
+                                value bigint,
+                                passed boolean not null
+                                )
+                                diststyle all;
+""")
+
+# rows rejected by COPY (STL_LOAD_ERRORS) or by the local loader
+load_error_table_create = ("""CREATE TABLE IF NOT EXISTS etl_load_errors(
+                                batch_id bigint,
+                                loaded_at timestamp not null sortkey,
+                                table_name varchar(128) not null,
+                                filename varchar(256) not null,
+                                line_number bigint,
+                                column_name varchar(127),
+                                reason varchar(512),
+                                raw_line varchar(1024)
+                                )
+                                diststyle all;
+""")
+
+# songplay_id range exported by each run (see export.py)
+export_table_create = ("""CREATE TABLE IF NOT EXISTS etl_exports(
+                                export_id bigint not null sortkey,
+                                first_songplay_id bigint not null,
+                                last_songplay_id bigint not null,
+                                rows_exported bigint not null,
+                                manifest varchar(1024),
+                                rows_corrected bigint not null,
+                                corrections_manifest varchar(1024),
+                                exported_at timestamp not null
+                                )
+                                diststyle all;
+""")
+
+# songplays changed by the reconcile pass which the next export writes to
+# its corrections partition
+songplay_correction_table_create = ("""CREATE TABLE IF NOT EXISTS songplay_corrections(
+                                songplay_id bigint not null sortkey
+                                );
+""")
+
+# one row per run which wrote to the tables, the latest row is the table
+# version cached report results are keyed by
+load_table_create = ("""CREATE TABLE IF NOT EXISTS etl_loads(
+                                script varchar(64) not null,
+                                loaded_at timestamp not null sortkey,
+                                succeeded boolean not null
+                                )
+                                diststyle all;
+""")
+
+# ROLLUP TABLES
+# songplays pre-aggregated for the common dashboard queries
+
+song_play_rollup_create = ("""CREATE TABLE IF NOT EXISTS song_plays_daily(
+                                day date not null sortkey,
+                                song_id varchar not null distkey,
+                                artist_id varchar not null,
+                                plays bigint not null
+                                );
+""")
+
+level_play_rollup_create = ("""CREATE TABLE IF NOT EXISTS level_plays_hourly(
+                                hour timestamp not null sortkey,
+                                level varchar not null,
+                                plays bigint not null
+                                )
+                                diststyle all;
+""")
+
+active_user_rollup_create = ("""CREATE TABLE IF NOT EXISTS active_users_daily(
+                                day date not null sortkey,
+                                active_users bigint not null
+                                )
+                                diststyle all;
+""")
+
 # STAGING TABLES
 
-staging_events_copy = ("""
-                        copy stg_events
-                        from {}
-                        iam_role {}
-                        JSON {}
+staging_events_copy_template = ("""
+                        copy stg_events_raw
+                        from {source}
+                        iam_role {iam_role}
+                        JSON {log_jsonpath}
                         ROUNDEC
                         TIMEFORMAT 'epochmillisecs'
-                        region 'us-west-2';
-""").format( config.get('S3','LOG_DATA'), 
-             config.get('IAM_ROLE', 'ARN'), 
-             config.get('S3', 'LOG_JSONPATH') )
-
-staging_songs_copy = ("""
-                        copy stg_songs
-                        from {} 
-                        iam_role {}
+                        region '{region}'{options};
+""")
+
+staging_songs_copy_template = ("""
+                        copy stg_songs_raw
+                        from {source} 
+                        iam_role {iam_role}
                         JSON 'auto'
                         ROUNDEC
-                        region 'us-west-2';
-""").format( config.get('S3','SONG_DATA'), 
-             config.get('IAM_ROLE', 'ARN') )
+                        region '{region}'{options};
+""")
+
+# STAGING TABLES (MATCH KEY)
+# normalized, hashed title|artist|duration key computed once at load time;
+# durations are rounded to 2 decimals, so differently rounded decimal(18,5)
+# values still match. Events without a song get a key of their own to keep
+# them spread over all slices. Songs already in stg_songs are not added
+# again: incremental runs append to it, and a run failing before its files
+# are recorded copies them once more.
+
+song_match_key = ("""MD5(UPPER(TRIM({title})) || '|' || UPPER(TRIM({artist}))
+                        || '|' || CAST(ROUND({duration}, 2) AS varchar))""")
+
+staging_events_key_insert = ("""
+                INSERT INTO stg_events(
+                    artist,
+                    auth,
+                    firstName,
+                    gender,
+                    itemInSession,
+                    lastName,
+                    length,
+                    level,
+                    location,
+                    method,
+                    page,
+                    registration,
+                    sessionId,
+                    song,
+                    status,
+                    ts,
+                    userAgent,
+                    userId,
+                    match_key
+                )
+                SELECT
+                    artist,
+                    auth,
+                    firstName,
+                    gender,
+                    itemInSession,
+                    lastName,
+                    length,
+                    level,
+                    location,
+                    method,
+                    page,
+                    registration,
+                    sessionId,
+                    song,
+                    status,
+                    ts,
+                    userAgent,
+                    userId,
+                    COALESCE({},
+                             MD5(CAST(ts AS varchar) || '|' 
+                                 || COALESCE(CAST(userId AS varchar), '') || '|'
+                                 || COALESCE(CAST(sessionId AS varchar), '') || '|'
+                                 || COALESCE(CAST(itemInSession AS varchar), '')))
+                FROM stg_events_raw;
+""").format(song_match_key.format(title='song', artist='artist',
+                                  duration='length'))
+
+staging_songs_key_insert = ("""
+                INSERT INTO stg_songs(
+                    artist_id,
+                    artist_latitude,
+                    artist_location,
+                    artist_longitude,
+                    artist_name,
+                    duration,
+                    num_songs,
+                    song_id,
+                    title,
+                    year,
+                    match_key
+                )
+                SELECT
+                    artist_id,
+                    artist_latitude,
+                    artist_location,
+                    artist_longitude,
+                    artist_name,
+                    duration,
+                    num_songs,
+                    song_id,
+                    title,
+                    year,
+                    match_key
+                FROM (
+                    SELECT
+                        *,
+                        {} AS match_key
+                    FROM stg_songs_raw
+                ) r
+                WHERE NOT EXISTS (SELECT 1 FROM stg_songs so
+                                  WHERE so.match_key = r.match_key
+                                  AND so.song_id = r.song_id);
+""").format(song_match_key.format(title='title', artist='artist_name',
+                                  duration='duration'))
+
+staging_events_raw_truncate = "TRUNCATE stg_events_raw;"
+staging_songs_raw_truncate = "TRUNCATE stg_songs_raw;"
+
+# STAGING TABLES (INCREMENTAL)
+
+staging_events_truncate = "TRUNCATE stg_events;"
+
+# the COPY templates with MANIFEST (and GZIP for compacted source files)
+# keep a {} placeholder for the manifest url
+
+COPY_OPTION = "\n                        {}"
+
+slice_count_select = "SELECT COUNT(1) FROM stv_slices;"
+
+# STAGING TABLES (BACKFILL)
+# each backfill partition runs in its own session on temp tables which
+# shadow the staging tables, so partitions can load in parallel
+
+staging_temp_tables_create = ("""
+                CREATE TEMP TABLE stg_events_raw (LIKE stg_events_raw);
+                CREATE TEMP TABLE stg_events (LIKE stg_events);
+""")
+
+staging_events_window_delete = ("""
+                DELETE FROM stg_events
+                WHERE ts < %s OR ts >= %s;
+""")
+
+staging_songs_truncate = "TRUNCATE stg_songs;"
+
+# CONNECTION
+# pooled connections keep their search path, so connections without a
+# schema are reset to the default one
+
+search_path_default_set = 'SET search_path TO "$user", public;'
+
+# ETL STATE
+
+loaded_files_select = ("""
+                SELECT s3_key
+                FROM etl_load_files
+                WHERE source = %s;
+""")
+
+high_water_mark_select = ("""
+                SELECT MAX(s3_key)
+                FROM etl_load_files
+                WHERE source = %s;
+""")
+
+# STAGING TABLES (LOAD ERRORS)
+# rows rejected by the COPY of a table since a point in time, or by COPYs
+# given by query id (independent of the client clock); COPY logs one row
+# per rejected line, failed COPYs included
+
+load_errors_select = ("""
+                SELECT DISTINCT
+                    TRIM(filename),
+                    line_number,
+                    TRIM(colname),
+                    TRIM(err_reason),
+                    TRIM(raw_line)
+                FROM stl_load_errors
+                WHERE starttime >= %s
+                AND tbl IN (SELECT id 
+                            FROM stv_tbl_perm 
+                            WHERE TRIM(name) = %s)
+                ORDER BY 1, 2;
+""")
+
+copy_load_errors_select = ("""
+                SELECT DISTINCT
+                    TRIM(filename),
+                    line_number,
+                    TRIM(colname),
+                    TRIM(err_reason),
+                    TRIM(raw_line)
+                FROM stl_load_errors
+                WHERE query IN %s
+                ORDER BY 1, 2;
+""")
+
+# query id of the last COPY of the session, also of a failed one
+last_copy_id_select = "SELECT pg_last_copy_id();"
+
+load_errors_insert = ("""
+                INSERT INTO etl_load_errors(
+                    batch_id,
+                    loaded_at,
+                    table_name,
+                    filename,
+                    line_number,
+                    column_name,
+                    reason,
+                    raw_line
+                )
+                VALUES %s;
+""")
+
+loaded_files_insert = ("""
+                INSERT INTO etl_load_files(
+                    source,
+                    s3_key,
+                    batch_id,
+                    loaded_at
+                )
+                VALUES %s;
+""")
+
+backfill_lock = ("LOCK users, time, songplays, songplays_pending, "
+                 "song_plays_daily, level_plays_hourly, active_users_daily, "
+                 "etl_backfill_partitions;")
+
+completed_partitions_select = ("""
+                SELECT partition_start
+                FROM etl_backfill_partitions
+                WHERE grain = %s
+                AND partition_start >= %s
+                AND partition_start < %s;
+""")
+
+completed_partition_insert = ("""
+                INSERT INTO etl_backfill_partitions(
+                    grain,
+                    partition_start,
+                    rows_loaded,
+                    finished_at
+                )
+                VALUES (%s, %s, %s, %s);
+""")
+
+songplay_window_delete = ("""
+                DELETE FROM songplays
+                WHERE start_time >= %s AND start_time < %s;
+""")
+
+songplay_pending_window_delete = ("""
+                DELETE FROM songplays_pending
+                WHERE start_time >= %s AND start_time < %s;
+""")
 
 # FINAL TABLES
 
-songplay_table_insert = ("""
+# events without a song in the catalog are loaded with the UNKNOWN song
+# and artist (seeded by create_tables.py) instead of being dropped; songs
+# sharing a match key are joined once (the lowest song_id), so every event
+# gives one songplay
+
+songplay_table_insert_template = ("""
                 INSERT INTO songplays(
                         start_time,
+                        time_key,
                         user_id,
                         level,
                         song_id,
                         artist_id,
                         session_id,
                         location,
-                        user_agent     
+                        user_agent,
+                        user_key
                 )
                 SELECT
-                    se.ts              AS start_time,
-                    se.userId          AS user_id,
-                    se.level           AS level,
-                    so.song_id         AS song_id,
-                    so.artist_id       AS artist_id,
-                    se.sessionId       AS session_id,
-                    se.location        AS location,
-                    se.userAgent       AS user_agent
+                    se.ts                             AS start_time,
+                    {time_key:<33} AS time_key,
+                    se.userId                         AS user_id,
+                    se.level                          AS level,
+                    COALESCE(so.song_id, 'UNKNOWN')   AS song_id,
+                    COALESCE(so.artist_id, 'UNKNOWN') AS artist_id,
+                    se.sessionId                      AS session_id,
+                    se.location                       AS location,
+                    se.userAgent                      AS user_agent,
+                    u.user_key                        AS user_key
                 FROM stg_events se
-                INNER JOIN stg_songs so
-                    ON UPPER(so.title) = UPPER(se.song)
-                    AND so.duration = se.length
+                LEFT JOIN (
+                      SELECT
+                          match_key,
+                          song_id,
+                          artist_id,
+                          ROW_NUMBER() OVER 
+                            (PARTITION BY match_key ORDER BY song_id) as row_num
+                      FROM stg_songs
+                ) so
+                    ON so.match_key = se.match_key
+                    AND so.row_num = 1
+                LEFT JOIN users u
+                    ON u.user_id = se.userId
+                    AND se.ts >= u.valid_from
+                    AND se.ts < u.valid_to
                 WHERE se.page = 'NextSong';
 """)
 
-user_table_insert = ("""
-                INSERT INTO users(
-                    user_id, 
-                    first_name, 
-                    last_name, 
-                    gender, 
-                    level
+songplay_pending_insert = ("""
+                INSERT INTO songplays_pending(
+                        start_time,
+                        user_id,
+                        session_id,
+                        match_key
                 )
-                SELECT 
-                    userid            AS user_id,
-                    firstName         AS first_name,
-                    lastName          AS last_name,
-                    gender            AS gender,
-                    level             AS level
-                FROM (
-                      SELECT
-                          userid,          
-                          firstName,       
-                          lastName,        
-                          gender,
-                          level,           
-                          ts,
-                          ROW_NUMBER() OVER 
-                            (PARTITION BY userid ORDER BY ts DESC) as row_num
-                      FROM stg_events
-                      WHERE page = 'NextSong'
-                ) 
-                WHERE row_num = 1;        
+                SELECT
+                    se.ts              AS start_time,
+                    se.userId          AS user_id,
+                    se.sessionId       AS session_id,
+                    se.match_key       AS match_key
+                FROM stg_events se
+                WHERE se.page = 'NextSong'
+                AND NOT EXISTS (SELECT 1 FROM stg_songs so
+                                WHERE so.match_key = se.match_key);
 """)
 
 song_table_insert = ("""
@@ -220,6 +738,27 @@ song_table_insert = ("""
                 FROM stg_songs;
 """)
 
+unknown_artist_insert = ("""
+                INSERT INTO artists(
+                    artist_id, 
+                    name
+                )
+                SELECT 'UNKNOWN', 'Unknown Artist'
+                WHERE NOT EXISTS (SELECT 1 FROM artists
+                                  WHERE artist_id = 'UNKNOWN');
+""")
+
+unknown_song_insert = ("""
+                INSERT INTO songs(
+                    song_id, 
+                    title, 
+                    artist_id
+                )
+                SELECT 'UNKNOWN', 'Unknown Song', 'UNKNOWN'
+                WHERE NOT EXISTS (SELECT 1 FROM songs
+                                  WHERE song_id = 'UNKNOWN');
+""")
+
 artist_table_insert = ("""
                 INSERT INTO artists(
                     artist_id, 
@@ -245,7 +784,7 @@ artist_table_insert = ("""
                     ROW_NUMBER() OVER 
                       (PARTITION BY artist_id ORDER BY year DESC) as row_num
                     FROM stg_songs
-                    )
+                    ) ar
                 WHERE row_num = 1;   
 """)
 
@@ -271,29 +810,804 @@ time_table_insert = ("""
                 FROM stg_events;
 """)
 
+# TIME_GRAIN=second/hour: every second/hour of the days with events, built
+# from a numbers table of cross joined digits instead of deduplicating the
+# event timestamps; existing rows are skipped, so re-runs and backfills can
+# use the same statement
+
+digits = "SELECT 0 AS d UNION ALL " + " UNION ALL ".join(
+    "SELECT {}".format(d) for d in range(1, 10))
+
+
+def calendar_numbers(units):
+    """
+    Returns SQL subquery of the numbers 0 .. units - 1 as column n.
+    """
+    places = len(str(units - 1))
+    return "SELECT {} AS n FROM {}".format(
+        " + ".join("{} * d{}.d".format(10 ** i, i) for i in range(places)),
+        " CROSS JOIN ".join("({}) d{}".format(digits, i)
+                            for i in range(places)))
+
+
+time_table_calendar_template = ("""
+                INSERT INTO time(
+                    start_time,
+                    hour,
+                    day,
+                    week,
+                    month,
+                    year,
+                    weekday
+                    )
+                SELECT
+                    c.start_time                      AS start_time,
+                    EXTRACT(hour from c.start_time)   AS hour,
+                    EXTRACT(day from c.start_time)    AS day,
+                    EXTRACT(week from c.start_time)   AS week,
+                    EXTRACT(month from c.start_time)  AS month,
+                    EXTRACT(year from c.start_time)   AS year,
+                    EXTRACT(dow from c.start_time)    AS weekday
+                FROM (
+                      SELECT DATEADD({grain}, nu.n, ed.day) AS start_time
+                      FROM (SELECT DISTINCT DATE_TRUNC('day', ts) AS day
+                            FROM stg_events
+                            WHERE page = 'NextSong') ed
+                      CROSS JOIN ({numbers}) nu
+                      WHERE nu.n < {units}
+                ) c
+                WHERE NOT EXISTS (SELECT 1 FROM time t 
+                                  WHERE t.start_time = c.start_time);
+""")
+
+# FINAL TABLES (INCREMENTAL)
+# stg_events only holds the current batch, stg_songs accumulates the song
+# catalog (each song is keyed once), so only keys not yet present in the
+# target tables are inserted.
+
+song_table_insert_incremental = ("""
+                INSERT INTO songs(
+                    song_id, 
+                    title, 
+                    artist_id, 
+                    year, 
+                    duration
+                ) 
+                SELECT 
+                    DISTINCT
+                    so.song_id,
+                    so.title,
+                    so.artist_id,
+                    so.year,
+                    so.duration
+                FROM stg_songs so
+                WHERE NOT EXISTS (SELECT 1 FROM songs s 
+                                  WHERE s.song_id = so.song_id);
+""")
+
+artist_table_insert_incremental = ("""
+                INSERT INTO artists(
+                    artist_id, 
+                    name, 
+                    location, 
+                    latitude, 
+                    longitude
+                ) 
+                SELECT
+                    ar.artist_id,
+                    ar.artist_name as name,
+                    ar.artist_location as location,
+                    ar.artist_latitude as latitude,
+                    ar.artist_longitude as longitude
+                FROM (
+                    SELECT
+                     artist_id,
+                     artist_name,
+                     artist_location,       
+                     artist_latitude,        
+                     artist_longitude,
+                     year,
+                    ROW_NUMBER() OVER 
+                      (PARTITION BY artist_id ORDER BY year DESC) as row_num
+                    FROM stg_songs
+                    ) ar
+                WHERE ar.row_num = 1
+                AND NOT EXISTS (SELECT 1 FROM artists a 
+                                WHERE a.artist_id = ar.artist_id);   
+""")
+
+time_table_insert_incremental = ("""
+                INSERT INTO time(
+                    start_time,
+                    hour,
+                    day,
+                    week,
+                    month,
+                    year,
+                    weekday
+                    )
+                SELECT
+                    DISTINCT
+                    se.ts                      AS start_time,
+                    EXTRACT(hour from se.ts)   AS hour,
+                    EXTRACT(day from se.ts)    AS day,
+                    EXTRACT(week from se.ts)   AS week,
+                    EXTRACT(month from se.ts)  AS month,
+                    EXTRACT(year from se.ts)   AS year,
+                    EXTRACT(dow from se.ts)    AS weekday
+                FROM stg_events se
+                WHERE NOT EXISTS (SELECT 1 FROM time t 
+                                  WHERE t.start_time = se.ts);
+""")
+
+# ROLLUP TABLES (REFRESH)
+# Only the days of the current load (the events in stg_events) are
+# recomputed from songplays: their rows are deleted and re-aggregated in
+# one transaction. Whole days are recomputed, so non-additive measures
+# (distinct users) stay correct.
+
+touched_days = ("""SELECT DISTINCT CAST(DATE_TRUNC('day', ts) AS date)
+                      FROM stg_events
+                      WHERE page = 'NextSong'""")
+
+# lower bound on the sort key, lets the scan skip older blocks
+touched_start = ("""SELECT DATE_TRUNC('day', MIN(ts))
+                      FROM stg_events
+                      WHERE page = 'NextSong'""")
+
+song_play_rollup_template = ("""
+                DELETE FROM song_plays_daily
+                WHERE day IN ({touched_days});
+                
+                INSERT INTO song_plays_daily(
+                    day,
+                    song_id,
+                    artist_id,
+                    plays
+                )
+                SELECT
+                    CAST(DATE_TRUNC('day', start_time) AS date) AS day,
+                    song_id,
+                    artist_id,
+                    COUNT(1)                                    AS plays
+                FROM songplays
+                WHERE start_time >= ({touched_start})
+                AND CAST(DATE_TRUNC('day', start_time) AS date) 
+                    IN ({touched_days})
+                GROUP BY 1, 2, 3;
+""")
+
+song_play_rollup_refresh = song_play_rollup_template.format(
+    touched_days=touched_days, touched_start=touched_start)
+
+level_play_rollup_refresh = ("""
+                DELETE FROM level_plays_hourly
+                WHERE CAST(DATE_TRUNC('day', hour) AS date) IN ({touched_days});
+                
+                INSERT INTO level_plays_hourly(
+                    hour,
+                    level,
+                    plays
+                )
+                SELECT
+                    DATE_TRUNC('hour', start_time)              AS hour,
+                    level,
+                    COUNT(1)                                    AS plays
+                FROM songplays
+                WHERE start_time >= ({touched_start})
+                AND CAST(DATE_TRUNC('day', start_time) AS date) 
+                    IN ({touched_days})
+                GROUP BY 1, 2;
+""").format(touched_days=touched_days, touched_start=touched_start)
+
+active_user_rollup_refresh = ("""
+                DELETE FROM active_users_daily
+                WHERE day IN ({touched_days});
+                
+                INSERT INTO active_users_daily(
+                    day,
+                    active_users
+                )
+                SELECT
+                    CAST(DATE_TRUNC('day', start_time) AS date) AS day,
+                    COUNT(DISTINCT user_id)                     AS active_users
+                FROM songplays
+                WHERE start_time >= ({touched_start})
+                AND CAST(DATE_TRUNC('day', start_time) AS date) 
+                    IN ({touched_days})
+                GROUP BY 1;
+""").format(touched_days=touched_days, touched_start=touched_start)
+
+# SONGPLAYS (RECONCILE)
+# Resolves pending songplays whose song has arrived in stg_songs: only the
+# pending rows are joined, the matching UNKNOWN songplays are updated and
+# the song rollup of their days is recomputed. Pending rows are found by
+# start time, user and session (events without session included, so every
+# resolved pending row is updated before it is deleted). The updated
+# songplays are queued in songplay_corrections for the export. All
+# statements run in one transaction.
+
+songplay_resolved_create = ("""
+                CREATE TEMP TABLE songplays_resolved AS
+                SELECT
+                    p.start_time,
+                    p.user_id,
+                    p.session_id,
+                    p.match_key,
+                    so.song_id,
+                    so.artist_id
+                FROM songplays_pending p
+                INNER JOIN (
+                      SELECT
+                          match_key,
+                          song_id,
+                          artist_id,
+                          ROW_NUMBER() OVER 
+                            (PARTITION BY match_key ORDER BY song_id) as row_num
+                      FROM stg_songs
+                      WHERE match_key IN (SELECT match_key 
+                                          FROM songplays_pending)
+                ) so
+                    ON so.match_key = p.match_key
+                WHERE so.row_num = 1;
+""")
+
+songplay_correction_insert = ("""
+                INSERT INTO songplay_corrections(
+                    songplay_id
+                )
+                SELECT songplays.songplay_id
+                FROM songplays
+                INNER JOIN songplays_resolved
+                    ON songplays.start_time = songplays_resolved.start_time
+                    AND songplays.user_id = songplays_resolved.user_id
+                    AND COALESCE(songplays.session_id, -1)
+                        = COALESCE(songplays_resolved.session_id, -1)
+                WHERE songplays.song_id = 'UNKNOWN'
+                AND songplays.start_time >= (SELECT MIN(start_time) 
+                                             FROM songplays_resolved);
+""")
+
+songplay_resolved_update = ("""
+                UPDATE songplays
+                SET song_id = songplays_resolved.song_id,
+                    artist_id = songplays_resolved.artist_id
+                FROM songplays_resolved
+                WHERE songplays.song_id = 'UNKNOWN'
+                AND songplays.start_time >= (SELECT MIN(start_time) 
+                                             FROM songplays_resolved)
+                AND songplays.start_time = songplays_resolved.start_time
+                AND songplays.user_id = songplays_resolved.user_id
+                AND COALESCE(songplays.session_id, -1)
+                    = COALESCE(songplays_resolved.session_id, -1);
+""")
+
+songplay_pending_resolved_delete = ("""
+                DELETE FROM songplays_pending
+                USING songplays_resolved
+                WHERE songplays_pending.match_key = songplays_resolved.match_key;
+""")
+
+song_play_rollup_reconcile = song_play_rollup_template.format(
+    touched_days="""SELECT DISTINCT CAST(DATE_TRUNC('day', start_time) AS date)
+                      FROM songplays_resolved""",
+    touched_start="""SELECT DATE_TRUNC('day', MIN(start_time))
+                      FROM songplays_resolved""")
+
+songplay_resolved_drop = "DROP TABLE songplays_resolved;"
+
+# SONGPLAYS (EXPORT)
+# songplays inserted since the last export, found by the IDENTITY column:
+# (last exported songplay_id, highest songplay_id], and the corrections:
+# songplays exported before and changed since by the reconcile pass; the
+# partition column day is not written into the files
+
+export_high_water_mark_select = ("""
+                SELECT COALESCE(MAX(last_songplay_id), -1)
+                FROM etl_exports;
+""")
+
+songplay_max_id_select = "SELECT MAX(songplay_id) FROM songplays;"
+
+songplay_export_template = ("""
+                SELECT
+                    songplay_id,
+                    start_time,
+                    time_key,
+                    user_id,
+                    level,
+                    song_id,
+                    artist_id,
+                    session_id,
+                    location,
+                    user_agent,
+                    TO_CHAR(start_time, 'YYYY-MM-DD') AS day
+                FROM songplays
+                WHERE {where}
+                ORDER BY songplay_id
+""")
+
+songplay_export_select = songplay_export_template.format(
+    where="songplay_id > {first} AND songplay_id <= {last}")
+
+songplay_correction_export_select = songplay_export_template.format(
+    where="""songplay_id IN (SELECT songplay_id
+                                      FROM songplay_corrections
+                                      WHERE songplay_id <= {first})""")
+
+songplay_export_count = ("""
+                SELECT COUNT(1)
+                FROM songplays
+                WHERE songplay_id > %s AND songplay_id <= %s;
+""")
+
+songplay_correction_count = ("""
+                SELECT COUNT(DISTINCT songplay_id)
+                FROM songplay_corrections
+                WHERE songplay_id <= %s;
+""")
+
+# corrections up to the last exported songplay_id are written out, later
+# ones are part of the exported range
+songplay_correction_delete = ("""
+                DELETE FROM songplay_corrections
+                WHERE songplay_id <= %s;
+""")
+
+# the select is inlined with its quotes doubled
+songplay_unload_template = ("""
+                UNLOAD ('{{select}}')
+                TO '{{prefix}}'
+                IAM_ROLE {iam_role}
+                FORMAT AS PARQUET
+                PARTITION BY (day)
+                MANIFEST;
+""")
+
+export_insert = ("""
+                INSERT INTO etl_exports(
+                    export_id,
+                    first_songplay_id,
+                    last_songplay_id,
+                    rows_exported,
+                    manifest,
+                    rows_corrected,
+                    corrections_manifest,
+                    exported_at
+                )
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+""")
+
+# TABLE VERSION
+
+load_insert = ("""
+                INSERT INTO etl_loads(script, loaded_at, succeeded)
+                VALUES (%s, %s, %s);
+""")
+
+load_version_select = ("""
+                SELECT COUNT(1), MAX(loaded_at)
+                FROM etl_loads;
+""")
+
+# USERS (TYPE 2 HISTORY)
+# Only the users of the batch are compared: their existing periods and
+# the batch events are merged into one timeline, a period starts where
+# the level changes. Periods which still start at the same time are kept
+# (and keep their user_key), the others are deleted or inserted. Events
+# may arrive out of order (backfills), so a batch can split or join older
+# periods; songplays of the batch users from the first batch event on
+# are re-keyed to the period they fall into. Used by all load modes.
+
+user_history_merge = ("""
+                CREATE TEMP TABLE users_periods AS
+                SELECT
+                    user_id,
+                    first_name,
+                    last_name,
+                    gender,
+                    level,
+                    valid_from,
+                    COALESCE(LEAD(valid_from) OVER 
+                               (PARTITION BY user_id ORDER BY valid_from),
+                             CAST('9999-12-31' AS timestamp)) AS valid_to
+                FROM (
+                      SELECT
+                          user_id,
+                          first_name,
+                          last_name,
+                          gender,
+                          level,
+                          valid_from,
+                          LAG(level) OVER 
+                            (PARTITION BY user_id 
+                             ORDER BY valid_from, level) AS previous_level
+                      FROM (
+                            SELECT user_id, first_name, last_name, gender,
+                                   level, valid_from
+                            FROM users
+                            WHERE user_id IN (SELECT DISTINCT userid
+                                              FROM stg_events
+                                              WHERE page = 'NextSong')
+                            UNION ALL
+                            SELECT userid, firstName, lastName, gender,
+                                   level, ts
+                            FROM stg_events
+                            WHERE page = 'NextSong'
+                            AND userid IS NOT NULL
+                      ) timeline
+                ) changes
+                WHERE previous_level IS NULL OR previous_level <> level;
+                
+                DELETE FROM users
+                WHERE user_id IN (SELECT user_id FROM users_periods)
+                AND NOT EXISTS (SELECT 1 FROM users_periods p
+                                WHERE p.user_id = users.user_id
+                                AND p.valid_from = users.valid_from);
+                
+                UPDATE users
+                SET valid_to = users_periods.valid_to,
+                    is_current = users_periods.valid_to 
+                                 = CAST('9999-12-31' AS timestamp)
+                FROM users_periods
+                WHERE users.user_id = users_periods.user_id
+                AND users.valid_from = users_periods.valid_from
+                AND users.valid_to <> users_periods.valid_to;
+                
+                INSERT INTO users(
+                    user_id, 
+                    first_name, 
+                    last_name, 
+                    gender, 
+                    level, 
+                    valid_from, 
+                    valid_to, 
+                    is_current
+                )
+                SELECT
+                    user_id, 
+                    first_name, 
+                    last_name, 
+                    gender, 
+                    level, 
+                    valid_from, 
+                    valid_to, 
+                    valid_to = CAST('9999-12-31' AS timestamp)
+                FROM users_periods p
+                WHERE NOT EXISTS (SELECT 1 FROM users u
+                                  WHERE u.user_id = p.user_id
+                                  AND u.valid_from = p.valid_from);
+                
+                UPDATE songplays
+                SET user_key = users.user_key
+                FROM users
+                WHERE songplays.user_id = users.user_id
+                AND songplays.start_time >= users.valid_from
+                AND songplays.start_time < users.valid_to
+                AND songplays.start_time >= (SELECT MIN(ts) 
+                                             FROM stg_events
+                                             WHERE page = 'NextSong')
+                AND songplays.user_id IN (SELECT user_id FROM users_periods)
+                AND (songplays.user_key IS NULL 
+                     OR songplays.user_key <> users.user_key);
+                
+                DROP TABLE users_periods;
+""")
+
+# FINAL TABLES (MERGE)
+# Upserts the dimension tables: the deduplicated batch is staged in a temp
+# table, target rows with the same key are deleted and the staged rows
+# inserted. All statements of a merge run in one transaction.
+
+song_table_merge = ("""
+                CREATE TEMP TABLE songs_stage AS
+                SELECT 
+                    DISTINCT
+                    song_id,
+                    title,
+                    artist_id,
+                    year,
+                    duration
+                FROM stg_songs;
+                
+                DELETE FROM songs
+                USING songs_stage
+                WHERE songs.song_id = songs_stage.song_id;
+                
+                INSERT INTO songs(
+                    song_id, 
+                    title, 
+                    artist_id, 
+                    year, 
+                    duration
+                ) 
+                SELECT
+                    song_id,
+                    title,
+                    artist_id,
+                    year,
+                    duration
+                FROM songs_stage;
+                
+                DROP TABLE songs_stage;
+""")
+
+artist_table_merge = ("""
+                CREATE TEMP TABLE artists_stage AS
+                SELECT
+                    artist_id,
+                    artist_name as name,
+                    artist_location as location,
+                    artist_latitude as latitude,
+                    artist_longitude as longitude
+                FROM (
+                    SELECT
+                     artist_id,
+                     artist_name,
+                     artist_location,       
+                     artist_latitude,        
+                     artist_longitude,
+                     year,
+                    ROW_NUMBER() OVER 
+                      (PARTITION BY artist_id ORDER BY year DESC) as row_num
+                    FROM stg_songs
+                    ) ar
+                WHERE row_num = 1;
+                
+                DELETE FROM artists
+                USING artists_stage
+                WHERE artists.artist_id = artists_stage.artist_id;
+                
+                INSERT INTO artists(
+                    artist_id, 
+                    name, 
+                    location, 
+                    latitude, 
+                    longitude
+                ) 
+                SELECT
+                    artist_id, 
+                    name, 
+                    location, 
+                    latitude, 
+                    longitude
+                FROM artists_stage;
+                
+                DROP TABLE artists_stage;
+""")
+
+time_table_merge = ("""
+                CREATE TEMP TABLE time_stage AS
+                SELECT
+                    DISTINCT
+                    ts                      AS start_time,
+                    EXTRACT(hour from ts)   AS hour,
+                    EXTRACT(day from ts)    AS day,
+                    EXTRACT(week from ts)   AS week,
+                    EXTRACT(month from ts)  AS month,
+                    EXTRACT(year from ts)   AS year,
+                    EXTRACT(dow from ts)    AS weekday
+                FROM stg_events;
+                
+                DELETE FROM time
+                USING time_stage
+                WHERE time.start_time = time_stage.start_time;
+                
+                INSERT INTO time(
+                    start_time,
+                    hour,
+                    day,
+                    week,
+                    month,
+                    year,
+                    weekday
+                    )
+                SELECT
+                    start_time,
+                    hour,
+                    day,
+                    week,
+                    month,
+                    year,
+                    weekday
+                FROM time_stage;
+                
+                DROP TABLE time_stage;
+""")
+
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, 
+create_table_queries = [staging_events_raw_table_create, 
+                        staging_songs_raw_table_create, 
+                        staging_events_table_create, 
                         staging_songs_table_create, 
                         user_table_create, 
                         song_table_create, 
                         artist_table_create, 
                         time_table_create, 
-                        songplay_table_create ]
+                        songplay_table_create,
+                        songplay_pending_table_create,
+                        load_file_table_create,
+                        backfill_partition_table_create,
+                        dq_result_table_create,
+                        load_error_table_create,
+                        export_table_create,
+                        songplay_correction_table_create,
+                        load_table_create,
+                        song_play_rollup_create,
+                        level_play_rollup_create,
+                        active_user_rollup_create ]
 
-drop_table_queries = [staging_events_table_drop, 
+drop_table_queries = [staging_events_raw_table_drop, 
+                      staging_songs_raw_table_drop, 
+                      staging_events_table_drop, 
                       staging_songs_table_drop, 
                       songplay_table_drop, 
+                      songplay_pending_table_drop, 
                       user_table_drop, 
                       song_table_drop, 
                       artist_table_drop, 
-                      time_table_drop ]
+                      time_table_drop,
+                      load_file_table_drop,
+                      backfill_partition_table_drop,
+                      dq_result_table_drop,
+                      load_error_table_drop,
+                      export_table_drop,
+                      songplay_correction_table_drop,
+                      load_table_drop,
+                      song_play_rollup_drop,
+                      level_play_rollup_drop,
+                      active_user_rollup_drop ]
+
+staging_key_queries = [staging_events_key_insert, 
+                       staging_songs_key_insert ]
+
+seed_table_queries = [unknown_artist_insert, 
+                      unknown_song_insert ]
+
+songplay_reconcile_queries = [songplay_resolved_create, 
+                              songplay_correction_insert, 
+                              songplay_resolved_update, 
+                              songplay_pending_resolved_delete, 
+                              song_play_rollup_reconcile, 
+                              songplay_resolved_drop ]
+
+staging_truncate_queries = [staging_events_truncate, 
+                            staging_songs_truncate ]
+
+staging_raw_truncate_queries = [staging_events_raw_truncate, 
+                                staging_songs_raw_truncate ]
+
+# LOAD DEPENDENCIES
+# target table -> tables which must be loaded first
+
+copy_table_dependencies = {}
+
+insert_table_dependencies = {'songplays': ['users', 'artists', 'time', 'songs'],
+                             'songplays_pending': ['songplays'],
+                             'song_plays_daily': ['songplays'],
+                             'level_plays_hourly': ['songplays'],
+                             'active_users_daily': ['songplays']}
+
+# COMPILED QUERIES
+
+# names of the statements and lists returned by `compile_queries`
+COMPILED_QUERIES = ['staging_events_copy', 'staging_songs_copy',
+                    'staging_events_copy_manifest',
+                    'staging_songs_copy_manifest',
+                    'staging_events_copy_manifest_gzip',
+                    'staging_songs_copy_manifest_gzip',
+                    'songplay_table_insert', 'time_table_calendar_insert',
+                    'search_path_set', 'songplay_unload',
+                    'copy_table_queries',
+                    'insert_table_queries', 'incremental_insert_table_queries',
+                    'merge_insert_table_queries']
+
+
+@lru_cache(maxsize=256)
+def compile_queries(spec):
+    """
+    Returns dictionary with the statements (and query lists) of
+    `COMPILED_QUERIES` built from the templates for a QuerySpec, in the
+    dialect of the spec. The result is cached per spec, so per-partition
+    and per-schema loads of one process compile each statement once.
+
+    `time_table_calendar_insert` is None at timestamp grain;
+    `search_path_set` restores the default search path without a schema.
+    """
+    copy = {'iam_role': spec.iam_role, 'log_jsonpath': spec.log_jsonpath,
+            'region': spec.region}
+    options = ''
+    if spec.max_errors:
+        options = COPY_OPTION.format('MAXERROR {}'.format(spec.max_errors))
+    manifest = options + COPY_OPTION.format('MANIFEST')
+    manifest_gzip = options + COPY_OPTION.format('MANIFEST GZIP')
+    events_source = spec.log_data
+    if spec.partition:
+        events_source = "'{}/{}'".format(spec.log_data.strip("'").rstrip('/'),
+                                         spec.partition)
+
+    queries = {
+        'staging_events_copy': staging_events_copy_template.format(
+            source=events_source, options=options, **copy),
+        'staging_songs_copy': staging_songs_copy_template.format(
+            source=spec.song_data, options=options, **copy),
+        'staging_events_copy_manifest': staging_events_copy_template.format(
+            source='{}', options=manifest, **copy),
+        'staging_songs_copy_manifest': staging_songs_copy_template.format(
+            source='{}', options=manifest, **copy),
+        'staging_events_copy_manifest_gzip':
+            staging_events_copy_template.format(
+                source='{}', options=manifest_gzip, **copy),
+        'staging_songs_copy_manifest_gzip': staging_songs_copy_template.format(
+            source='{}', options=manifest_gzip, **copy),
+        'songplay_table_insert': songplay_table_insert_template.format(
+            time_key='se.ts' if spec.time_grain == 'timestamp'
+            else "DATE_TRUNC('{}', se.ts)".format(spec.time_grain)),
+        'songplay_unload': songplay_unload_template.format(
+            iam_role=spec.iam_role),
+        'time_table_calendar_insert': None,
+        'search_path_set': search_path_default_set,
+    }
+    if spec.time_grain in TIME_GRAIN_UNITS:
+        units = TIME_GRAIN_UNITS[spec.time_grain]
+        queries['time_table_calendar_insert'] = \
+            time_table_calendar_template.format(
+                grain=spec.time_grain, numbers=calendar_numbers(units),
+                units=units)
+    if spec.schema:
+        queries['search_path_set'] = "SET search_path TO {};".format(
+            spec.schema)
+
+    time_insert = queries['time_table_calendar_insert']
+    queries['copy_table_queries'] = [queries['staging_events_copy'],
+                                     queries['staging_songs_copy']]
+    queries['insert_table_queries'] = [user_history_merge,
+                                       artist_table_insert,
+                                       time_insert or time_table_insert,
+                                       song_table_insert,
+                                       queries['songplay_table_insert'],
+                                       songplay_pending_insert,
+                                       song_play_rollup_refresh,
+                                       level_play_rollup_refresh,
+                                       active_user_rollup_refresh]
+    queries['incremental_insert_table_queries'] = [
+        user_history_merge,
+        artist_table_insert_incremental,
+        time_insert or time_table_insert_incremental,
+        song_table_insert_incremental,
+        queries['songplay_table_insert'],
+        songplay_pending_insert,
+        song_play_rollup_refresh,
+        level_play_rollup_refresh,
+        active_user_rollup_refresh]
+    queries['merge_insert_table_queries'] = [user_history_merge,
+                                             artist_table_merge,
+                                             time_insert or time_table_merge,
+                                             song_table_merge,
+                                             queries['songplay_table_insert'],
+                                             songplay_pending_insert,
+                                             song_play_rollup_refresh,
+                                             level_play_rollup_refresh,
+                                             active_user_rollup_refresh]
+
+    for name, value in queries.items():
+        if isinstance(value, list):
+            queries[name] = [translate(query, spec.dialect) for query in value]
+        elif value is not None:
+            queries[name] = translate(value, spec.dialect)
+    return queries
 
-copy_table_queries = [staging_events_copy, 
-                      staging_songs_copy ]
 
-insert_table_queries = [user_table_insert, 
-                        artist_table_insert, 
-                        time_table_insert, 
-                        song_table_insert, 
-                        songplay_table_insert ]
\ No newline at end of file
+def __getattr__(name):
+    """
+    Returns a compiled statement of dwh.cfg by module attribute, e.g.
+    `from sql_queries import insert_table_queries`; dwh.cfg is read on
+    first access instead of at import.
+    """
+    if name == 'TIME_GRAIN':
+        return default_spec().time_grain
+    if name in COMPILED_QUERIES:
+        return compile_queries(default_spec())[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(
+        __name__, name))
@@ -1,45 +1,73 @@
 import configparser
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 from prettytable import PrettyTable
+import dq_rules
+import instrumentation
+import reporting
+from backends import get_backend
+from sql_queries import get_spec
 
 
-def get_test_definition():
+def get_test_definition(time_grain='timestamp'):
     """
-    returns list of dictionaries with test definition and sql statements.
+    returns list of dictionaries with test definition; source and target
+    are aggregates (`function` over `column`, rows matching `filter` only)
+    of a table. `time_grain` is the grain of the time dimension.
     """
     
-    ## DATA QUALITY TEST DEFINITION (SQL)
-   
+    ## DATA QUALITY TEST DEFINITION
+    
     # USERS Count
-    user_stg_count = """SELECT COUNT(DISTINCT userId) 
-                        FROM stg_events WHERE page='NextSong';"""
+    user_stg_count = {'table': 'stg_events', 'function': 'count_distinct',
+                      'column': 'userId', 'filter': "page = 'NextSong'"}
     
-    user_dim_count = """SELECT COUNT(user_id) FROM users;"""
+    user_dim_count = {'table': 'users', 'function': 'count',
+                      'column': 'user_id', 'filter': 'is_current'}
     
     
     # ARTISTS Count
-    artist_stg_count = """SELECT COUNT(DISTINCT artist_id) FROM stg_songs;"""
+    artist_stg_count = {'table': 'stg_songs', 'function': 'count_distinct',
+                        'column': 'artist_id'}
     
-    artist_dim_count = """SELECT COUNT(artist_id) from artists;"""
+    artist_dim_count = {'table': 'artists', 'function': 'count',
+                        'column': 'artist_id',
+                        'filter': "artist_id <> 'UNKNOWN'"}
     
     
     # SONGS Count
-    song_stg_count = """SELECT COUNT(DISTINCT song_id) FROM stg_songs;"""
+    song_stg_count = {'table': 'stg_songs', 'function': 'count_distinct',
+                      'column': 'song_id'}
+    
+    song_dim_count = {'table': 'songs', 'function': 'count',
+                      'column': 'song_id', 'filter': "song_id <> 'UNKNOWN'"}
     
-    song_dim_count = """SELECT COUNT(song_id) FROM songs;"""
     
+    # TIME Count (calendar time dimension: time keys of the songplays)
+    time_stg_count = {'table': 'stg_events', 'function': 'count_distinct',
+                      'column': 'ts'}
     
-    # TIME Count
-    time_stg_count = """SELECT COUNT(DISTINCT ts) FROM stg_events;"""
+    time_dim_count = {'table': 'time', 'function': 'count',
+                      'column': 'start_time'}
     
-    time_dim_count = """SELECT COUNT(start_time) FROM time;"""
+    if time_grain != 'timestamp':
+        time_stg_count = {'table': 'stg_events',
+                          'function': 'count_distinct',
+                          'column': "DATE_TRUNC('{}', ts)".format(time_grain),
+                          'filter': "page = 'NextSong'"}
+        
+        time_dim_count = {'table': 'songplays',
+                          'function': 'count_distinct',
+                          'column': 'time_key'}
     
     
     # SONGPLAYS Count
-    songplays_stg_count = """SELECT COUNT(1) FROM stg_events
-                             WHERE page='NextSong';"""
+    songplays_stg_count = {'table': 'stg_events', 'function': 'count',
+                           'column': '1', 'filter': "page = 'NextSong'"}
     
-    songplays_fact_count = """SELECT COUNT(1) FROM songplays;"""
+    songplays_fact_count = {'table': 'songplays', 'function': 'count',
+                            'column': '1'}
 
     
     ## BUILD QUERY LIST
@@ -66,39 +94,131 @@ def get_test_definition():
     test_definition = [user, artist, song, time, songplays]
     
     return test_definition
-    
 
-def run_test(cur, conn, test_definition):
+
+def compile_aggregate(aggregate, approximate=False):
+    """
+    Returns SQL expression of an aggregate. Filters are applied inside the
+    aggregate, so aggregates with different filters share one table scan.
+    """
+    column = aggregate['column']
+    if aggregate.get('filter'):
+        column = "CASE WHEN {} THEN {} END".format(aggregate['filter'], column)
+    
+    if aggregate['function'] == 'count_distinct':
+        expression = "COUNT(DISTINCT {})".format(column)
+        if approximate:
+            expression = "APPROXIMATE " + expression
+        return expression
+    if aggregate['function'] == 'count':
+        return "COUNT({})".format(column)
+    raise ValueError("Unknown aggregate function: {}".format(
+        aggregate['function']))
+
+
+def compile_test_queries(test_definition, approximate=False):
+    """
+    Returns dictionary of one aggregate query per table computing all
+    source/target values of the test definition on that table, and the
+    (table, column index) of each value, keyed by (test, side).
+    """
+    expressions = {}
+    positions = {}
+    for test in test_definition:
+        for side in ('source', 'target'):
+            aggregate = test[side]
+            expression = compile_aggregate(aggregate, approximate)
+            table_expressions = expressions.setdefault(aggregate['table'], [])
+            if expression not in table_expressions:
+                table_expressions.append(expression)
+            positions[(test['test'], side)] = (
+                aggregate['table'], table_expressions.index(expression))
+    
+    queries = {table: "SELECT {} FROM {};".format(
+                   ",\n       ".join(table_expressions), table)
+               for table, table_expressions in expressions.items()}
+    
+    return queries, positions
+
+
+def fetch_test_row(cur, query, cache=None, version=None):
+    """
+    Runs an aggregate query and returns the result row, from the cache if
+    the tables did not change since it was cached.
+    """
+    if cache is None:
+        instrumentation.execute(cur, query)
+        return cur.fetchone()
+    return reporting.fetch_cached(cur, cache, query, version=version)[1][0]
+
+
+def run_test_query(backend, query, cache=None, version=None):
+    """
+    Runs an aggregate query on a connection of its own and returns the
+    result row.
+    """
+    conn = backend.connect()
+    try:
+        cur = conn.cursor()
+        row = fetch_test_row(cur, query, cache, version)
+        conn.rollback()
+        return row
+    finally:
+        backend.release(conn)
+
+
+def run_test(cur, conn, test_definition, backend=None, workers=1,
+             approximate=False, cache=None):
     """
     Runs test definition against database and
     returns list of dictionaries with test results.
+    
+    All values of a table are computed by one aggregate query; with a
+    backend and more than one worker the per-table queries run
+    concurrently. `approximate` uses APPROXIMATE COUNT(DISTINCT) (Redshift).
+    With a `reporting.ResultCache` results of unchanged tables are served
+    from the cache.
     """
-
+    
+    queries, positions = compile_test_queries(test_definition, approximate)
+    
+    rows = {}
+    try:
+        version = None
+        if cache is not None:
+            version = reporting.get_version(cur)
+        
+        if backend is not None and workers > 1:
+            # run per-table queries concurrently
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {table: executor.submit(run_test_query, backend,
+                                                  query, cache, version)
+                           for table, query in queries.items()}
+                rows = {table: future.result()
+                        for table, future in futures.items()}
+        else:
+            for table, query in queries.items():
+                rows[table] = fetch_test_row(cur, query, cache, version)
+    except psycopg2.Error:
+        print("Error: Retrieving results from database")
+        raise
+    
     test_results = []
-    test_result = {}
     for test in test_definition:
-        try:
-            # run test against source table
-            cur.execute(test['source'])
-            source_value = cur.fetchone()[0]
-            
-            # run test against target table
-            cur.execute(test['target'])
-            target_value = cur.fetchone()[0]
-            
-            # calculate differences
-            diff = source_value - target_value
-            
-            # assign result
-            test_result = {'test': test['test'], 'source':source_value, 
-                           'target': target_value, 'diff': diff}
-            
-            # build result list
-            test_results.append(test_result)
+        table, index = positions[(test['test'], 'source')]
+        source_value = rows[table][index]
+        table, index = positions[(test['test'], 'target')]
+        target_value = rows[table][index]
+        
+        # calculate differences
+        diff = source_value - target_value
+        
+        # assign result
+        test_result = {'test': test['test'], 'source':source_value, 
+                       'target': target_value, 'diff': diff}
         
-        except psycopg2.Error:
-            print("Error: Retrieving results from database")
-            raise
+        # build result list
+        test_results.append(test_result)
     
     return test_results
 
@@ -123,53 +243,88 @@ def main():
     """  
     - Reads configuration file.
     
-    - Establishes connection with the sparkify database and gets
+    - Establishes connection with the sparkify database of the configured
+    backend (Redshift or local PostgreSQL) and gets
     cursor to it.  
     
-    - Retrieves data quality test definition (SQL statements).
+    - Retrieves data quality test definition.
     
-    - Runs test definition against database.
+    - Runs test definition against database, one aggregate query per
+    table (section [TEST]: WORKERS concurrent queries, APPROXIMATE
+    distinct counts on Redshift, CACHE results of unchanged tables as
+    configured in section [REPORTING]).
     
     - Prints test definition in table format.
     
-    - Finally, closes the connection. 
+    - Runs the data quality rules of the rules file (section [TEST]
+    RULES) and prints their results.
+    
+    - Finally, releases the connection. 
+    
+    Returns the exit code: 0 if all rules passed, 1 if the process failed,
+    otherwise the highest EXIT_CODE of the failed rules.
     """
     
     # read config
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    backend = get_backend(config)
+    instrumentation.configure(config, backend.name)
+    workers = config.getint('TEST', 'WORKERS', fallback=1)
+    approximate = (config.getboolean('TEST', 'APPROXIMATE', fallback=False)
+                   and backend.name == 'redshift')
+    rules_file = config.get('TEST', 'RULES', fallback='')
+    cache = None
+    if config.getboolean('TEST', 'CACHE', fallback=False):
+        cache = reporting.ResultCache.from_settings(
+            reporting.get_settings(config))
     
     # set process status
     success = False
+    exit_code = 1
     conn = None
     try:
         # connect database
-        conn = psycopg2.connect("host={} dbname={} user={} password={} \
-                                port={}".format(*config['CLUSTER'].values()))
+        conn = backend.connect()
         # create cursor
         cur = conn.cursor()
         
         # get test definition
-        test_definition = get_test_definition()
+        test_definition = get_test_definition(get_spec(config).time_grain)
         
         # run tests against database
-        test_results = run_test(cur, conn, test_definition)
+        test_results = run_test(cur, conn, test_definition, backend,
+                                workers, approximate, cache)
+        if cache is not None:
+            cache.save()
         
         # print results
         print_test_results(test_results)
         
+        # run data quality rules
+        rule_results = []
+        if rules_file:
+            rules = dq_rules.read_rules(rules_file)
+            rule_results = dq_rules.run_rules(cur, conn, rules, backend)
+            dq_rules.print_rule_results(rule_results)
+        
         # change process status
         success = True
-    except psycopg2.Error as e:
+        exit_code = dq_rules.get_exit_code(rule_results)
+    except (psycopg2.Error, ValueError) as e:
         print(e)
     finally:
         if conn is not None:
-            conn.close()
-        if success:
-            print('Process suceeded')
-        else:
+            backend.release(conn)
+        if not success:
             print('Process failed')
+        elif exit_code:
+            print('Process suceeded, data quality rules failed')
+        else:
+            print('Process suceeded')
+    
+    return exit_code
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file